@@ -11,9 +11,9 @@ setup(
     url = 'https://github.com/snafus/xrdreporter.git',
     project_urls ={'Bug Tracker':'https://github.com/snafus/xrdreporter/issues'},
     classifiers =['Programming Language :: Python :: 3','License :: OSI Approved :: MIT License'],
-    packages = ['xrdreporter'],
-    python_requires = '>=3.6',
-    install_requires = ['influxdb', 'influxdb-client'],
+    packages = ['xrdreporter', 'xrdreporter.bench'],
+    python_requires = '>=3.7',
+    install_requires = ['influxdb', 'influxdb-client', 'requests'],
     scripts = ['xrdreporter/xrdrep.py',
                'xrdreporter/check.py'],
 )
@@ -0,0 +1,56 @@
+import time
+
+from xrdreporter.deltas import DeltaStore
+
+
+def record(src, tod, tos=100, **values):
+    stats = {'src': src, 'tod': tod, 'tos': tos}
+    stats.update(values)
+    return stats
+
+
+def test_rate_between_samples():
+    store = DeltaStore()
+    assert 'delta_s' not in store.calculate(record('a', 10, link__in=100))
+    stats = store.calculate(record('a', 20, link__in=300))
+    assert stats['delta_s'] == 10.
+    assert stats['delta_link__in'] == 20.
+
+
+def test_restart_resets_the_counters():
+    store = DeltaStore()
+    store.calculate(record('a', 10, link__in=1000))
+    stats = store.calculate(record('a', 20, tos=15, link__in=10))
+    assert 'delta_link__in' not in stats
+    assert store.stats()['resets'] == 1
+    # the next sample has a delta against the one after the restart
+    assert store.calculate(record('a', 30, tos=15, link__in=30))['delta_link__in'] == 2.
+
+
+def test_counter_going_backwards_has_no_delta():
+    store = DeltaStore(counters='link__in,link__num')
+    store.calculate(record('a', 10, link__in=1000, link__num=5, buff__mem=7))
+    stats = store.calculate(record('a', 20, link__in=10, link__num=6, buff__mem=3))
+    assert 'delta_link__in' not in stats
+    assert stats['delta_link__num'] == 0.1
+    # not a counter
+    assert 'delta_buff__mem' not in stats
+
+
+def test_evicts_beyond_max_sources():
+    store = DeltaStore(max_sources=2, shards=1)
+    for src in ('a', 'b', 'c'):
+        store.calculate(record(src, 10, link__in=1))
+    assert len(store) == 2
+    assert store.stats()['evicted'] == 1
+    # 'a' was the least recently updated, so starts afresh
+    assert 'delta_s' not in store.calculate(record('a', 20, link__in=2))
+
+
+def test_evicts_idle_sources():
+    store = DeltaStore(ttl=0.05, shards=1)
+    store.calculate(record('a', 10, link__in=1))
+    time.sleep(0.1)
+    store.calculate(record('b', 10, link__in=1))
+    assert len(store) == 1
+    assert store.stats()['evicted'] == 1
@@ -0,0 +1,25 @@
+from xrdreporter.filters import FieldFilter
+
+
+def test_include_and_exclude():
+    f = FieldFilter('src,tod,link.*,buff.*', 'buff__mem,link__tmo')
+    stats = {'src': 'a:1094', 'tod': 1, 'link__in': 5, 'link__tmo': 0, 'buff__reqs': 2, 'buff__mem': 3, 'sched__jobs': 4}
+    assert f.filter(stats) == {'src': 'a:1094', 'tod': 1, 'link__in': 5, 'buff__reqs': 2}
+
+
+def test_patterns_are_anchored_at_the_start():
+    f = FieldFilter('link', '')
+    assert f.filter({'link__in': 1, 'xlink': 2}) == {'link__in': 1}
+
+
+def test_exclude_wins_over_include():
+    f = FieldFilter('.*', 'ssi.*')
+    assert f.filter({'ssi__err': 1, 'tod': 2}) == {'tod': 2}
+
+
+def test_cached_decisions_and_hits():
+    f = FieldFilter('tod,src', 'src')
+    stats = {'src': 'a', 'tod': 1, 'pid': 2}
+    for _ in range(3):
+        assert f.filter(stats) == {'tod': 1}
+    assert f.hits() == {'exclude:src': 3, 'include:tod': 3, 'include:src': 0, 'unmatched': 3}
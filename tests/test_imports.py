@@ -0,0 +1,15 @@
+from xrdreporter.bench import imports
+
+
+def test_light_modules_load_no_heavy_libraries():
+    results = [imports.measure(module, repeat=1) for module in imports.LIGHT]
+    for r in results:
+        assert 'error' not in r, r['error']
+        assert r['heavy_modules'] == []
+    assert imports.check(results) == []
+
+
+def test_check_reports_heavy_imports():
+    results = [{'name': 'import.xrdreporter.observers', 'seconds': 0.5, 'heavy_modules': ['requests']}]
+    assert imports.check(results, max_ms=100) == ["xrdreporter.observers loads requests",
+                                                  "xrdreporter.observers takes 500.0 ms to import (limit 100 ms)"]
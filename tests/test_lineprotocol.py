@@ -0,0 +1,41 @@
+from xrdreporter.lineprotocol import LineProtocol, escape_key, escape_measurement, escape_string
+
+
+def test_escaping():
+    assert escape_measurement('xrd report,v2') == 'xrd\\ report\\,v2'
+    assert escape_key('a b,c=d') == 'a\\ b\\,c\\=d'
+    assert escape_string('say "hi"\\') == '"say \\"hi\\"\\\\"'
+
+
+def test_tags_and_fields_are_escaped():
+    lp = LineProtocol('xrd report', tags=('site', 'host'), extra_tags={'reporthost': 'r1'})
+    line = lp.line({'site': 'RAL T1', 'host': 'gw=1', 'link in': 5, 'ofs__role': 'data "server"'}, 123)
+    assert line == ('xrd\\ report,host=gw\\=1,reporthost=r1,site=RAL\\ T1 '
+                    'site="RAL T1",host="gw=1",link\\ in=5,ofs__role="data \\"server\\"" 123')
+
+
+def test_excluded_and_non_finite_fields_are_left_out():
+    lp = LineProtocol('m', tags=('src',), excluded=('src',))
+    assert lp.line({'src': 'a', 'x': float('nan'), 'y': 1.5}, 1) == 'm,src=a y=1.5 1'
+    assert lp.line({'src': 'a', 'x': float('inf')}, 1) is None
+
+
+def test_numbers_are_floats_by_default():
+    lp = LineProtocol('m', tags=())
+    assert lp.line({'n': 3, 'x': 2.5}, 1) == 'm n=3,x=2.5 1'
+
+
+def test_integers_fix_the_type_of_each_field():
+    lp = LineProtocol('m', tags=(), integers=True)
+    assert lp.line({'n': 3, 'x': 2.5}, 1) == 'm n=3i,x=2.5 1'
+    # an integer field takes a float without a fractional part, a float field writes ints as floats
+    assert lp.line({'n': 4.0, 'x': 2}, 2) == 'm n=4i,x=2.0 2'
+    assert lp.conflicts == 0
+
+
+def test_integers_conflict_is_skipped_and_counted():
+    lp = LineProtocol('m', tags=(), integers=True)
+    lp.line({'n': 3}, 1)
+    assert lp.line({'n': 3.5, 'x': 1.0}, 2) == 'm x=1.0 2'
+    assert lp.line({'n': 0.5}, 3) is None
+    assert lp.conflicts == 2
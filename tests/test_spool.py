@@ -0,0 +1,98 @@
+import json
+import os
+import time
+
+from xrdreporter.batching import BatchWriter, PermanentWriteError
+from xrdreporter.spool import DEAD_LETTER, Spool
+
+
+def replay_all(spool):
+    batches = []
+    batch = spool.peek()
+    while batch is not None:
+        batches.append(batch)
+        spool.commit()
+        batch = spool.peek()
+    return batches
+
+
+def test_replays_in_order_across_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=20)
+    for i in range(5):
+        spool.append([{'n': i}])
+    assert spool.stats()['segments'] > 1
+    assert replay_all(spool) == [[{'n': i}] for i in range(5)]
+    assert spool.pending() == 0
+    assert spool.size() == 0
+
+
+def test_restart_resumes_where_replay_stopped(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(3):
+        spool.append([i])
+    assert spool.peek() == [0]
+    spool.commit()
+    spool.close()
+    spool = Spool(str(tmp_path))
+    assert spool.pending() == 2
+    assert replay_all(spool) == [[1], [2]]
+
+
+def test_reject_moves_the_head_to_the_dead_letter_file(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(3):
+        spool.append([i])
+    assert spool.peek() == [0]
+    spool.commit()
+    assert spool.peek() == [1]
+    spool.reject()
+    assert replay_all(spool) == [[2]]
+    with open(os.path.join(str(tmp_path), DEAD_LETTER)) as f:
+        assert [json.loads(line) for line in f] == [[1]]
+    assert spool.stats()['dead_lettered'] == 1
+
+
+def test_full_dead_letter_file_drops_and_counts(tmp_path):
+    spool = Spool(str(tmp_path), max_bytes=10)
+    assert spool.dead_letter([1, 2])
+    assert not spool.dead_letter(list(range(10)))
+    stats = spool.stats()
+    assert stats['dead_lettered'] == 1
+    assert stats['dead_letter_dropped'] == 1
+
+
+def test_evicts_the_oldest_segments_beyond_max_bytes(tmp_path):
+    spool = Spool(str(tmp_path), max_bytes=40, segment_size=10)
+    for i in range(10):
+        spool.append(['x' * 5, i])
+    assert spool.stats()['evicted'] > 0
+    batches = replay_all(spool)
+    assert [b[1] for b in batches] == list(range(10 - len(batches), 10))
+
+
+def test_writer_spools_while_the_sink_is_down_and_replays_in_order(tmp_path):
+    written = []
+    state = {'up': False}
+
+    def write(batch):
+        if not state['up']:
+            raise ConnectionError('down')
+        if batch == ['poison']:
+            raise PermanentWriteError('bad batch')
+        written.extend(batch)
+
+    writer = BatchWriter(write, batch_size=1, flush_interval=0.01, max_retries=0,
+                         spool=Spool(str(tmp_path)), probe_interval=0.05)
+    for item in (1, 'poison', 2, 3):
+        writer.put(item)
+    deadline = time.monotonic() + 5
+    while writer.stats()['spooled'] < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    state['up'] = True
+    while writer.stats()['sink_down'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+    assert written == [1, 2, 3]
+    assert writer.stats()['rejected'] == 1
+    with open(os.path.join(str(tmp_path), DEAD_LETTER)) as f:
+        assert [json.loads(line) for line in f] == [['poison']]
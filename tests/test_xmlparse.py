@@ -0,0 +1,22 @@
+from xrdreporter.requestHandlers import parse_dom
+from xrdreporter.templates import TemplateCache
+from xrdreporter.xmlparse import SAMPLE_PACKETS, compare_parsers, parse_expat
+
+
+def test_expat_matches_minidom():
+    assert compare_parsers(SAMPLE_PACKETS, parse_dom, parse_expat) == []
+
+
+def test_expat_keeps_types():
+    stats = parse_expat(SAMPLE_PACKETS[0])
+    assert stats['tod'] == 1650000000
+    assert stats['link__in'] == 123456789012
+    assert stats['link__out'] == 5.5
+    assert stats['ofs__role'] == 'server'
+
+
+def test_template_cache_matches_expat():
+    cache = TemplateCache()
+    # the second time round each structure comes from the cache
+    assert compare_parsers(SAMPLE_PACKETS + SAMPLE_PACKETS, parse_expat, cache.parse) == []
+    assert cache.stats()['hits'] >= len(SAMPLE_PACKETS)
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from xrdreporter.servers import set_rcvbuf, udp_socket_stats
+
+
+class AsyncUDPServer:
+    """UDP server driven by an asyncio event loop, reading datagrams in batches.
+
+    Each time the socket becomes readable, up to batch_size datagrams are drained
+    from it without blocking. The batch is run through handler_class.prepare() and
+    the results are handed to the observers in one go, as a list:
+      - observers with a serve_batch_async() coroutine are scheduled on the loop;
+      - observers marked nonblocking (they only queue for their own writer thread)
+        have serve_batch() called directly;
+      - any other observer gets serve_batch() called on its own single thread, so
+        its batches stay in order without holding up the loop.
+    At most max_pending batches may be outstanding per observer; further batches
+    for it are dropped and counted. When the handler has an ObserverDispatcher,
+    the records are passed to it instead.
+    The interface mirrors socketserver.UDPServer, so either can be used by xrdrep.py
+    """
+    max_packet_size = 65535
+
+    def __init__(self, server_address, handler_class, batch_size: int = 64, rcvbuf: int = 0,
+                 max_pending: int = 100, metrics=None, reuse_port: bool = False):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.handler_class = handler_class
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.metrics = metrics
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if rcvbuf:
+            set_rcvbuf(self.socket, rcvbuf)
+        self.socket.bind(server_address)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+
+        self._loop = None
+        self._stop = None
+        self._shutdown_requested = False
+        self._stopped = threading.Event()
+        self._executors = {}
+        self._pending = {}
+        self._tasks = set()
+        # only touched from the event loop thread
+        self.received = 0
+        self.batches = 0
+        self.processed = 0
+        self.errors = 0
+        self.observer_dropped = 0
+        self.observer_errors = 0
+
+    def serve_forever(self):
+        """Run the event loop, reading datagrams until shutdown() is called"""
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._stopped.set()
+
+    async def _serve(self):
+        # _stop must exist before _loop is visible to shutdown()
+        self._stop = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        if self._shutdown_requested:
+            self._stop.set()
+        self._loop.add_reader(self.socket.fileno(), self._on_readable)
+        logging.info("Serving on {} with asyncio, up to {} datagrams per read".format(
+                     self.server_address, self.batch_size))
+        try:
+            await self._stop.wait()
+        finally:
+            self._loop.remove_reader(self.socket.fileno())
+            # let the observers finish what they have been given
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            for executor in self._executors.values():
+                executor.shutdown(wait=True)
+            self._executors = {}
+            logging.info("Asyncio server stopped: {}".format(self.stats()))
+
+    def _on_readable(self):
+        batch = []
+        recvfrom = self.socket.recvfrom
+        for _ in range(self.batch_size):
+            try:
+                batch.append(recvfrom(self.max_packet_size))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                logging.error("Socket error: {}".format(e))
+                break
+        if not batch:
+            return
+        self.received += len(batch)
+        self.batches += 1
+
+        records = []
+        prepare = self.handler_class.prepare
+        for packet, client_address in batch:
+            try:
+                stats = prepare(packet, client_address, self.socket)
+            except Exception as e:
+                self.errors += 1
+                logging.error("Error processing datagram from {}: {}".format(client_address, e))
+                continue
+            self.processed += 1
+            if stats is not None:
+                records.append(stats)
+        if records:
+            t0 = perf_counter()
+            self._emit(records)
+            if self.metrics is not None:
+                self.metrics.histogram('emit').record(perf_counter() - t0)
+
+    def _emit(self, records: list):
+        handler = self.handler_class
+        if handler.dispatcher is not None:
+            for stats in records:
+                handler.dispatcher.serve(stats)
+            return
+        for obs in handler.observers:
+            if getattr(obs, 'nonblocking', False) and not hasattr(obs, 'serve_batch_async'):
+                try:
+                    self.observer_errors += obs.serve_batch(records) or 0
+                except Exception as e:
+                    self.observer_errors += len(records)
+                    logging.error("Observer {} failed: {}".format(getattr(obs, 'name', obs), e))
+                continue
+            name = getattr(obs, 'name', str(obs))
+            if self._pending.get(name, 0) >= self.max_pending:
+                self.observer_dropped += len(records)
+                continue
+            if hasattr(obs, 'serve_batch_async'):
+                future = self._loop.create_task(obs.serve_batch_async(records))
+            else:
+                if name not in self._executors:
+                    self._executors[name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix='xrdrep-' + name)
+                future = self._loop.run_in_executor(self._executors[name], obs.serve_batch, records)
+            self._pending[name] = self._pending.get(name, 0) + 1
+            self._tasks.add(future)
+            future.add_done_callback(lambda f, name=name, n=len(records): self._served(f, name, n))
+
+    def _served(self, future, name: str, n: int):
+        self._tasks.discard(future)
+        self._pending[name] -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.observer_errors += n
+            logging.error("Observer {} failed: {}".format(name, future.exception()))
+        elif type(future.result()) is int:
+            self.observer_errors += future.result()
+
+    def shutdown(self):
+        """Stop the event loop and wait until it has finished"""
+        self._shutdown_requested = True
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._stop.set)
+            except RuntimeError:
+                # the loop has already finished
+                pass
+        self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+
+    def stats(self) -> dict:
+        stats = {'received': self.received,
+                 'batches': self.batches,
+                 'mean_batch': round(self.received / self.batches, 2) if self.batches else 0.,
+                 'processed': self.processed,
+                 'errors': self.errors,
+                 'observer_pending': sum(self._pending.values()),
+                 'observer_dropped': self.observer_dropped,
+                 'observer_errors': self.observer_errors,
+                 }
+        stats.update(udp_socket_stats(self.socket))
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
@@ -0,0 +1,431 @@
+"""Columnar archive of the processed records, and a tool to query it.
+
+An archive file (.xcol) holds chunks of records from a single source. In a chunk,
+every field is stored as one column, padded to 8 bytes:
+  * ints in the narrowest of int8/16/32/64 that holds them, floats as float64;
+  * strings (and anything else) as codes into a per-chunk dictionary;
+  * tod as the differences from the previous row, after the first value.
+A numeric column with missing rows also has a validity byte per row.
+The layout of each chunk (source, time range, offset and type of each column) is
+appended as a line of JSON to an index file next to it (.xcol.idx), written after
+the chunk itself, so the index never refers to data that is not there.
+Readers memory-map the archive and decode only the columns that are asked for,
+from the chunks whose source and time range match.
+Values are stored in the byte order of the writer, which is recorded in the file header.
+"""
+import argparse
+import csv
+import json
+import logging
+import mmap
+import os
+import re
+import sys
+import time
+from array import array
+from datetime import date
+from itertools import accumulate
+
+from xrdreporter.batching import BatchWriter
+from xrdreporter.observers import Observer
+from xrdreporter.spool import Spool
+from xrdreporter.xrdLabels import XrdKey
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'XCOL1'
+SUFFIX = '.xcol'
+INDEX_SUFFIX = '.idx'
+INT_TYPES = 'bhiq'
+TOD = 'tod'
+SRC = 'src'
+
+
+def _int_type(lo: int, hi: int) -> str:
+    """Narrowest array typecode that holds lo..hi, or None if beyond 64 bits"""
+    for t in INT_TYPES:
+        limit = 1 << (8 * array(t).itemsize - 1)
+        if -limit <= lo and hi < limit:
+            return t
+    return None
+
+
+def _pad(data: bytes) -> bytes:
+    return data + b'\0' * (-len(data) % 8)
+
+
+def encode_column(name: str, values: list):
+    """(column description, bytes) for one column of a chunk"""
+    present = [v for v in values if v is not None]
+    numeric = all(type(v) in (int, float, bool) for v in present)
+    if present and numeric and all(type(v) in (int, bool) for v in present):
+        ints = [0 if v is None else int(v) for v in values]
+        if name == TOD and len(present) == len(values):
+            # the first value, then the difference from the row before
+            deltas = [0] + [b - a for a, b in zip(ints, ints[1:])]
+            t = _int_type(min(deltas), max(deltas))
+            if t is not None:
+                return {'t': t, 'base': ints[0]}, array(t, deltas).tobytes()
+        t = _int_type(min(ints), max(ints))
+        if t is not None:
+            column, data = {'t': t}, array(t, ints).tobytes()
+        else:
+            # beyond 64 bits; keep as much as a float can
+            column, data = {'t': 'd'}, array('d', [float(v) for v in ints]).tobytes()
+    elif present and numeric:
+        column, data = {'t': 'd'}, array('d', [0. if v is None else float(v) for v in values]).tobytes()
+    else:
+        values = [v if v is None or type(v) is str else str(v) for v in values]
+        codes = {}
+        for v in values:
+            if v not in codes:
+                codes[v] = len(codes)
+        t = 'B' if len(codes) <= 1 << 8 else 'H' if len(codes) <= 1 << 16 else 'I'
+        return {'t': 's', 'c': t, 'dict': list(codes)}, array(t, [codes[v] for v in values]).tobytes()
+    if len(present) < len(values):
+        column['valid'] = len(_pad(data))
+        data = _pad(data) + bytes(v is not None for v in values)
+    return column, data
+
+
+def encode_chunk(records: list):
+    """(index entry without offset, bytes) for records from one source"""
+    keys = {}
+    for r in records:
+        for k in r:
+            keys[k] = None
+    columns = {}
+    parts = []
+    offset = 0
+    for k in keys:
+        column, data = encode_column(k, [r.get(k) for r in records])
+        column['o'] = offset
+        column['n'] = len(data)
+        columns[k] = column
+        data = _pad(data)
+        parts.append(data)
+        offset += len(data)
+    tods = [r[TOD] for r in records if type(r.get(TOD)) is int]
+    entry = {'src': records[0].get(SRC),
+             'tmin': min(tods, default=None),
+             'tmax': max(tods, default=None),
+             'rows': len(records),
+             'length': offset,
+             'columns': columns}
+    return entry, b''.join(parts)
+
+
+class ArchiveWriter:
+    """Append chunks to the archive file of the day, in directory, and to its index"""
+    def __init__(self, directory: str, prefix: str = 'xrdrep'):
+        self.directory = directory
+        self.prefix = prefix
+        os.makedirs(directory, exist_ok=True)
+        self._day = None
+        self._file = None
+        self._index = None
+        self.chunks = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def _open(self, day: str):
+        self.close()
+        path = os.path.join(self.directory, '{}-{}{}'.format(self.prefix, day, SUFFIX))
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(_pad(MAGIC + b' ' + sys.byteorder.encode('ascii') + b'\n'))
+        self._index = open(path + INDEX_SUFFIX, 'a')
+        self._day = day
+
+    def write(self, records: list, day: str):
+        """Write records, all from the same source, as one chunk; day (YYYYMMDD) chooses the file"""
+        if day != self._day:
+            self._open(day)
+        entry, data = encode_chunk(records)
+        entry['offset'] = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        self._index.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self._index.flush()
+        self.chunks += 1
+        self.rows += len(records)
+        self.bytes += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            self._file = None
+            self._index = None
+            self._day = None
+
+
+class ArchiveReader:
+    """Memory-mapped read access to one archive file"""
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = []
+        with open(path + INDEX_SUFFIX) as f:
+            for line in f:
+                try:
+                    self.entries.append(json.loads(line))
+                except ValueError:
+                    pass # a partial last line, from a writer that is still going or crashed
+        self._file = open(path, 'rb')
+        header = self._file.read(16)
+        if not header.startswith(MAGIC):
+            raise ValueError("{} is not an xrdreporter archive".format(path))
+        byteorder = header[len(MAGIC):].split()[0].decode('ascii')
+        self.swap = byteorder != sys.byteorder
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def chunks(self, start: int = None, end: int = None, src=None) -> list:
+        """Index entries of the chunks from sources matching src (a compiled regex) with rows in [start, end]"""
+        selected = []
+        for e in self.entries:
+            if e['offset'] + e['length'] > len(self._map):
+                continue
+            if src is not None and not src.search(str(e['src'])):
+                continue
+            if e['tmin'] is not None and ((end is not None and e['tmin'] > end) or
+                                          (start is not None and e['tmax'] < start)):
+                continue
+            selected.append(e)
+        return selected
+
+    def column(self, entry: dict, name: str):
+        """Values of one column of a chunk: a numpy array if numpy is installed (a view of the
+        mapped file, where possible), otherwise an array; strings and numeric columns with
+        missing values come back as lists, with None for the missing values"""
+        column = entry['columns'].get(name)
+        if column is None:
+            return [None] * entry['rows']
+        start = entry['offset'] + column['o']
+        t = column['t']
+        typecode = column['c'] if t == 's' else t
+        if numpy is not None and not self.swap:
+            values = numpy.frombuffer(self._map, dtype=typecode, count=entry['rows'], offset=start)
+        else:
+            values = array(typecode)
+            values.frombytes(self._map[start:start + entry['rows'] * values.itemsize])
+            if self.swap:
+                values.byteswap()
+        if t == 's':
+            dictionary = column['dict']
+            return [dictionary[c] for c in values.tolist()]
+        if 'base' in column:
+            if numpy is not None and not self.swap:
+                values = numpy.cumsum(values, dtype='q') + column['base']
+            else:
+                values = array('q', accumulate([column['base']] + values.tolist()[1:]))
+        if 'valid' in column:
+            valid = self._map[start + column['valid']:start + column['valid'] + entry['rows']]
+            return [v if ok else None for v, ok in zip(values.tolist(), valid)]
+        return values
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # numpy arrays still refer to the mapping; it is unmapped when they are gone
+            pass
+        self._map = None
+        self._file.close()
+
+
+def archive_files(paths: list) -> list:
+    """The archive files among paths, looking inside directories"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(SUFFIX))
+        else:
+            files.append(path)
+    return files
+
+
+def _to_numpy(values):
+    if hasattr(values, 'dtype'):
+        return values
+    if hasattr(values, 'typecode'):
+        return numpy.array(values, dtype=values.typecode)
+    if any(v is not None for v in values) and all(type(v) in (int, float) for v in values if v is not None):
+        return numpy.array([numpy.nan if v is None else v for v in values], dtype=float)
+    return numpy.array(values, dtype=object)
+
+
+def query(paths: list, fields: list, start: int = None, end: int = None, src: str = None,
+          as_numpy: bool = False) -> dict:
+    """Scan the archives for the rows with start <= tod <= end from sources matching the src regex.
+
+    Returns {field: values} for src, tod and the requested fields, only decoding those columns.
+    Values are lists, with None for missing values; with as_numpy, numeric columns are
+    numpy arrays (float, with nan for missing values, if any are missing) and the others object arrays.
+    """
+    if as_numpy and numpy is None:
+        raise ImportError("NumPy output needs the numpy package")
+    src = re.compile(src) if src else None
+    names = [SRC, TOD] + [f for f in fields if f not in (SRC, TOD)]
+    pieces = {k: [] for k in names}
+    for path in archive_files(paths):
+        reader = ArchiveReader(path)
+        try:
+            for entry in reader.chunks(start, end, src):
+                tod = list(reader.column(entry, TOD))
+                rows = [i for i, t in enumerate(tod) if t is not None and
+                        (start is None or t >= start) and (end is None or t <= end)]
+                if not rows:
+                    continue
+                for k in names:
+                    values = reader.column(entry, k)
+                    if as_numpy:
+                        values = _to_numpy(values)
+                        if len(rows) < entry['rows']:
+                            values = values[rows]
+                        elif values.base is not None:
+                            # do not keep the file mapped
+                            values = values.copy()
+                    else:
+                        values = values.tolist() if hasattr(values, 'tolist') else values
+                        if len(rows) < entry['rows']:
+                            values = [values[i] for i in rows]
+                    pieces[k].append(values)
+        finally:
+            reader.close()
+    if as_numpy:
+        return {k: numpy.concatenate(v) if v else numpy.array([]) for k, v in pieces.items()}
+    return {k: [x for values in v for x in values] for k, v in pieces.items()}
+
+
+def _fields(reader_paths: list) -> dict:
+    """All field names in the archives, with the number of chunks that have each"""
+    fields = {}
+    for path in archive_files(reader_paths):
+        reader = ArchiveReader(path)
+        for e in reader.entries:
+            for k in e['columns']:
+                fields[k] = fields.get(k, 0) + 1
+        reader.close()
+    return fields
+
+
+class ArchiveObserver(Observer):
+    """Write the records to a columnar archive, one file per day in directory.
+
+    Records are buffered per source, and a source's buffer is written as one chunk
+    when it has chunk_rows records, when its oldest record has waited max_age
+    seconds, or when more than max_buffered records are waiting in total.
+    The buffering and writing happen on the background thread of a BatchWriter.
+    Query the archive with python -m xrdreporter.archive.
+    """
+    nonblocking = True
+
+    def __init__(self, params):
+        super().__init__()
+        self.directory = params['directory']
+        self.prefix = params.get('prefix', 'xrdrep').replace('{pid}', str(os.getpid()))
+        self.chunk_rows = int(params.get('chunk_rows', 360))
+        self.max_age = float(params.get('max_age', 3600))
+        self.max_buffered = int(params.get('max_buffered', 200000))
+        self.archive = ArchiveWriter(self.directory, self.prefix)
+        # src -> (time the first record was buffered, records); only used by the writer thread
+        self._buffers = {}
+        self._buffered = 0
+        self._next_sweep = 0.
+        self.writer = BatchWriter(self._write_data, name=str(self),
+                                  batch_size=int(params.get('batch_size', 1000)),
+                                  flush_interval=float(params.get('flush_interval', 1.0)),
+                                  queue_size=int(params.get('queue_size', 100000)),
+                                  max_retries=int(params.get('max_retries', 1)),
+                                  retry_backoff=float(params.get('retry_backoff', 1.0)),
+                                  spool=Spool.from_params(params),
+                                  replay_rate=float(params.get('spool_replay_rate', 1000.)),
+                                  probe_interval=float(params.get('spool_probe_interval', 30.)),
+                                  max_probe_failures=int(params.get('spool_max_probe_failures', 0)))
+
+    def _write_chunk(self, src):
+        _, records = self._buffers.pop(src)
+        self._buffered -= len(records)
+        self.archive.write(records, date.today().strftime("%Y%m%d"))
+
+    def _write_data(self, records):
+        now = time.monotonic()
+        for r in records:
+            src = r.get(XrdKey.SRC)
+            buffer = self._buffers.get(src)
+            if buffer is None:
+                buffer = self._buffers[src] = (now, [])
+            buffer[1].append(r)
+            self._buffered += 1
+            if len(buffer[1]) >= self.chunk_rows:
+                self._write_chunk(src)
+        if self._buffered > self.max_buffered:
+            logging.warning("{}: {} records buffered; writing all sources".format(self, self._buffered))
+            for src in list(self._buffers):
+                self._write_chunk(src)
+        elif now >= self._next_sweep:
+            self._next_sweep = now + min(60., self.max_age / 10)
+            for src in [s for s, (t0, _) in self._buffers.items() if now - t0 >= self.max_age]:
+                self._write_chunk(src)
+
+    def serve(self, data: dict):
+        self.writer.put(data)
+
+    def close(self):
+        self.writer.close()
+        for src in list(self._buffers):
+            self._write_chunk(src)
+        self.archive.close()
+
+    def stats(self) -> dict:
+        return {'chunks': self.archive.chunks,
+                'rows': self.archive.rows,
+                'bytes': self.archive.bytes,
+                'buffered': self._buffered,
+                'sources_buffered': len(self._buffers),
+                }
+
+    def __str__(self):
+        return "Archive(\"{}\")".format(self.directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the columnar archives written by ArchiveObserver')
+    parser.add_argument('paths', nargs='+', help='archive files (.xcol), or directories of them')
+    parser.add_argument('-f', '--fields', default='', help='comma separated fields to return (src and tod always are)')
+    parser.add_argument('--start', type=int, default=None, help='earliest tod (unix time)')
+    parser.add_argument('--end', type=int, default=None, help='latest tod (unix time)')
+    parser.add_argument('--src', default=None, help='regular expression the source must match')
+    parser.add_argument('--npz', default=None, help='write the columns as NumPy arrays to this .npz file, instead of CSV')
+    parser.add_argument('--list', action='store_true', help='list the chunks and fields, instead of querying')
+    args = parser.parse_args()
+
+    if args.list:
+        for path in archive_files(args.paths):
+            reader = ArchiveReader(path)
+            rows = sum(e['rows'] for e in reader.entries)
+            sources = len({e['src'] for e in reader.entries})
+            print("{}: {} chunks, {} rows, {} sources, {} bytes".format(
+                  path, len(reader.entries), rows, sources, os.path.getsize(path)))
+            reader.close()
+        for k, n in sorted(_fields(args.paths).items()):
+            print("  {} ({} chunks)".format(k, n))
+        sys.exit(0)
+
+    fields = [x.strip() for x in args.fields.split(",") if len(x.strip())]
+    if args.npz and numpy is None:
+        parser.error("--npz needs the numpy package")
+    if args.npz:
+        result = query(args.paths, fields, args.start, args.end, args.src, as_numpy=True)
+        numpy.savez(args.npz, **result)
+        print("{} rows written to {}".format(len(result[TOD]), args.npz))
+        sys.exit(0)
+    result = query(args.paths, fields, args.start, args.end, args.src)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(list(result))
+    for row in zip(*result.values()):
+        writer.writerow(['' if v is None else v for v in row])
@@ -0,0 +1,294 @@
+import logging
+import queue
+import threading
+import time
+
+
+class PermanentWriteError(Exception):
+    """Raised by a write function when the sink rejected the batch in a way that retrying will
+    not fix, e.g. an HTTP 400 for a mapping or field type error"""
+
+
+class PartialWriteError(Exception):
+    """Raised by a write function when the sink took only part of a batch, e.g. a bulk
+    request with some items refused under load; items are the ones to write again"""
+    def __init__(self, message, items: list):
+        super().__init__(message)
+        self.items = items
+
+
+# 4xx statuses that are about the sink rather than the batch: authentication, a missing
+# index or bucket, timeouts and rate limiting; a later attempt may well succeed
+RETRYABLE_4XX = (401, 403, 404, 408, 429)
+
+
+def permanent_status(status) -> bool:
+    """Whether an HTTP status means the request itself is at fault, so sending it again would not help"""
+    return isinstance(status, int) and 400 <= status < 500 and status not in RETRYABLE_4XX
+
+
+class BatchWriter:
+    """Hand items to a write function in batches, from a background thread.
+
+    Items are put on a bounded queue without blocking the caller; if the queue is
+    full the item is dropped and counted, so a slow sink cannot stall ingest.
+    The background thread flushes whenever batch_size items are waiting, or
+    flush_interval seconds after the first item of a batch arrived.
+    A failed write is retried up to max_retries times with exponential backoff
+    before the batch is given up.
+    With a spool, a batch that is given up is appended to it instead, and the
+    sink is considered down: later batches go straight to the spool, and every
+    probe_interval seconds the oldest spooled batch is written as a probe. Once
+    that succeeds the spool is replayed in order, at most replay_rate items per
+    second, in between the new batches (which keep going to the spool until it
+    has been emptied, so the order of the writes is preserved).
+    A batch whose write raises PermanentWriteError is not retried, and does not
+    make the sink count as down: it is moved to the spool's dead letter file (or
+    dropped, without a spool) and counted as rejected, including when it comes up
+    during replay, so the rest of the spool can drain. With max_probe_failures,
+    the oldest spooled batch is also moved aside after failing that many probes
+    in a row, in case it is what keeps failing.
+    A write that raises PartialWriteError counts as written except for the items
+    it returns, and only those are retried (or spooled); during replay they go to
+    the end of the spool, and the sink is probed again after probe_interval.
+    Setting block makes put() wait for space instead of dropping, for when the
+    caller can be held back, e.g. when replaying a capture.
+    """
+    block = False
+
+    def __init__(self, write, name: str = 'writer', batch_size: int = 500,
+                 flush_interval: float = 1.0, queue_size: int = 10000,
+                 max_retries: int = 3, retry_backoff: float = 1.0, max_backoff: float = 30.,
+                 spool=None, replay_rate: float = 1000., probe_interval: float = 30.,
+                 max_probe_failures: int = 0):
+        self.write = write
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.probe_interval = probe_interval
+        self.max_probe_failures = max_probe_failures # 0 to keep probing with the same batch
+        self._probe_failures = 0
+        # the sink is down while there is anything in the spool; replay once it answers a probe
+        self._down = spool is not None and spool.peek() is not None
+        self._next_probe = 0.
+        self._tokens = 0.
+        self._last_refill = time.monotonic()
+
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.retries = 0
+        self.spooled = 0
+        self.rejected = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='xrdrep-{}'.format(name), daemon=True)
+        self._thread.start()
+
+    def put(self, item) -> bool:
+        """Queue one item for writing; returns False if it had to be dropped"""
+        try:
+            self.queue.put(item, block=self.block)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.queued += 1
+        return True
+
+    def _next_batch(self):
+        """Block until there is something to write, then collect up to a batch of it"""
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self):
+        """Collect whatever is still queued, without waiting"""
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            if self._down:
+                self._replay()
+        # write out anything left on shutdown
+        batch = self._drain()
+        while batch:
+            self._flush(batch)
+            batch = self._drain()
+        if self.spool is not None:
+            self.spool.close()
+
+    def _to_spool(self, batch: list):
+        try:
+            self.spool.append(batch)
+        except Exception as e:
+            logging.error("{}: failed to spool batch of {}: {}".format(self.name, len(batch), e))
+            with self._lock:
+                self.failed += len(batch)
+            return
+        with self._lock:
+            self.spooled += len(batch)
+
+    def _reject(self, batch: list, error, spooled: bool = False):
+        """Set aside a batch the sink will not take; spooled if it is the one last returned by spool.peek()"""
+        if self.spool is None:
+            logging.error("{}: sink rejected batch of {}, dropping it: {}".format(self.name, len(batch), error))
+        else:
+            logging.error("{}: sink rejected batch of {}, moving it to the dead letter file in {}: {}".format(
+                          self.name, len(batch), self.spool.directory, error))
+            try:
+                if spooled:
+                    self.spool.reject()
+                else:
+                    self.spool.dead_letter(batch)
+            except Exception as e:
+                logging.error("{}: failed to keep rejected batch: {}".format(self.name, e))
+        with self._lock:
+            self.rejected += len(batch)
+
+    def _replay(self):
+        """Probe the sink if it is due, and while it answers write spooled batches, within the replay rate"""
+        now = time.monotonic()
+        if now < self._next_probe:
+            return
+        self._tokens = min(self._tokens + (now - self._last_refill) * self.replay_rate,
+                           max(self.replay_rate, self.batch_size))
+        self._last_refill = now
+        while not self._stop.is_set():
+            batch = self.spool.peek()
+            if batch is None:
+                logging.info("{}: spool replayed, writing directly again".format(self.name))
+                self._down = False
+                return
+            if self._tokens < len(batch):
+                return
+            try:
+                self.write(batch)
+            except PermanentWriteError as e:
+                # the sink answered, so it is up; go on with the next batch
+                self._probe_failures = 0
+                self._reject(batch, e, spooled=True)
+                continue
+            except PartialWriteError as e:
+                # the sink is up but overloaded: keep what it refused, and give it time
+                self._probe_failures = 0
+                self.spool.commit()
+                with self._lock:
+                    self.written += len(batch) - len(e.items)
+                self._to_spool(e.items)
+                logging.warning("{}: sink took {} of {} items ({}), next probe in {:.0f}s".format(
+                                self.name, len(batch) - len(e.items), len(batch), e, self.probe_interval))
+                self._next_probe = time.monotonic() + self.probe_interval
+                return
+            except Exception as e:
+                self._probe_failures += 1
+                if self.max_probe_failures and self._probe_failures >= self.max_probe_failures:
+                    self._probe_failures = 0
+                    self._reject(batch, "failed {} probes in a row, last: {}".format(self.max_probe_failures, e),
+                                 spooled=True)
+                logging.warning("{}: sink still down ({}), next probe in {:.0f}s".format(
+                                self.name, e, self.probe_interval))
+                self._next_probe = time.monotonic() + self.probe_interval
+                return
+            self._probe_failures = 0
+            self.spool.commit()
+            self._tokens -= len(batch)
+            with self._lock:
+                self.written += len(batch)
+
+    def _flush(self, batch: list):
+        if self._down:
+            self._to_spool(batch)
+            return False
+        delay = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.write(batch)
+                with self._lock:
+                    self.written += len(batch)
+                return True
+            except PermanentWriteError as e:
+                self._reject(batch, e)
+                return False
+            except Exception as e:
+                if isinstance(e, PartialWriteError):
+                    # only what the sink refused is tried again
+                    with self._lock:
+                        self.written += len(batch) - len(e.items)
+                    batch = e.items
+                if attempt == self.max_retries:
+                    if self.spool is None:
+                        logging.error("{}: giving up on batch of {} after {} attempts: {}".format(
+                                      self.name, len(batch), attempt + 1, e))
+                    else:
+                        logging.error("{}: batch of {} failed after {} attempts: {}; spooling to {} "
+                                      "until the sink is back".format(
+                                      self.name, len(batch), attempt + 1, e, self.spool.directory))
+                    break
+                logging.warning("{}: write failed ({}), retrying in {:.1f}s".format(self.name, e, delay))
+                with self._lock:
+                    self.retries += 1
+                if self._stop.wait(delay):
+                    # shutting down; make one last attempt without further waiting
+                    delay = 0
+                delay = min(delay * 2, self.max_backoff)
+        if self.spool is not None:
+            self._to_spool(batch)
+            self._down = True
+            self._next_probe = time.monotonic() + self.probe_interval
+            return False
+        with self._lock:
+            self.failed += len(batch)
+        return False
+
+    def close(self, timeout: float = None):
+        """Stop the background thread, after flushing what is already queued"""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {'queued': self.queued,
+                     'written': self.written,
+                     'failed': self.failed,
+                     'dropped': self.dropped,
+                     'retries': self.retries,
+                     'rejected': self.rejected,
+                     'queue_depth': self.queue.qsize(),
+                     }
+            if self.spool is not None:
+                stats['spooled'] = self.spooled
+                stats['sink_down'] = self._down
+        if self.spool is not None:
+            stats['spool'] = self.spool.stats()
+        return stats
@@ -0,0 +1,78 @@
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+
+from xrdreporter.bench import blast, imports, micro
+from xrdreporter.bench.generator import PacketGenerator
+
+
+def report(results: list):
+    for r in results:
+        if 'error' in r:
+            print("{name:40s} failed: {error}".format(**r))
+        elif r['name'].startswith('import.'):
+            print("{:40s} {:10.2f} ms  {}".format(r['name'], 1e3 * r['seconds'], ", ".join(r['heavy_modules'])))
+        elif 'us_per_op' in r:
+            print("{name:40s} {us_per_op:10.2f} us/op {ops_per_s:12.0f} ops/s".format(**r))
+        else:
+            print("{name:40s} sent {sent} at {sent_per_s:.0f}/s, processed {processed} at {processed_per_s:.0f}/s, loss {loss:.2%}".format(**r))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the xrdreporter processing chain on synthetic xrd.report packets')
+    parser.add_argument('benchmarks', nargs='*', metavar='{micro,udp,imports}',
+                        help='micro (default): per-stage benchmarks; udp: end-to-end UDP blast against a local collector; '
+                             'imports: import time of the modules, in fresh interpreters')
+    parser.add_argument('-s', '--servers', type=int, default=100, help='number of simulated servers')
+    parser.add_argument('-n', '--packets', type=int, default=2000, help='packets per micro-benchmark')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per micro-benchmark; the best is reported')
+    parser.add_argument('--udp-packets', type=int, default=20000, help='packets to send in the UDP blast')
+    parser.add_argument('--rate', type=float, default=0., help='UDP send rate, packets/s (default: as fast as possible)')
+    parser.add_argument('--mode', action='append', default=None,
+                        help='[SERVER] mode(s) to blast, e.g. --mode threading --mode pool (default: all)')
+    parser.add_argument('--pool-size', type=int, default=4)
+    parser.add_argument('--rcvbuf', type=int, default=0, help='[SERVER] rcvbuf for the UDP blast, in bytes')
+    parser.add_argument('--max-import-ms', type=float, default=None,
+                        help='with imports, fail if importing the collector takes longer than this')
+    parser.add_argument('-o', '--output', default=None, help='also write the results as JSON to this file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    # checked here, as argparse rejects an empty list for nargs='*' with choices
+    benchmarks = args.benchmarks or ['micro']
+    for b in benchmarks:
+        if b not in ('micro', 'udp', 'imports'):
+            parser.error("unknown benchmark '{}'; choose from micro, udp, imports".format(b))
+    logging.basicConfig(level=logging.WARNING)
+
+    generator = PacketGenerator(n_servers=args.servers, seed=args.seed)
+    packets = generator.packets(args.packets)
+
+    results = []
+    if 'micro' in benchmarks:
+        results.extend(micro.run(packets, repeat=args.repeat))
+    if 'udp' in benchmarks:
+        for mode in args.mode or ['threading', 'pool', 'asyncio']:
+            results.append(blast.run(packets, n=args.udp_packets, rate=args.rate,
+                                     server_options={'mode': mode, 'pool_size': str(args.pool_size),
+                                                     'rcvbuf': str(args.rcvbuf)}))
+    problems = []
+    if 'imports' in benchmarks:
+        import_results = imports.run(repeat=args.repeat)
+        problems = imports.check(import_results, args.max_import_ms)
+        results.extend(import_results)
+    report(results)
+    for problem in problems:
+        print("REGRESSION: {}".format(problem))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'timestamp': int(time.time()),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'servers': args.servers,
+                       'seed': args.seed,
+                       'results': results}, f, indent=2)
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,87 @@
+import configparser
+import socket
+import threading
+import time
+
+from xrdreporter.observers import Observer
+from xrdreporter.requestHandlers import MyUDPRequestHandler
+
+
+class CountingObserver(Observer):
+    """Local sink that only counts what reaches it"""
+    nonblocking = True
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def serve(self, data: dict):
+        with self._lock:
+            self.count += 1
+
+    def serve_batch(self, data: list):
+        with self._lock:
+            self.count += len(data)
+
+
+def send(addr: tuple, packets: list, n: int, rate: float = 0.) -> float:
+    """Send n packets (cycling through packets) to addr, at rate packets/s or as fast as possible; returns the time taken"""
+    encoded = [p.encode('utf-8') for p in packets]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    t0 = time.perf_counter()
+    try:
+        for i in range(n):
+            if rate > 0:
+                wait = t0 + i / rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            sock.sendto(encoded[i % len(encoded)], addr)
+    finally:
+        sock.close()
+    return time.perf_counter() - t0
+
+
+def run(packets: list, n: int = 10000, rate: float = 0., server_options: dict = None,
+        deltas: bool = True, settle: float = 2.) -> dict:
+    """Start a collector on localhost, blast n packets at it over UDP and count how many reach the observer.
+
+    server_options are [SERVER] settings, e.g. {'mode': 'pool', 'pool_size': '4'}.
+    Note the handler class settings are changed for the duration of the run.
+    """
+    from xrdreporter.xrdrep import create_server
+
+    config = configparser.ConfigParser()
+    config['SERVER'] = dict(server_options or {})
+    config['SERVER'].setdefault('mode', 'threading')
+
+    observer = CountingObserver()
+    saved = MyUDPRequestHandler.observers, MyUDPRequestHandler.dispatcher, MyUDPRequestHandler.do_deltas
+    MyUDPRequestHandler.observers = [observer]
+    MyUDPRequestHandler.dispatcher = None
+    MyUDPRequestHandler.do_deltas = deltas
+    server = create_server(('127.0.0.1', 0), config['SERVER'])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        t0 = time.perf_counter()
+        elapsed = send(server.server_address, packets, n, rate)
+        # wait for processing to catch up, until nothing more arrives for a while
+        last, last_change = -1, time.perf_counter()
+        while time.perf_counter() - last_change < settle and observer.count < n:
+            if observer.count != last:
+                last, last_change = observer.count, time.perf_counter()
+            time.sleep(0.05)
+        processed_time = (time.perf_counter() if observer.count >= n else last_change) - t0
+    finally:
+        server.shutdown()
+        server.server_close()
+        MyUDPRequestHandler.observers, MyUDPRequestHandler.dispatcher, MyUDPRequestHandler.do_deltas = saved
+
+    return {'name': 'udp_blast.{}'.format(config['SERVER']['mode']),
+            'sent': n,
+            'processed': observer.count,
+            'loss': 1. - observer.count / n if n else 0.,
+            'send_seconds': elapsed,
+            'sent_per_s': n / elapsed if elapsed else 0.,
+            'processed_per_s': observer.count / processed_time if processed_time else 0.,
+            }
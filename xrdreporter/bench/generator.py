@@ -0,0 +1,120 @@
+import random
+import re
+import time
+
+from xrdreporter.xrdLabels import name_mappings
+
+# fields sent as attributes of the <statistics> element
+ROOT_FIELDS = ('tod', 'ver', 'src', 'tos', 'pgm', 'ins', 'pid', 'site')
+STRING_FIELDS = ('info.host', 'info.name', 'ofs.role')
+# fields that go up and down; everything else numeric is a monotonically increasing counter
+GAUGE_FIELDS = {'info.port', 'buff.reqs', 'buff.mem', 'buff.buffs', 'buff.adj', 'buff.xlreqs', 'buff.xlmem', 'buff.xlbuffs',
+                'link.num', 'link.maxn', 'poll.att', 'xrootd.num', 'xrootd.aio.max',
+                'ofs.opp', 'ofs.han', 'ofs.bxq', 'oss.paths', 'oss.space',
+                'sched.inq', 'sched.maxinq', 'sched.threads', 'sched.idle',
+                'sgen.as', 'sgen.et', 'sgen.toe', 'ssi.req.maxsz', 'ssi.req.bnd'}
+
+HOST_PATTERNS = ('ceph-gw{}.example.org', 'ceph-dev-gw{}.example.org', 'lcg{}.example.org',
+                 'host-{}.nubes.example.org', 'eos{}.example.org', 'cta{}.example.org', 'node{}.example.org')
+PROGRAMS = (('xrootd', 'anon'), ('xrootd', 'proxy'), ('xrootd', 'cache'), ('cmsd', 'anon'))
+
+
+def field_catalogue():
+    """The xrd.report fields from xrdLabels.name_mappings, as a nested dict of <stats> id -> child -> grandchild"""
+    tree = {}
+    for line in name_mappings:
+        name = re.search('\"(.*?)\"', line)[1]
+        if name in ROOT_FIELDS:
+            continue
+        node = tree
+        parts = name.split('.')
+        for p in parts[:-1]:
+            node = node.setdefault(p, {})
+        node[parts[-1]] = name
+    return tree
+
+
+class SimulatedServer:
+    """State of one simulated xrootd server: its identity, and counters that only ever increase"""
+    def __init__(self, n: int, rng: random.Random, start: int):
+        pgm, ins = PROGRAMS[n % len(PROGRAMS)]
+        host = HOST_PATTERNS[n % len(HOST_PATTERNS)].format(n)
+        port = 1094 + (n % 3)
+        self.rng = rng
+        self.attrs = {'ver': 'v5.5.{}'.format(n % 4), 'src': '{}:{}'.format(host, port),
+                      'tos': start - rng.randint(3600, 86400 * 30), 'pgm': pgm, 'ins': ins,
+                      'pid': rng.randint(1000, 60000), 'site': 'EXAMPLE'}
+        self.strings = {'info.host': host, 'info.name': 'ceph' if port == 1094 else ins,
+                        'ofs.role': 'server' if pgm == 'xrootd' else 'manager'}
+        self.port = port
+        self.counters = {}
+        # some servers are much busier than others
+        self.rate = rng.choice((1, 10, 100, 1000))
+
+    def value(self, field: str):
+        if field in self.strings:
+            return self.strings[field]
+        if field == 'info.port':
+            return self.port
+        if field in GAUGE_FIELDS:
+            return self.rng.randint(0, 100)
+        if field == 'link.out':
+            # the odd floating point value
+            v = self.counters.get(field, 0.) + self.rng.random() * self.rate
+            self.counters[field] = v
+            return round(v, 3)
+        v = self.counters.get(field, 0) + self.rng.randint(0, self.rate)
+        self.counters[field] = v
+        return v
+
+
+class PacketGenerator:
+    """Generate realistic xrd.report packets for n_servers simulated servers.
+
+    Every field of the xrdLabels catalogue is included; each server has its own
+    pgm/ins/info.host, and its counters increase monotonically from packet to packet.
+    Servers report in turn, with 'tod' advancing by interval for every round.
+    """
+    def __init__(self, n_servers: int = 10, seed: int = 0, interval: int = 10, start: int = None):
+        self.rng = random.Random(seed)
+        self.interval = interval
+        self.tod = int(time.time()) if start is None else start
+        self.catalogue = field_catalogue()
+        self.servers = [SimulatedServer(i, self.rng, self.tod) for i in range(n_servers)]
+        self._next = 0
+
+    def _xml(self, server: SimulatedServer) -> str:
+        attrs = dict(server.attrs)
+        parts = ['<statistics tod="{}" ver="{ver}" src="{src}" tos="{tos}" pgm="{pgm}" ins="{ins}" pid="{pid}" site="{site}">'
+                 .format(self.tod, **attrs)]
+        for stats_id, children in self.catalogue.items():
+            parts.append('<stats id="{}">'.format(stats_id))
+            for child, node in children.items():
+                if isinstance(node, dict):
+                    parts.append('<{}>'.format(child))
+                    for grandchild, field in node.items():
+                        parts.append('<{0}>{1}</{0}>'.format(grandchild, server.value(field)))
+                    parts.append('</{}>'.format(child))
+                else:
+                    value = self.tod if node == 'sgen.toe' else server.value(node)
+                    parts.append('<{0}>{1}</{0}>'.format(child, value))
+            parts.append('</stats>')
+        parts.append('</statistics>')
+        return ''.join(parts)
+
+    def packet(self) -> str:
+        """The next packet, from the next server in turn"""
+        server = self.servers[self._next]
+        packet = self._xml(server)
+        self._next += 1
+        if self._next == len(self.servers):
+            self._next = 0
+            self.tod += self.interval
+        return packet
+
+    def packets(self, n: int) -> list:
+        return [self.packet() for _ in range(n)]
+
+    def __iter__(self):
+        while True:
+            yield self.packet()
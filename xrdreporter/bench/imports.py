@@ -0,0 +1,59 @@
+import json
+import subprocess
+import sys
+
+MODULES = ['xrdreporter.observers', 'xrdreporter.xrdrep', 'xrdreporter.archive', 'xrdreporter.ringbuffer',
+           'xrdreporter.prometheus', 'xrdreporter.elastic', 'xrdreporter.influx']
+# libraries that only the observers (or server modes) that need them should load
+HEAVY = ['requests', 'urllib3', 'influxdb_client', 'influxdb', 'http.server', 'asyncio', 'numpy']
+# importing these must not load any of HEAVY
+LIGHT = ['xrdreporter.observers', 'xrdreporter.xrdrep']
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{'seconds': elapsed, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module: str, repeat: int = 5) -> dict:
+    """Best of repeat imports of module, each in a fresh interpreter"""
+    best = None
+    heavy = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY)],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'exit code {}'.format(proc.returncode)
+            return {'name': 'import.{}'.format(module), 'error': error}
+        result = json.loads(proc.stdout)
+        if best is None or result['seconds'] < best:
+            best = result['seconds']
+        heavy = result['heavy']
+    return {'name': 'import.{}'.format(module),
+            'n': 1,
+            'seconds': best,
+            'ops_per_s': 1 / best if best else 0.,
+            'us_per_op': 1e6 * best,
+            'heavy_modules': heavy,
+            }
+
+
+def run(repeat: int = 5) -> list:
+    return [measure(module, repeat) for module in MODULES]
+
+
+def check(results: list, max_ms: float = None) -> list:
+    """Regressions in the results: light modules loading heavy libraries, or imports slower than max_ms"""
+    problems = []
+    for r in results:
+        module = r['name'][len('import.'):]
+        if module in LIGHT and r.get('heavy_modules'):
+            problems.append("{} loads {}".format(module, ", ".join(r['heavy_modules'])))
+        if module in LIGHT and 'error' in r:
+            problems.append("{} fails to import: {}".format(module, r['error']))
+        if max_ms is not None and module in LIGHT and 'seconds' in r and 1e3 * r['seconds'] > max_ms:
+            problems.append("{} takes {:.1f} ms to import (limit {} ms)".format(module, 1e3 * r['seconds'], max_ms))
+    return problems
@@ -0,0 +1,143 @@
+import logging
+import time
+from socket import getfqdn
+
+from xrdreporter.deltas import DeltaStore
+from xrdreporter.enrich import Enricher
+from xrdreporter.filters import FieldFilter
+from xrdreporter.registry import observer_class
+from xrdreporter.requestHandlers import augment_raltier1, parse_dom
+from xrdreporter.templates import TemplateCache
+from xrdreporter.xmlparse import parse_expat
+
+
+class StubWriter:
+    """Stands in for an observer's BatchWriter, so only the serialization path is measured"""
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+        return True
+
+    def close(self, timeout: float = None):
+        pass
+
+    def stats(self) -> dict:
+        return {'queued': len(self.items)}
+
+
+def timed(name: str, fn, items, repeat: int = 3) -> dict:
+    """Best of repeat runs of fn over every item"""
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for x in items:
+            fn(x)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    n = len(items)
+    return {'name': name,
+            'n': n,
+            'seconds': best,
+            'ops_per_s': n / best if best else 0.,
+            'us_per_op': 1e6 * best / n if n else 0.,
+            }
+
+
+def legacy_influx_line(measurement: str, tags: list, excluded: list, data: dict) -> str:
+    """Line-protocol assembly as InfluxDB2Observer did it before LineProtocol (unescaped, getfqdn() per record), as a baseline"""
+    tag_values = {k: f'{data[k]}' for k in tags if k in data}
+    tag_values['reporthost'] = getfqdn()
+    fields = {}
+    for k, v in data.items():
+        if k in excluded:
+            continue
+        fields[k] = f'\"{v}\"' if type(v) == str else v
+    v = "{},".format(measurement)
+    v += ','.join("{}={}".format(k, v) for k, v in tag_values.items())
+    v += " "
+    v += ','.join("{}={}".format(k, v) for k, v in fields.items())
+    v += ' {}'.format(int(data['tod'] * 1e9))
+    return v
+
+
+def stub_observers():
+    """Observers whose output goes to a StubWriter instead of a real sink;
+    those whose client library is not installed are left out"""
+    configs = {
+        'influxdb': ('InfluxDB2Observer', {'measurement': 'xrdreport', 'bucket': 'bench', 'org': 'bench',
+                                           'url': 'http://localhost:8086', 'token': 'bench'}),
+        'elasticsearch': ('ElasticSearchObserver', {'hosts': 'http://localhost:9200'}),
+        'file': ('FileObserver', {'filename': '/dev/null'}),
+    }
+    observers = {}
+    for name, (class_name, params) in configs.items():
+        try:
+            ObserverClass = observer_class(class_name)
+        except ImportError as e:
+            logging.warning("Skipping the {} observer benchmarks: {}".format(name, e))
+            continue
+        obs = ObserverClass(params)
+        obs.writer.close()
+        obs.writer = StubWriter()
+        observers[name] = obs
+    return observers
+
+
+def observer_benchmarks(records: list, repeat: int = 3) -> list:
+    """Time each observer's serve() into a stub sink, and its batch encoding where it has one"""
+    from xrdreporter.observers import json_line
+    results = []
+    observers = stub_observers()
+    for name, obs in observers.items():
+        results.append(timed('observer.{}.serve'.format(name), obs.serve, records, repeat))
+    if 'elasticsearch' in observers:
+        es = observers['elasticsearch']
+        docs = es.writer.items[:len(records)]
+        results.append(timed('observer.elasticsearch.bulk_body', lambda d: es._bulk_body([d]), docs, repeat))
+    results.append(timed('observer.file.json_line', json_line, records, repeat))
+    if 'influxdb' in observers:
+        influx = observers['influxdb']
+        results.append(timed('observer.influxdb.legacy_line',
+                             lambda d: legacy_influx_line(influx.measurement, influx.tags, influx.excluded, d), records, repeat))
+        results.append(timed('observer.influxdb.line',
+                             lambda d: influx.serializer.line(d, d['tod'] * 1000000000), records, repeat))
+    from xrdreporter.observers import TAG_KEYS
+    from xrdreporter.prometheus import Exposition
+    exposition = Exposition(TAG_KEYS)
+    results.append(timed('observer.prometheus.update', exposition.update, records, repeat))
+    # a scrape re-renders the page after any update
+    results.append(timed('observer.prometheus.update_and_scrape',
+                         lambda d: exposition.update(d) or exposition.render(), records[:20], repeat))
+    for obs in observers.values():
+        obs.close()
+    return results
+
+
+def run(packets: list, repeat: int = 3) -> list:
+    """Micro-benchmarks of each processing stage over the given packets"""
+    results = [timed('parse_dom', parse_dom, packets, repeat),
+               timed('parse_expat', parse_expat, packets, repeat)]
+    template_cache = TemplateCache()
+    for p in packets:
+        template_cache.parse(p)
+    results.append(timed('parse_template', template_cache.parse, packets, repeat))
+
+    parsed = [parse_expat(p) for p in packets]
+    field_filter = FieldFilter('.*', 'buff.*,ssi.*')
+    results.append(timed('filter_stats', field_filter.filter, parsed, repeat))
+    filtered = [field_filter.filter(s) for s in parsed]
+
+    results.append(timed('augment_raltier1', augment_raltier1, filtered, repeat))
+    enricher = Enricher()
+    # enrichment is in place, and gives the same result when repeated
+    results.append(timed('enrich', enricher.enrich, [dict(s) for s in filtered], repeat))
+    augmented = [enricher.enrich(dict(s)) for s in filtered]
+
+    delta_store = DeltaStore()
+    results.append(timed('deltas', delta_store.calculate, augmented, repeat))
+
+    records = [delta_store.calculate(s) for s in augmented]
+    results.extend(observer_benchmarks(records, repeat))
+    return results
@@ -0,0 +1,130 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Segment files start with MAGIC, followed by records of:
+#   RECORD header: receive time (unix seconds, double), source port, length of the
+#   source host, length of the datagram; then the host (ascii) and the datagram bytes
+MAGIC = b'XRDCAP1\n'
+RECORD = struct.Struct('<dHHI')
+
+
+class CaptureWriter:
+    """Append raw datagrams, with their receive time and source address, to segment files.
+
+    Segments are named <prefix>-<start time>.xrdcap in directory, and a new one is
+    started once segment_size bytes have been written. Writes are buffered, and
+    flushed every flush_interval seconds from a background thread, so the
+    datagrams of a quiet collector do not sit in the buffer.
+    """
+    def __init__(self, directory: str, prefix: str = 'xrdreport', segment_size: int = 64 << 20,
+                 flush_interval: float = 1.):
+        self.directory = directory
+        self.prefix = prefix
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self.captured = 0
+        self.segments = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='xrdrep-capture', daemon=True)
+        self._thread.start()
+
+    def _open(self, now: float):
+        name = '{}-{}.xrdcap'.format(self.prefix, time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)))
+        path = os.path.join(self.directory, name)
+        n = 0
+        while os.path.exists(path):
+            n += 1
+            path = os.path.join(self.directory, '{}-{}.xrdcap'.format(name[:-len('.xrdcap')], n))
+        self._file = open(path, 'wb', buffering=1 << 20)
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        self.segments += 1
+        logging.info("Capturing datagrams to {}".format(path))
+
+    def write(self, packet: bytes, client_address, received: float = None):
+        now = time.time() if received is None else received
+        host = client_address[0].encode('ascii')
+        record = RECORD.pack(now, client_address[1], len(host), len(packet)) + host + packet
+        with self._lock:
+            if self._file is None:
+                self._open(now)
+            self._file.write(record)
+            self._size += len(record)
+            self.captured += 1
+            if self._size >= self.segment_size:
+                self._file.close()
+                self._file = None
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                if self._file is not None:
+                    self._file.flush()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self) -> dict:
+        return {'captured': self.captured, 'segments': self.segments}
+
+
+def read_segment(path: str):
+    """Yield (receive time, (host, port), datagram) from a segment file, which is memory-mapped rather than read"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC:
+                raise ValueError("{} is not a capture segment".format(path))
+            pos = len(MAGIC)
+            end = len(m)
+            while pos + RECORD.size <= end:
+                received, port, host_len, packet_len = RECORD.unpack_from(m, pos)
+                pos += RECORD.size
+                if pos + host_len + packet_len > end:
+                    logging.warning("Truncated record at the end of {}".format(path))
+                    break
+                host = m[pos:pos + host_len].decode('ascii')
+                pos += host_len
+                packet = m[pos:pos + packet_len]
+                pos += packet_len
+                yield received, (host, port), packet
+
+
+def replay(paths, process, speed: float = 0.):
+    """Pass the datagrams from the segment files, in order, to process(packet, client_address).
+
+    speed 0 replays as fast as possible; otherwise the original spacing between
+    datagrams is kept, sped up by this factor. Returns the number of datagrams replayed.
+    """
+    n = 0
+    start_wall = time.monotonic()
+    first = None
+    for path in paths:
+        logging.info("Replaying {}".format(path))
+        for received, client_address, packet in read_segment(path):
+            if speed > 0:
+                if first is None:
+                    first = received
+                wait = (received - first) / speed - (time.monotonic() - start_wall)
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                process(packet, client_address)
+            except Exception as e:
+                logging.error("Error replaying datagram from {}: {}".format(client_address, e))
+            n += 1
+    return n
@@ -0,0 +1,124 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+from xrdreporter.xrdLabels import XrdKey
+
+# fields that identify a record (and are tags in InfluxDB), so are never suppressed
+DEFAULT_ALWAYS = ', '.join([XrdKey.SRC, XrdKey.TOD, XrdKey.PGM, XrdKey.INS, XrdKey.SITE, XrdKey.VER,
+                            XrdKey.INFO_HOST, XrdKey.INFO_PORT, XrdKey.INFO_NAME, XrdKey.OFS_ROLE, 'host_type'])
+
+
+class ChangeFilter:
+    """Pass on only the fields whose value changed since the source last reported them.
+
+    Every heartbeat seconds (per source), and whenever a source's set of keys
+    changes, the full record is passed on, so a field is never suppressed for
+    longer than that. Fields named in always are never suppressed.
+    The previous values of a source are kept as a tuple, alongside a key tuple
+    shared by all the sources with the same layout. Sources are spread over
+    shards, each with its own lock and LRU order, and sources not seen for ttl
+    seconds, or beyond max_sources, are evicted.
+    """
+    max_schemas = 256
+
+    def __init__(self, heartbeat: float = 300., always: str = DEFAULT_ALWAYS, ttl: float = 3600.,
+                 max_sources: int = 10000, shards: int = 16):
+        self.heartbeat = heartbeat
+        self.always = frozenset(x.strip() for x in always.split(",") if len(x.strip()))
+        self.ttl = ttl
+        self.n_shards = shards
+        self.max_per_shard = max(1, max_sources // shards)
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        # key tuple -> (the shared key tuple, which of its keys are always passed on)
+        self._schemas = {}
+        self._schema_lock = threading.Lock()
+        self._counts_lock = threading.Lock()
+        self.fields_in = 0
+        self.fields_out = 0
+        self.full = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_config(cls, section):
+        """Create from a [CHANGES] config section"""
+        return cls(heartbeat=section.getfloat('heartbeat', 300.),
+                   always=section.get('always', DEFAULT_ALWAYS),
+                   ttl=section.getfloat('ttl', 3600.),
+                   max_sources=section.getint('max_sources', 10000),
+                   shards=section.getint('shards', 16))
+
+    def _schema(self, keys: tuple) -> tuple:
+        schema = self._schemas.get(keys)
+        if schema is None:
+            schema = (keys, tuple(k in self.always for k in keys))
+            with self._schema_lock:
+                if len(self._schemas) >= self.max_schemas:
+                    self._schemas.clear()
+                self._schemas[keys] = schema
+        return schema
+
+    def _evict(self, shard: OrderedDict, now: float):
+        """Remove the least recently seen sources that are idle, or over capacity; the shard lock must be held"""
+        while shard:
+            src, entry = next(iter(shard.items()))
+            if len(shard) > self.max_per_shard or now - entry[3] > self.ttl:
+                del shard[src]
+                self.evicted += 1
+            else:
+                break
+
+    def filter(self, stats: dict) -> dict:
+        """Return stats with the unchanged fields removed, and remember its values for the next time"""
+        src = stats.get(XrdKey.SRC)
+        schema = self._schema(tuple(stats))
+        keys, always = schema
+        values = tuple(stats.values())
+        now = time.monotonic()
+
+        n = hash(src) % self.n_shards
+        shard = self._shards[n]
+        with self._locks[n]:
+            last = shard.pop(src, None)
+            if (last is None or last[0] is not schema or now - last[2] >= self.heartbeat
+                    or now - last[3] > self.ttl):
+                # pass on everything, and start a new heartbeat interval
+                shard[src] = (schema, values, now, now)
+                last = None
+            else:
+                shard[src] = (schema, values, last[2], now)
+            self._evict(shard, now)
+
+        if last is None:
+            out = stats
+            with self._counts_lock:
+                self.full += 1
+                self.fields_in += len(keys)
+                self.fields_out += len(keys)
+            return out
+        previous = last[1]
+        out = {k: v for k, v, p, a in zip(keys, values, previous, always) if a or v != p}
+        with self._counts_lock:
+            self.fields_in += len(keys)
+            self.fields_out += len(out)
+        return out
+
+    def __len__(self):
+        return sum(len(s) for s in self._shards)
+
+    def stats(self) -> dict:
+        with self._counts_lock:
+            fields_in, fields_out = self.fields_in, self.fields_out
+        return {'sources': len(self),
+                'fields_in': fields_in,
+                'fields_out': fields_out,
+                'suppressed_ratio': round(1. - fields_out / fields_in, 4) if fields_in else 0.,
+                'full_records': self.full,
+                'evicted': self.evicted,
+                }
+
+    def __str__(self):
+        return "ChangeFilter(heartbeat={}, always={}, ttl={}, max_sources={})".format(
+               self.heartbeat, ",".join(sorted(self.always)), self.ttl, self.max_per_shard * self.n_shards)
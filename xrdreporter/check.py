@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
-import os
+import argparse
+import json
 import socket
 import sys
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 # check that a "pong" is return from a "ping" to the server
 
@@ -12,35 +16,203 @@ class Response(Enum):
     TIMEOUT=1
     FAILURE=2
 
-def send_ping(addr: tuple):
-    #Create a UDP socket
+def ping(addr: tuple, timeout: float = 1.):
+    """Send one ping; returns (Response, round-trip time in seconds or None)"""
+    # a new socket for every ping, so a late pong cannot be taken for the answer to the next one
+    sock = socket.socket(socket.AF_INET6 if ':' in addr[0] else socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    try:
+        t0 = time.perf_counter()
+        sock.sendto('ping'.encode('utf-8'), addr)
+        data, server = sock.recvfrom(1024)
+        rtt = time.perf_counter() - t0
+    except socket.timeout:
+        return Response.TIMEOUT, None
+    except OSError:
+        # e.g. ICMP port unreachable, or the host does not resolve
+        return Response.FAILURE, None
+    finally:
+        sock.close()
+    if data.strip() != 'pong'.encode('utf-8'):
+        return Response.FAILURE, None
+    return Response.OK, rtt
+
+def send_ping(addr: tuple, timeout: float = 1.):
+    response, _ = ping(addr, timeout)
+    if response == Response.TIMEOUT:
+        print('Failed to ping')
+    elif response == Response.FAILURE:
+        print("missmatch message")
+    return response
+
+def get_stats(addr: tuple):
+    """Ask the server for its self-metrics; returns the decoded dict, or None on timeout"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    #Set a timeout value of 1 second
     sock.settimeout(1)
-    message = 'ping'.encode('utf-8')
-    response_check = 'pong'.encode('utf-8')
+    try:
+        sock.sendto('stats'.encode('utf-8'), addr)
+        data, server = sock.recvfrom(65535)
+    except socket.timeout:
+        print('Failed to get stats')
+        return None
+    finally:
+        sock.close()
+    return json.loads(data.decode('utf-8'))
 
-    sock.sendto(message, addr)
+def send_reload(addr: tuple, timeout: float = 1.):
+    """Ask the server to re-read its config files; it answers before the reload is done"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
     try:
+        sock.sendto('reload'.encode('utf-8'), addr)
         data, server = sock.recvfrom(1024)
-    #If data is not received back from server, print it has timed out  
     except socket.timeout:
-        print('Failed to ping')
+        print('Failed to request a reload')
         return Response.TIMEOUT
-
-    if data.strip() != response_check:
-        print("missmatch message")
+    finally:
+        sock.close()
+    if data != b'reloading':
+        print(data.decode('utf-8'))
         return Response.FAILURE
-    sock.close()
-
     return Response.OK
 
 
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile (q in 0-1) of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(q * len(values) + 0.5) - 1))]
+
+def probe(addr: tuple, count: int = 10, interval: float = 0.1, timeout: float = 1.) -> dict:
+    """Send count pings to addr, interval seconds apart, and summarize the round-trip times (in ms) and loss"""
+    rtts = []
+    failures = 0
+    start = time.perf_counter()
+    for i in range(count):
+        wait = start + i * interval - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        response, rtt = ping(addr, timeout)
+        if response == Response.OK:
+            rtts.append(1e3 * rtt)
+        elif response == Response.FAILURE:
+            failures += 1
+    rtts.sort()
+    return {'target': '{}:{}'.format(*addr),
+            'sent': count,
+            'received': len(rtts),
+            'failures': failures,
+            'loss': 1. - len(rtts) / count if count else 0.,
+            'p50_ms': percentile(rtts, 0.5),
+            'p95_ms': percentile(rtts, 0.95),
+            'p99_ms': percentile(rtts, 0.99),
+            'max_ms': rtts[-1] if rtts else None,
+            }
+
+def probe_all(addrs: list, count: int = 10, interval: float = 0.1, timeout: float = 1.,
+              concurrency: int = 32) -> list:
+    """Probe all the targets at the same time (up to concurrency at once); results in the order of addrs"""
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(addrs)))) as pool:
+        return list(pool.map(lambda addr: probe(addr, count, interval, timeout), addrs))
+
+def load(addrs: list, rate: float, duration: float, servers: int = 100) -> list:
+    """Start sending synthetic xrd.report packets to each target at rate packets/s for duration seconds,
+    from a background thread per target; returns the threads"""
+    # only needed in load mode, and pulls in the rest of the package
+    from xrdreporter.bench.blast import send
+    from xrdreporter.bench.generator import PacketGenerator
+
+    packets = PacketGenerator(n_servers=servers).packets(max(servers, 100))
+    threads = []
+    for addr in addrs:
+        t = threading.Thread(target=send, args=(addr, packets, int(rate * duration), rate),
+                             name='xrdrep-load', daemon=True)
+        t.start()
+        threads.append(t)
+    return threads
+
+def parse_target(target: str, default_port: int) -> tuple:
+    """host, host:port or [v6 address]:port"""
+    if target.startswith('['):
+        host, _, port = target[1:].partition(']')
+        port = port.lstrip(':')
+    elif target.count(':') == 1:
+        host, port = target.split(':')
+    else:
+        host, port = target, ''
+    return host, int(port) if port else default_port
+
+def probe_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(prog='check.py probe',
+                                     description='Ping collectors concurrently and report round-trip latency and loss')
+    parser.add_argument('targets', nargs='+', help='host, host:port or [v6 address]:port')
+    parser.add_argument('-p', '--port', type=int, default=None, help='port for targets given without one')
+    parser.add_argument('-c', '--count', type=int, default=20, help='pings per target')
+    parser.add_argument('-i', '--interval', type=float, default=0.1, help='seconds between the pings to a target')
+    parser.add_argument('-t', '--timeout', type=float, default=1., help='seconds to wait for each pong')
+    parser.add_argument('--concurrency', type=int, default=32, help='targets probed at the same time')
+    parser.add_argument('--load-rate', type=float, default=0.,
+                        help='also send this many synthetic xrd.report packets/s to each target while probing. '
+                             'They are processed like real reports, so only use this against test collectors')
+    parser.add_argument('--load-servers', type=int, default=100, help='simulated servers in the load')
+    parser.add_argument('--max-loss', type=float, default=0., help='fail if the loss of any target is above this (0-1)')
+    parser.add_argument('--max-p99', type=float, default=None, help='fail if the p99 of any target is above this, in ms')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    addrs = [parse_target(t, args.port) for t in args.targets]
+    for target, addr in zip(args.targets, addrs):
+        if addr[1] is None:
+            parser.error("no port for {}; give it as host:port or use --port".format(target))
+    if args.load_rate > 0:
+        # start the load a little before the pings, and keep it up until they are done
+        duration = args.count * args.interval + args.timeout + 1.
+        load(addrs, args.load_rate, duration, args.load_servers)
+        time.sleep(0.5)
+    results = probe_all(addrs, args.count, args.interval, args.timeout, args.concurrency)
+
+    status = Response.OK
+    for r in results:
+        r['load_rate'] = args.load_rate
+        if r['received'] == 0:
+            r['status'] = Response.TIMEOUT.name if r['failures'] == 0 else Response.FAILURE.name
+        elif r['loss'] > args.max_loss or (args.max_p99 is not None and r['p99_ms'] > args.max_p99):
+            r['status'] = Response.FAILURE.name
+        else:
+            r['status'] = Response.OK.name
+        if Response[r['status']].value > status.value:
+            status = Response[r['status']]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            if r['received']:
+                print("{target:30s} {status:8s} {received}/{sent} loss {loss:.1%} "
+                      "p50 {p50_ms:.2f} p95 {p95_ms:.2f} p99 {p99_ms:.2f} max {max_ms:.2f} ms".format(**r))
+            else:
+                print("{target:30s} {status:8s} 0/{sent} loss {loss:.1%}".format(**r))
+    return status.value
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'probe':
+        sys.exit(probe_main(sys.argv[2:]))
+
     host = sys.argv[1]
     port = int(sys.argv[2])
 
     addr = (host, port)
 
+    if len(sys.argv) > 3 and sys.argv[3] == 'stats':
+        stats = get_stats(addr)
+        if stats is None:
+            sys.exit(Response.TIMEOUT.value)
+        print(json.dumps(stats, indent=2))
+        sys.exit(Response.OK.value)
+
+    if len(sys.argv) > 3 and sys.argv[3] == 'reload':
+        sys.exit(send_reload(addr).value)
+
     reponse = send_ping(addr)
     sys.exit(reponse.value)
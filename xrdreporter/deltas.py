@@ -0,0 +1,152 @@
+import logging
+import re
+import threading
+import time
+
+from array import array
+from collections import OrderedDict
+
+from xrdreporter.filters import split_patterns
+from xrdreporter.xrdLabels import XrdKey
+
+
+class Schema:
+    """Ordered numeric keys of a packet layout, shared by all the sources sending that layout"""
+    __slots__ = ('keys', 'index', 'delta_keys', 'counter')
+
+    def __init__(self, keys: tuple, re_counters=None):
+        self.keys = keys
+        self.index = {k: i for i, k in enumerate(keys)}
+        self.delta_keys = tuple(f'delta_{k}' for k in keys)
+        # which fields are monotonic counters; without a counter list every field gets a delta
+        if re_counters is None:
+            self.counter = (True,) * len(keys)
+        else:
+            self.counter = tuple(re_counters.match(k) is not None for k in keys)
+
+
+class DeltaStore:
+    """Previous values per source ('src'), used to calculate the delta_* rates.
+
+    Only the numeric fields are kept, as an array of doubles alongside a Schema
+    that is shared between sources with the same layout.
+    Sources are spread over several shards, each with its own lock and LRU order,
+    so handler threads working on different sources rarely contend.
+    A change of 'tos' (server start time) means xrootd was restarted, so no deltas
+    are calculated against the old values; neither are they for a counter whose
+    value went down. Sources not seen for ttl seconds, or beyond max_sources, are evicted.
+
+    counters: comma separated regular expressions of the fields that are counters;
+    deltas are only calculated for those. If not given, every numeric field gets a delta.
+    """
+    max_schemas = 256
+
+    def __init__(self, counters: str = None, ttl: float = 3600., max_sources: int = 10000, shards: int = 16):
+        patterns = split_patterns(counters) if counters else []
+        self._re_counters = re.compile('|'.join('(?:{})'.format(p) for p in patterns)) if patterns else None
+        self.ttl = ttl
+        self.n_shards = shards
+        self.max_per_shard = max(1, max_sources // shards)
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        self._schemas = {}
+        self._schema_lock = threading.Lock()
+        self.resets = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_config(cls, section):
+        """Create from a [DELTAS] config section"""
+        return cls(counters=section.get('counters', None),
+                   ttl=section.getfloat('ttl', 3600.),
+                   max_sources=section.getint('max_sources', 10000),
+                   shards=section.getint('shards', 16))
+
+    def _schema(self, keys: tuple) -> Schema:
+        schema = self._schemas.get(keys)
+        if schema is None:
+            schema = Schema(keys, self._re_counters)
+            with self._schema_lock:
+                if len(self._schemas) >= self.max_schemas:
+                    self._schemas.clear()
+                self._schemas[keys] = schema
+        return schema
+
+    def _evict(self, shard: OrderedDict, now: float):
+        """Remove the least recently updated sources that are idle, or over capacity; the shard lock must be held"""
+        while shard:
+            src, entry = next(iter(shard.items()))
+            if len(shard) > self.max_per_shard or now - entry[3] > self.ttl:
+                del shard[src]
+                self.evicted += 1
+            else:
+                break
+
+    def calculate(self, stats: dict) -> dict:
+        """Return stats with delta_s and delta_<key> added, and remember stats as the latest values for its source"""
+        src = stats.get(XrdKey.SRC, None)
+        if src is None:
+            raise ValueError("Missing 'src' key")
+
+        keys = tuple(k for k, v in stats.items() if type(v) is int or type(v) is float)
+        schema = self._schema(keys)
+        values = array('d', [stats[k] for k in keys])
+        tos = stats.get(XrdKey.TOS)
+        now = time.monotonic()
+
+        n = hash(src) % self.n_shards
+        shard = self._shards[n]
+        with self._locks[n]:
+            last = shard.pop(src, None)
+            shard[src] = (schema, values, tos, now)
+            self._evict(shard, now)
+
+        if last is None or now - last[3] > self.ttl:
+            # no (recent) previous value, so return
+            return stats
+        last_schema, last_values, last_tos, _ = last
+        if tos != last_tos:
+            # the server was restarted, so its counters were reset
+            logging.debug("Server restart detected for {}".format(src))
+            self.resets += 1
+            return stats
+
+        new_stats = dict(stats)
+        delta_s = float(stats[XrdKey.TOD] - last_values[last_schema.index[XrdKey.TOD]])
+        new_stats['delta_s'] = delta_s
+        if delta_s == 0:
+            # set value to 1 to avoid /0 errors
+            delta_s = 1.
+
+        same = last_schema is schema
+        last_index = last_schema.index
+        for i, k in enumerate(keys):
+            if same:
+                j = i
+            else:
+                j = last_index.get(k)
+                if j is None:
+                    continue
+            if not schema.counter[i]:
+                continue
+            diff = values[i] - last_values[j]
+            if diff < 0 and self._re_counters is not None:
+                # counter went backwards; no meaningful rate
+                continue
+            new_stats[schema.delta_keys[i]] = diff / delta_s
+        return new_stats
+
+    def __len__(self):
+        return sum(len(s) for s in self._shards)
+
+    def stats(self) -> dict:
+        return {'sources': len(self),
+                'schemas': len(self._schemas),
+                'resets': self.resets,
+                'evicted': self.evicted,
+                }
+
+    def __str__(self):
+        return "DeltaStore(counters={}, ttl={}, max_sources={})".format(
+               None if self._re_counters is None else self._re_counters.pattern,
+               self.ttl, self.max_per_shard * self.n_shards)
@@ -0,0 +1,139 @@
+import logging
+import queue
+import threading
+import time
+
+from xrdreporter.metrics import Histogram
+
+# what to do when an observer's queue is full
+DROP = 'drop'
+BLOCK = 'block'
+POLICIES = (DROP, BLOCK)
+
+
+class ObserverQueue:
+    """Bounded queue in front of one observer, drained by its own worker thread(s).
+
+    Records are handed to the observer's serve_batch() in batches of up to batch_size,
+    so one slow observer only delays itself. When the queue is full, the 'drop'
+    policy discards the new record, and the 'block' policy waits for space.
+    errors counts the records that failed: those the observer reports as failed,
+    or the whole batch if serve_batch() raises.
+    """
+    def __init__(self, observer, name: str = None, queue_size: int = 1000,
+                 policy: str = DROP, workers: int = 1, batch_size: int = 100):
+        if policy not in POLICIES:
+            raise ValueError("Unknown dispatch policy '{}'; use one of {}".format(policy, POLICIES))
+        self.observer = observer
+        self.name = name if name is not None else str(observer)
+        self.policy = policy
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self._lock = threading.Lock()
+        self.served = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = Histogram()    # from being queued to served
+        self.serve_time = Histogram() # time spent in serve_batch, per batch
+
+        self._workers = [threading.Thread(target=self._run, name='xrdrep-observer-{}-{}'.format(self.name, i), daemon=True)
+                         for i in range(workers)]
+        for t in self._workers:
+            t.start()
+
+    @classmethod
+    def from_params(cls, observer, params: dict, name: str = None):
+        """Build from the dispatch_* options of an observer's config section"""
+        return cls(observer, name=name,
+                   queue_size=int(params.get('dispatch_queue_size', 1000)),
+                   policy=params.get('dispatch_policy', DROP),
+                   workers=int(params.get('dispatch_workers', 1)),
+                   batch_size=int(params.get('dispatch_batch_size', 100)))
+
+    def put(self, data: dict):
+        item = (time.monotonic(), data)
+        if self.policy == BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    # put the sentinel back for after this batch
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            self._serve(batch)
+
+    def _serve(self, batch):
+        t0 = time.monotonic()
+        try:
+            # the number of records that failed, from Observer.serve_batch
+            failed = self.observer.serve_batch([data for _, data in batch]) or 0
+        except Exception as e:
+            with self._lock:
+                self.errors += len(batch)
+            logging.error("Observer {} failed on a batch of {}: {}".format(self.name, len(batch), e))
+            return
+        now = time.monotonic()
+        self.serve_time.record(now - t0)
+        for queued, _ in batch:
+            self.latency.record(now - queued)
+        with self._lock:
+            self.served += len(batch) - failed
+            self.errors += failed
+
+    def close(self, close_observer: bool = True):
+        """Let the workers serve what is queued, then stop them and close the observer (unless close_observer is false)"""
+        for _ in self._workers:
+            self.queue.put(None)
+        for t in self._workers:
+            t.join()
+        if close_observer:
+            self.observer.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = {'queue_depth': self.queue.qsize(),
+                      'served': self.served,
+                      'dropped': self.dropped,
+                      'errors': self.errors,
+                      }
+        counts['latency'] = self.latency.summary()
+        counts['serve_time'] = self.serve_time.summary()
+        return counts
+
+
+class ObserverDispatcher:
+    """Fan the processed stats out to a set of observers, each behind its own ObserverQueue"""
+    def __init__(self, queues):
+        self.queues = list(queues)
+
+    def serve(self, data: dict):
+        for q in self.queues:
+            q.put(data)
+
+    def close(self):
+        for q in self.queues:
+            q.close()
+
+    def stats(self) -> dict:
+        return {q.name: q.stats() for q in self.queues}
+
+    def __str__(self):
+        return "ObserverDispatcher({})".format(", ".join(q.name for q in self.queues))
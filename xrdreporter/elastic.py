@@ -0,0 +1,175 @@
+import json
+import logging
+import requests
+import time
+import urllib3
+
+from socket import getfqdn
+
+from xrdreporter.batching import BatchWriter, PartialWriteError, PermanentWriteError, permanent_status
+from xrdreporter.observers import Observer
+from xrdreporter.spool import Spool
+
+
+class ElasticSearchObserver(Observer):
+    """Send documents to ElasticSearch in batches, through the _bulk API.
+
+    Each host gets its own requests.Session, so connections are pooled and reused.
+    A batch goes to the first host that is not marked down, starting from a
+    different one each time; a host that fails is marked down for down_time seconds
+    and the batch is tried on the next one. A batch the hosts reject with a 4xx
+    status (see permanent_status) is not retried, and raises PermanentWriteError.
+    Of the documents ES reports as failed in a bulk response, those refused under
+    load (429, e.g. es_rejected_execution_exception, or 5xx) are handed back to the
+    writer with PartialWriteError; the others, e.g. mapping errors, are logged and dropped.
+    """
+    nonblocking = True
+
+    def __init__(self, params: dict):
+        super().__init__()
+        self.type_name = params.get('type_name', 'echo_xrdrpt')
+        self.index_prefix = params.get('index_prefix', 'logstash')
+        self.doc_type = params.get('doc_type', None) # only for ES < 7
+        hosts = [x.strip().rstrip('/') for x in params.get('hosts', '').split(',') if len(x.strip())]
+        self.hosts = hosts if len(hosts) else ["localhost:1232"]
+        self.timeout = float(params.get('timeout', 2))
+        self.down_time = float(params.get('down_time', 30))
+        self.verify = params.get('verify', 'false').lower() in ('true', 'yes', '1', 'on')
+        if not self.verify:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        self._sessions = {}
+        for host in self.hosts:
+            session = requests.Session()
+            session.verify = self.verify
+            session.headers['Content-Type'] = 'application/x-ndjson'
+            if 'username' in params:
+                session.auth = (params['username'], params.get('password', ''))
+            self._sessions[host] = session
+        self._down_until = {host: 0. for host in self.hosts}
+        self._next_host = 0
+
+        # does not change while running, so only look it up once
+        self.reporthost = getfqdn()
+        self._index_day = None
+        self._action = None
+
+        self.writer = BatchWriter(self._write_data, name=str(self),
+                                  batch_size=int(params.get('batch_size', 500)),
+                                  flush_interval=float(params.get('flush_interval', 1.0)),
+                                  queue_size=int(params.get('queue_size', 10000)),
+                                  max_retries=int(params.get('max_retries', 3)),
+                                  retry_backoff=float(params.get('retry_backoff', 1.0)),
+                                  spool=Spool.from_params(params),
+                                  replay_rate=float(params.get('spool_replay_rate', 1000.)),
+                                  probe_interval=float(params.get('spool_probe_interval', 30.)),
+                                  max_probe_failures=int(params.get('spool_max_probe_failures', 0)))
+
+    def _index_action(self, timestamp: str) -> str:
+        """Bulk action line for the daily index of a doc's @timestamp; only rebuilt when the day changes"""
+        day = timestamp[:10]
+        if day != self._index_day:
+            action = {'_index': '{}-{}'.format(self.index_prefix, day.replace('-', '.'))}
+            if self.doc_type:
+                action['_type'] = self.doc_type
+            self._action = json.dumps({'index': action})
+            self._index_day = day
+        return self._action
+
+    def _prep_request(self, data: dict):
+        """Build the data to be sent"""
+        
+        # add the type name as prefix to all keys 
+        params_new = {f'{self.type_name}_{k}': v for k,v in data.items()}
+        # add any extra variables 
+        params_new[f'{self.type_name}_reporthost'] = self.reporthost
+        # do not forget to add the type
+        params_new['type'] = self.type_name
+
+        #add some additional parameters
+        #Try to makesure get timezone/dst setting based on machine
+        # the time the stats were reported, so spooled and replayed docs keep their day
+        tod = data.get('tod')
+        if type(tod) is not int and type(tod) is not float:
+            tod = time.time()
+        params_new['@timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(tod))
+
+        return params_new
+
+    def _bulk_body(self, docs):
+        """NDJSON body of index actions for a _bulk request, each doc going to the index of its day"""
+        lines = []
+        for doc in docs:
+            lines.append(self._index_action(doc['@timestamp']))
+            lines.append(json.dumps(doc))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def _hosts_to_try(self):
+        """Hosts that are up, starting from the next in turn; if all are down try them all anyway"""
+        now = time.monotonic()
+        n = len(self.hosts)
+        start = self._next_host
+        self._next_host = (start + 1) % n
+        order = [self.hosts[(start + i) % n] for i in range(n)]
+        up = [h for h in order if self._down_until[h] <= now]
+        return up if up else order
+
+    def _write_data(self, docs):
+        body = self._bulk_body(docs)
+        error = None
+        for host in self._hosts_to_try():
+            try:
+                req = self._sessions[host].post(url=f'{host}/_bulk', data=body.encode('utf-8'),
+                                                timeout=self.timeout)
+                req.raise_for_status()
+                # a body that is not JSON (e.g. from a proxy in front of ES) fails the host like an error status
+                result = req.json()
+                if not isinstance(result, dict):
+                    raise ValueError("unexpected bulk response: {:.200}".format(req.text))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                status = e.response.status_code if getattr(e, 'response', None) is not None else None
+                if permanent_status(status):
+                    # the request itself is at fault, e.g. a mapping error; another host would say the same
+                    raise PermanentWriteError("ES host {} rejected the bulk request: {}".format(host, e)) from e
+                logging.warning("ES host {} failed ({}); marking down for {}s".format(host, e, self.down_time))
+                self._down_until[host] = time.monotonic() + self.down_time
+                error = e
+                continue
+            logging.debug(f'ES bulk result {req.status_code}, {len(docs)} documents to {host}')
+            if result.get('errors'):
+                self._bulk_errors(docs, result.get('items', []))
+            return
+        raise error
+
+    def _bulk_errors(self, docs, items):
+        """Drop the documents ES rejected for good, and raise PartialWriteError with those refused under load"""
+        retry = []
+        rejected = []
+        status = None
+        for doc, item in zip(docs, items):
+            result = item.get('index', {}) if isinstance(item, dict) else {}
+            if not result.get('error'):
+                continue
+            if permanent_status(result.get('status')):
+                rejected.append(result['error'])
+            else:
+                retry.append(doc)
+                status = result.get('status')
+        if rejected:
+            # documents rejected by ES, e.g. for a mapping error, would be rejected again, so do not retry them
+            logging.error("ES rejected {} of {} documents, e.g.: {}".format(len(rejected), len(docs), rejected[0]))
+        if retry:
+            raise PartialWriteError("ES refused {} of {} documents, e.g. with status {}".format(
+                                    len(retry), len(docs), status), retry)
+
+    def serve(self, data: dict):
+        self.writer.put(self._prep_request(data))
+
+    def close(self):
+        self.writer.close()
+        for session in self._sessions.values():
+            session.close()
+
+    def __str__(self):
+        return "ElasticSearch({}, {})".format(",".join(self.hosts), self.index_prefix)
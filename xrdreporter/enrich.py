@@ -0,0 +1,174 @@
+import ipaddress
+import logging
+import re
+import threading
+
+from xrdreporter.xrdLabels import XrdKey
+
+# the RAL Tier-1 classification, used when the config has no [ENRICH] section
+DEFAULT_RULES = """
+    contains nubes     host_type=VM
+    contains lcg       host_type=WN
+    contains ceph-dev  host_type=gateway-dev
+    contains ceph-     host_type=gateway
+    contains eos       host_type=eos
+    contains cta       host_type=cta
+"""
+# make sure that the proxy instance on the gateways has the correct label
+DEFAULT_OVERRIDES = """
+    info__name=ceph info__port=1094 -> info__name=proxy
+"""
+DEFAULT_DEFAULT = "host_type=unknown"
+
+RULE_KINDS = ('contains', 'regex', 'cidr')
+
+
+def parse_assignments(text: str) -> tuple:
+    """'a=1, b=2' -> (('a', '1'), ('b', '2'))"""
+    assignments = []
+    for item in re.split(r'[,\s]+', text.strip()):
+        if not item:
+            continue
+        if '=' not in item:
+            raise ValueError("Expected field=value, got '{}'".format(item))
+        k, v = item.split('=', 1)
+        assignments.append((k.strip(), v.strip()))
+    return tuple(assignments)
+
+
+def parse_rules(text: str) -> list:
+    """One rule per line: '<contains|regex|cidr> <pattern> field=value[, field=value...]'"""
+    rules = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 2)
+        if len(parts) != 3 or parts[0] not in RULE_KINDS:
+            raise ValueError("Invalid enrichment rule '{}'; use '<{}> <pattern> field=value'".format(
+                             line, '|'.join(RULE_KINDS)))
+        kind, pattern, assignments = parts
+        rules.append((kind, pattern, parse_assignments(assignments)))
+    return rules
+
+
+def parse_overrides(text: str) -> list:
+    """One override per line: 'field=value [field=value...] -> field=value[, field=value...]'"""
+    overrides = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if '->' not in line:
+            raise ValueError("Invalid override '{}'; use 'field=value ... -> field=value'".format(line))
+        conditions, assignments = line.split('->', 1)
+        overrides.append((parse_assignments(conditions), parse_assignments(assignments)))
+    return overrides
+
+
+class Enricher:
+    """Add fields to the stats, based on rules matched against the reporting host.
+
+    The host is info__host, or the host part of src if that is not a string.
+    Rules are tried in order and the first one that matches sets its fields:
+    'contains' matches a substring of the host, 'regex' searches it with a regular
+    expression, and 'cidr' matches the address the datagram came from (or the host,
+    if it is an IP address). If no rule matches, the default fields are set.
+    Overrides then set fields when all their conditions (field=value, compared as
+    strings) hold, e.g. to rename an instance.
+    All the contains/regex rules are compiled into a single regex that tries them
+    in order. The fields to set are memoized per host, address and the values of
+    the fields the overrides look at, and added to the stats in place.
+    """
+    max_cached = 10000
+
+    def __init__(self, rules: str = DEFAULT_RULES, overrides: str = DEFAULT_OVERRIDES, default: str = DEFAULT_DEFAULT):
+        self.rules = parse_rules(rules)
+        self.overrides = parse_overrides(overrides)
+        self.default = parse_assignments(default)
+
+        # each alternative scans the whole host, so the first rule in the list that matches wins
+        alternatives = []
+        self._cidrs = []
+        for i, (kind, pattern, _) in enumerate(self.rules):
+            if kind == 'contains':
+                alternatives.append('(?P<r{}>.*?{})'.format(i, re.escape(pattern)))
+            elif kind == 'regex':
+                re.compile(pattern)
+                alternatives.append('(?P<r{}>.*?(?:{}))'.format(i, pattern))
+            else:
+                self._cidrs.append((i, ipaddress.ip_network(pattern, strict=False)))
+        self._matcher = re.compile('|'.join(alternatives), re.DOTALL) if alternatives else None
+        self._condition_keys = tuple(sorted({k for conditions, _ in self.overrides for k, _ in conditions}))
+
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, section):
+        """Create from an [ENRICH] config section; options that are not set keep the defaults"""
+        return cls(rules=section.get('rules', DEFAULT_RULES),
+                   overrides=section.get('overrides', DEFAULT_OVERRIDES),
+                   default=section.get('default', DEFAULT_DEFAULT))
+
+    def _match(self, host: str, address) -> int:
+        """Index of the first rule that matches, or None"""
+        found = None
+        if self._matcher is not None:
+            m = self._matcher.match(host)
+            if m is not None:
+                found = int(m.lastgroup[1:])
+        for i, network in self._cidrs:
+            if found is not None and i > found:
+                break
+            for candidate in (address, host):
+                try:
+                    if candidate and ipaddress.ip_address(candidate) in network:
+                        return i
+                except ValueError:
+                    pass
+        return found
+
+    def _fields(self, host: str, address, conditions: tuple) -> tuple:
+        i = self._match(host, address)
+        fields = dict(self.default if i is None else self.rules[i][2])
+        values = {k: str(v) for k, v in zip(self._condition_keys, conditions) if v is not None}
+        for required, assignments in self.overrides:
+            if all(values.get(k) == v for k, v in required):
+                fields.update(assignments)
+        return tuple(fields.items())
+
+    def enrich(self, stats: dict, client_address=None) -> dict:
+        """Add the fields for the reporting host to stats, in place; returns stats"""
+        host = stats.get(XrdKey.INFO_HOST, "")
+        if type(host) != str:
+            logging.error(f'host {XrdKey.INFO_HOST} from {XrdKey.SRC} invalid')
+            host = str(stats.get(XrdKey.SRC, "")).split(":")[0]
+        # the address only matters to cidr rules, and would otherwise only dilute the cache
+        address = client_address[0] if client_address and self._cidrs else None
+        conditions = tuple(map(stats.get, self._condition_keys))
+        key = (host, address, conditions)
+        fields = self._cache.get(key)
+        if fields is None:
+            fields = self._fields(host, address, conditions)
+            with self._lock:
+                self.misses += 1
+                if len(self._cache) >= self.max_cached:
+                    self._cache.clear()
+                self._cache[key] = fields
+        else:
+            # not locked, so may undercount slightly with several threads
+            self.hits += 1
+        for k, v in fields:
+            stats[k] = v
+        return stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'rules': len(self.rules), 'cached': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+    def __str__(self):
+        return "Enricher({} rules, {} overrides, default {})".format(
+               len(self.rules), len(self.overrides), ",".join("{}={}".format(k, v) for k, v in self.default))
@@ -0,0 +1,99 @@
+import re
+import threading
+
+
+def split_patterns(patterns: str):
+    """Split a comma separated list of regular expressions, as used in the config"""
+    return [x.strip() for x in patterns.split(",") if len(x.strip())]
+
+
+class FieldFilter:
+    """Include/exclude filter for the stats keys, compiled once.
+
+    All the exclude patterns, and all the include patterns, are compiled into a
+    single alternation each; like re.match each pattern is anchored at the start of the key.
+    A key is dropped if it matches any exclude pattern, otherwise it is kept if it
+    matches any include pattern.
+    Decisions are memoized per key, and the list of keys to keep per key set, as the
+    keys sent by a given server hardly ever change.
+    The number of keys removed by each exclude rule (or by not matching any include),
+    and kept by each include rule, is counted for reporting.
+    """
+    max_cached = 4096
+    UNMATCHED = 'unmatched'
+
+    def __init__(self, include_fields: str = ".*", exclude_fields: str = ""):
+        self.include_fields = include_fields
+        self.exclude_fields = exclude_fields
+        self._includes = split_patterns(include_fields)
+        self._excludes = split_patterns(exclude_fields)
+        self._re_include = self._compile(self._includes, 'i')
+        self._re_exclude = self._compile(self._excludes, 'e')
+        # rule labels, indexed as [excludes..., includes..., unmatched]
+        self.rules = (['exclude:{}'.format(x) for x in self._excludes]
+                      + ['include:{}'.format(x) for x in self._includes]
+                      + [self.UNMATCHED])
+        self._hits = [0] * len(self.rules)
+
+        self._decisions = {} # key -> (keep, rule index)
+        self._keysets = {}   # tuple of keys -> (keys to keep, [(rule index, count), ...])
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _compile(patterns, prefix):
+        if not patterns:
+            return None
+        # name each alternative, so the rule that matched can be found from lastgroup
+        return re.compile('|'.join('(?P<{}{}>{})'.format(prefix, i, p) for i, p in enumerate(patterns)))
+
+    def _decide(self, key: str):
+        """Find whether to keep key, and which rule decided it"""
+        if self._re_exclude is not None:
+            m = self._re_exclude.match(key)
+            if m is not None:
+                return False, int(m.lastgroup[1:])
+        if self._re_include is not None:
+            m = self._re_include.match(key)
+            if m is not None:
+                return True, len(self._excludes) + int(m.lastgroup[1:])
+        return False, len(self.rules) - 1
+
+    def _keyset(self, keys: tuple):
+        """Work out, and cache, the keys to keep and the rule counts for one key set"""
+        decisions = self._decisions
+        keep = []
+        counts = {}
+        for k in keys:
+            decision = decisions.get(k)
+            if decision is None:
+                decision = self._decide(k)
+                if len(decisions) < self.max_cached:
+                    decisions[k] = decision
+            if decision[0]:
+                keep.append(k)
+            counts[decision[1]] = counts.get(decision[1], 0) + 1
+        entry = (tuple(keep), tuple(counts.items()))
+        if len(self._keysets) >= self.max_cached:
+            self._keysets.clear()
+        self._keysets[keys] = entry
+        return entry
+
+    def filter(self, stats: dict) -> dict:
+        """Return a new dict with only the kept keys of stats"""
+        keys = tuple(stats)
+        entry = self._keysets.get(keys)
+        if entry is None:
+            entry = self._keyset(keys)
+        keep, counts = entry
+        with self._lock:
+            for rule, n in counts:
+                self._hits[rule] += n
+        return {k: stats[k] for k in keep}
+
+    def hits(self) -> dict:
+        """Number of keys decided by each rule, since startup"""
+        with self._lock:
+            return dict(zip(self.rules, self._hits))
+
+    def __str__(self):
+        return "FieldFilter(include={!r}, exclude={!r})".format(self.include_fields, self.exclude_fields)
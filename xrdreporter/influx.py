@@ -0,0 +1,137 @@
+import logging
+import os
+
+from socket import getfqdn
+
+from xrdreporter.batching import BatchWriter, PermanentWriteError, permanent_status
+from xrdreporter.lineprotocol import LineProtocol
+from xrdreporter.observers import TAG_KEYS, Observer
+from xrdreporter.spool import Spool
+from xrdreporter.xrdLabels import XrdKey
+
+try:
+    from influxdb_client import InfluxDBClient
+    from influxdb_client.client.write_api import SYNCHRONOUS
+except ImportError:
+    InfluxDBClient = None
+
+try:
+    import influxdb as influxdbv1
+except ImportError:
+    influxdbv1 = None
+
+
+class InfluxDB2Observer(Observer):
+    nonblocking = True
+
+    def __init__(self, params: dict):
+        self.measurement = params['measurement'] # influx measurement name
+        self.tags = list(TAG_KEYS)
+        self.excluded = self.tags + [XrdKey.PID]
+        if 'api' in params and params['api'] == 'v1':
+            self.api = 'v1'
+            self.connection_param = {'host':params['host'],
+                                     'port':int(params['port']),
+                                     'username':params['username'],
+                                     'password':params['password'],
+                                     'database':params['database']
+                                     }
+        else:
+            self.api = 'v2'
+            self.bucket = params['bucket']
+            self.connection_param = { 'token': params['token'] if 'token' in params else  os.environ.get(params['token_env']),
+                    'org': params['org'], 
+                    'url': params['url'], 
+                }
+
+        library = 'influxdb' if self.api == 'v1' else 'influxdb-client'
+        if (influxdbv1 if self.api == 'v1' else InfluxDBClient) is None:
+            logging.error("{} needs the {} package; writes will fail until it is installed".format(self, library))
+
+        # escaped tag sets and field keys are cached; reporthost does not change while running
+        self.serializer = LineProtocol(self.measurement, self.tags, self.excluded,
+                                       extra_tags={'reporthost': getfqdn()},
+                                       integers=params.get('integers', 'false').lower() in ('true', 'yes', '1', 'on'))
+
+        # one long-lived client per observer, created on first use by the writer thread
+        self._client = None
+        self._write_api = None
+        self.writer = BatchWriter(self._write_data if self.api == 'v2' else self._write_data_v1,
+                                  name=str(self),
+                                  batch_size=int(params.get('batch_size', 500)),
+                                  flush_interval=float(params.get('flush_interval', 1.0)),
+                                  queue_size=int(params.get('queue_size', 10000)),
+                                  max_retries=int(params.get('max_retries', 3)),
+                                  retry_backoff=float(params.get('retry_backoff', 1.0)),
+                                  spool=Spool.from_params(params),
+                                  replay_rate=float(params.get('spool_replay_rate', 1000.)),
+                                  probe_interval=float(params.get('spool_probe_interval', 30.)),
+                                  max_probe_failures=int(params.get('spool_max_probe_failures', 0)))
+
+    def _reset_client(self):
+        """Drop the client after an error, so the next attempt reconnects"""
+        try:
+            if self._client is not None:
+                self._client.close()
+        except Exception:
+            pass
+        self._client = None
+        self._write_api = None
+
+    def _raise_if_rejected(self, e: Exception):
+        """Raise PermanentWriteError if the server rejected the points themselves, e.g. for a field type conflict"""
+        # ApiException of influxdb-client has the HTTP status as status, InfluxDBClientError of influxdb as code
+        status = getattr(e, 'status', None)
+        if status is None:
+            status = getattr(e, 'code', None)
+        if permanent_status(status):
+            raise PermanentWriteError("{} rejected the points: {}".format(self, e)) from e
+
+    def _write_data(self, lines):
+        if self._client is None:
+            if InfluxDBClient is None:
+                raise ImportError("the influxdb-client package is not installed")
+            self._client = InfluxDBClient(**self.connection_param)
+            self._write_api = self._client.write_api(write_options=SYNCHRONOUS)
+        try:
+            self._write_api.write(bucket=self.bucket, org=self.connection_param['org'], record='\n'.join(lines))
+        except Exception as e:
+            self._reset_client()
+            self._raise_if_rejected(e)
+            raise
+
+    def _write_data_v1(self, lines):
+        if self._client is None:
+            if influxdbv1 is None:
+                raise ImportError("the influxdb package is not installed")
+            self._client = influxdbv1.InfluxDBClient(**self.connection_param)
+        try:
+            self._client.write_points('\n'.join(lines), protocol='line')
+        except Exception as e:
+            self._reset_client()
+            self._raise_if_rejected(e)
+            raise
+
+    def serve(self, data: dict):
+        tod = data[XrdKey.TOD]
+        line = self.serializer.line(data, tod * 1000000000 if type(tod) is int else int(tod * 1e9))
+        if line is not None:
+            self.writer.put(line)
+
+    def close(self):
+        self.writer.close()
+        self._reset_client()
+
+    def stats(self) -> dict:
+        # values skipped because they did not fit the type of their field, with integers = true
+        return {'type_conflicts': self.serializer.conflicts}
+
+    def __str__(self):
+        if self.api == 'v2':
+            return "InfluxDB2({}, {}, {})".format(self.connection_param['url'], self.bucket, self.measurement)
+        else:
+            return "InfluxDBv1({}, {}, {})".format(self.connection_param['host'], self.connection_param['database'] 
+                                                  ,self.measurement)
+
+
+        
@@ -0,0 +1,135 @@
+# characters that must be escaped in each part of an influx line
+_MEASUREMENT_ESCAPES = str.maketrans({',': '\\,', ' ': '\\ ', '\n': '\\n'})
+_KEY_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ ', '\n': '\\n'})
+_STRING_ESCAPES = str.maketrans({'"': '\\"', '\\': '\\\\', '\n': '\\n'})
+
+
+def escape_measurement(name: str) -> str:
+    return name.translate(_MEASUREMENT_ESCAPES)
+
+
+def escape_key(key: str) -> str:
+    """Escape a tag key, tag value or field key"""
+    return key.translate(_KEY_ESCAPES)
+
+
+def escape_string(value: str) -> str:
+    """Quote a string field value"""
+    return '"' + value.translate(_STRING_ESCAPES) + '"'
+
+
+class LineProtocol:
+    """Serialize flat records into influx line protocol.
+
+    The measurement and tag set part of the line ("measurement,tag=value,... ") is
+    escaped once and cached per combination of tag values, which changes only with
+    the source; extra_tags (e.g. reporthost) are added to every line. Tags are
+    written sorted by key. The escaped
+    field keys are cached per key set, as a source sends the same keys every time.
+    By default numbers are all written as floats, as the earlier serializer did, so
+    existing measurements keep their field types. With integers, the type of each
+    field is fixed by the first value seen for it: an int makes it an integer field
+    (written with the 'i' suffix), a float a float field. Later floats with no
+    fractional part are written as ints in an integer field; those with one cannot
+    be, and are skipped and counted in conflicts, as influx would reject the point.
+    Non-finite floats are skipped, as influx does not accept them.
+    """
+    max_cached = 10000
+
+    def __init__(self, measurement: str, tags, excluded=(), extra_tags: dict = None, integers: bool = False):
+        self.measurement = measurement
+        self.tags = tuple(tags)
+        self.excluded = frozenset(excluded)
+        self.extra_tags = dict(extra_tags or {})
+        self.integers = integers
+        self._measurement = escape_measurement(measurement)
+        self._prefixes = {} # tag values -> "measurement,tags "
+        self._fields = {}   # tuple of keys -> ((key, "escaped key="), ...)
+        self._int_fields = {} # field key -> True for an integer field, False for a float field, with integers
+        self.conflicts = 0
+
+    def _prefix(self, values: tuple) -> str:
+        # influx prefers the tags sorted by key; empty tag values are not allowed
+        tags = dict(self.extra_tags)
+        tags.update((k, v) for k, v in zip(self.tags, values) if v is not None)
+        prefix = self._measurement + ''.join(',{}={}'.format(escape_key(k), escape_key(str(v)))
+                                             for k, v in sorted(tags.items()) if str(v) != '') + ' '
+        if len(self._prefixes) >= self.max_cached:
+            self._prefixes.clear()
+        self._prefixes[values] = prefix
+        return prefix
+
+    def _field_keys(self, keys: tuple) -> tuple:
+        excluded = self.excluded
+        fields = tuple((k, escape_key(k) + '=') for k in keys if k not in excluded)
+        if len(self._fields) >= self.max_cached:
+            self._fields.clear()
+        self._fields[keys] = fields
+        return fields
+
+    def line(self, record: dict, timestamp: int) -> str:
+        """The line for record, with timestamp in ns; None if the record has no fields to write"""
+        values = tuple(record.get(k) for k in self.tags)
+        prefix = self._prefixes.get(values)
+        if prefix is None:
+            prefix = self._prefix(values)
+        keys = tuple(record)
+        fields = self._fields.get(keys)
+        if fields is None:
+            fields = self._field_keys(keys)
+
+        if self.integers:
+            parts = self._typed_numbers(record, fields)
+        else:
+            parts = []
+        append = parts.append
+        for k, escaped in fields:
+            v = record[k]
+            t = type(v)
+            if t is int or t is float:
+                # with integers, numbers are already in parts
+                if self.integers:
+                    continue
+                if t is int:
+                    append(f'{escaped}{v}')
+                # false for inf and nan
+                elif v - v == 0:
+                    append(f'{escaped}{v!r}')
+            elif t is str:
+                append(escaped + escape_string(v))
+            elif t is bool:
+                append(escaped + ('true' if v else 'false'))
+            elif v is not None:
+                append(escaped + escape_string(str(v)))
+        if not parts:
+            return None
+        return '{}{} {}'.format(prefix, ','.join(parts), timestamp)
+
+    def _typed_numbers(self, record: dict, fields: tuple) -> list:
+        """The numeric fields of record, each written as the type its field was first seen with"""
+        int_fields = self._int_fields
+        parts = []
+        append = parts.append
+        for k, escaped in fields:
+            v = record[k]
+            t = type(v)
+            if t is not int and t is not float:
+                continue
+            if t is float and v - v != 0:
+                continue # inf or nan
+            is_int = int_fields.get(k)
+            if is_int is None:
+                is_int = t is int
+                if len(int_fields) < self.max_cached:
+                    int_fields[k] = is_int
+                else:
+                    is_int = False # untracked fields are safest as floats
+            if not is_int:
+                append(f'{escaped}{float(v)!r}')
+            elif t is int:
+                append(f'{escaped}{v}i')
+            elif v.is_integer():
+                append(f'{escaped}{int(v)}i')
+            else:
+                self.conflicts += 1
+        return parts
@@ -1,38 +1,98 @@
+import gzip
 import json
 import logging
 import os
-import re
-import requests
-import socketserver
+import shutil
 import threading
-import urllib3
 
 from datetime import date,datetime
-from random import choice 
-from requests.exceptions import Timeout
-from socket import getfqdn
-from threading import Lock
-from typing import List
 
+from xrdreporter.batching import BatchWriter
+from xrdreporter.spool import Spool
 from xrdreporter.xrdLabels import XrdKey
 
+# the observers with heavier dependencies live in their own modules, and are only
+# imported when used; see xrdreporter.registry
+MOVED = {'ArchiveObserver': 'xrdreporter.archive',
+         'RingBufferObserver': 'xrdreporter.ringbuffer',
+         'ElasticSearchObserver': 'xrdreporter.elastic',
+         'InfluxDB2Observer': 'xrdreporter.influx',
+         'PrometheusObserver': 'xrdreporter.prometheus'}
+
+
+def __getattr__(name):
+    # keep 'from xrdreporter.observers import InfluxDB2Observer' working, importing it on demand
+    if name in MOVED:
+        import importlib
+        return getattr(importlib.import_module(MOVED[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
 try:
-    import influxdb_client
-    from influxdb_client import InfluxDBClient, Point, WritePrecision
-    from influxdb_client.client.write_api import SYNCHRONOUS
+    import orjson
 except ImportError:
-    pass # slience for now
+    orjson = None
 
 try:
-    import influxdb as influxdbv1
+    import zstandard
 except ImportError:
-    pass # slience for now
+    zstandard = None
+
+
+def json_line(data: dict) -> bytes:
+    """Encode a record as a line of JSON, with orjson if it is available"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            pass # e.g. integers beyond 64 bits; fall back to the standard library
+    return (json.dumps(data) + '\n').encode('utf-8')
+
+
+# file suffix of each supported compression
+COMPRESSORS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+def compress_file(filename: str, method: str):
+    """Compress filename to filename + suffix, and remove the original"""
+    target = filename + COMPRESSORS[method]
+    try:
+        with open(filename, 'rb') as src, open(target + '.tmp', 'wb') as dst:
+            if method == 'gzip':
+                with gzip.GzipFile(filename=os.path.basename(filename), fileobj=dst, mode='wb') as gz:
+                    shutil.copyfileobj(src, gz)
+            else:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        os.rename(target + '.tmp', target)
+        os.remove(filename)
+    except Exception as e:
+        logging.error("Failed to compress {}: {}".format(filename, e))
 
 
 class Observer():
     # Note Observers are required to be thread-safe
+    # Observers that only queue records for their own writer thread set nonblocking,
+    # so the asyncio server can serve them directly from its event loop. An observer
+    # may also define a serve_batch_async(data: list) coroutine, which the asyncio
+    # server awaits on its loop instead of calling serve_batch().
+    nonblocking = False
     def serve(self,data: dict):
         pass
+    def serve_batch(self, data: list) -> int:
+        """Serve several records at once; override if the sink can handle them more efficiently together.
+        A record that fails is logged and skipped, so it does not take the rest of the batch with it;
+        returns the number of records that failed"""
+        failed = 0
+        for d in data:
+            try:
+                self.serve(d)
+            except Exception as e:
+                failed += 1
+                logging.error("Observer {} failed on a record from {}: {}".format(
+                              getattr(self, 'name', self), d.get('src') if isinstance(d, dict) else None, e))
+        return failed
+    def close(self):
+        """Flush any buffered output and release connections"""
+        pass
 
 class LoggerObserver(Observer):
     def __init__(self, params):
@@ -59,159 +119,94 @@ class SummaryLoggerObserver(Observer):
 
 
 class FileObserver(Observer):
-    def __init__(self, params):
-        super().__init__()
-        self.filename = params['filename']
-    def serve(self, data: dict):
-        with Lock():
-            with open(self.filename,'a') as foo:
-                foo.write("{}\n".format(json.dumps(data)))
-    def __str__(self):
-        return "File(\"{}\")".format(self.filename)
+    """Append each record as a line of JSON to a file.
 
+    The file is kept open and written by a single background thread, which flushes
+    when batch_size records are waiting or after flush_interval seconds.
+    The file is rotated when it reaches rotate_size bytes, and/or at the first write
+    of a new day (rotate_daily); the completed file is renamed with a timestamp suffix
+    and optionally compressed, with gzip or zstd.
+    """
+    nonblocking = True
 
-class ElasticSearchObserver(Observer):
-    def __init__(self, hosts: List[str], type_name: str ='echo_xrdrpt'):
+    def __init__(self, params):
         super().__init__()
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        self.type_name = type_name
-        self.hosts = hosts if len(hosts) else ["localhost:1232"]
-        self.timeout = 2
-
-    def _url(self):
-        es_host = choice(self.hosts)
-        day = date.today().strftime("%Y.%m.%d")
-        path = f'/logstash-{day}/doc/'
-        url = f'{es_host}/{path}'
-        return url
-
-    def _prep_request(self, data: dict):
-        """Build the data to be sent"""
-        
-        #make a copy
-        params = dict(data)
-        # add any extra variables 
-        params['reporthost'] = getfqdn()
-
-        # add the type name as prefix to all keys 
-        params_new = {}
-        for k,v in params.items():
-            params_new[f'{self.type_name}_{k}'] = v 
-        # do not forget to add the type
-        params_new['type'] = self.type_name
-
-        #add some additional parameters
-        #Try to makesure get timezone/dst setting based on machine
-        params_new['@timestamp'] = datetime.now().astimezone().strftime("%Y-%m-%dT%H:%M:%S%z")
-
-        return params_new
-
-    def serve(self, data: dict):
-        url = self._url()
-
-        new_data = self._prep_request(data)
-
-        logging.debug(f'Sending to ES: {new_data}, {url}')
-        try:
-            logging.info(f'{url} {new_data}')
-            #req = requests.post(url=url, verify=False,
-            #            json=new_data, timeout=self.timeout)
-            #req.raise_for_status()
-            #logging.debug(f'ES data result {req.status_code}' )
-        except Timeout:
-            logging.warning("ES data submission hit timeout")
-
-
-class InfluxDB2Observer(Observer):
-    def __init__(self, params: dict):
-        self.measurement = params['measurement'] # influx measurement name
-        self.tags = [XrdKey.SRC, XrdKey.INS, 
-                XrdKey.SITE, XrdKey.PGM,XrdKey.VER,
-                XrdKey.INFO_HOST, XrdKey.INFO_PORT, XrdKey.INFO_NAME, 
-                XrdKey.OFS_ROLE,
-                'host_type']
-        self.excluded = self.tags + [XrdKey.PID]
-        if 'api' in params and params['api'] == 'v1':
-            self.api = 'v1'
-            self.connection_param = {'host':params['host'],
-                                     'port':int(params['port']),
-                                     'username':params['username'],
-                                     'password':params['password'],
-                                     'database':params['database']
-                                     }
-        else:
-            self.api = 'v2'
-            self.bucket = params['bucket']
-            self.connection_param = { 'token': params['token'] if 'token' in params else  os.environ.get(params['token_env']),
-                    'org': params['org'], 
-                    'url': params['url'], 
-                }
+        # '{pid}' in the name gives each process its own file, e.g. with [SERVER] workers > 1
+        self.filename = params['filename'].replace('{pid}', str(os.getpid()))
+        self.rotate_size = int(params.get('rotate_size', 0)) # bytes; 0 to disable
+        self.rotate_daily = params.get('rotate_daily', 'false').lower() in ('true', 'yes', '1', 'on')
+        self.compress = params.get('compress', 'none').lower()
+        if self.compress not in COMPRESSORS:
+            raise ValueError("Unknown compression '{}'; use one of {}".format(self.compress, sorted(COMPRESSORS)))
+        if self.compress == 'zstd' and zstandard is None:
+            raise ImportError("compress = zstd requires the zstandard package")
+
+        self._file = None
+        self._size = 0
+        self._day = None
+        self.writer = BatchWriter(self._write_data, name=str(self),
+                                  batch_size=int(params.get('batch_size', 1000)),
+                                  flush_interval=float(params.get('flush_interval', 1.0)),
+                                  queue_size=int(params.get('queue_size', 100000)),
+                                  max_retries=int(params.get('max_retries', 1)),
+                                  retry_backoff=float(params.get('retry_backoff', 1.0)),
+                                  spool=Spool.from_params(params),
+                                  replay_rate=float(params.get('spool_replay_rate', 1000.)),
+                                  probe_interval=float(params.get('spool_probe_interval', 30.)),
+                                  max_probe_failures=int(params.get('spool_max_probe_failures', 0)))
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+        self._size = self._file.tell()
+        self._day = date.today()
+
+    def _rotate(self):
+        """Close the current file, move it aside and, if configured, compress it in the background"""
+        self._file.close()
+        self._file = None
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        rotated = '{}.{}'.format(self.filename, stamp)
+        n = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + COMPRESSORS[self.compress]):
+            n += 1
+            rotated = '{}.{}-{}'.format(self.filename, stamp, n)
+        os.rename(self.filename, rotated)
+        logging.info("Rotated {} to {}".format(self.filename, rotated))
+        if self.compress != 'none':
+            threading.Thread(target=compress_file, args=(rotated, self.compress),
+                             name='xrdrep-compress', daemon=True).start()
 
     def _write_data(self, records):
-        data =[]
-        for item in records:
-            v ="{},".format(self.measurement) # measurement
-            v += ','.join( "{}={}".format(k,v) for k,v in item['tags'].items() ) # tags
-            v += " "
-            v += ','.join( "{}={}".format(k,v) for k,v in item['fields'].items() ) # fields
-            v += ' {}\n'.format(item['timestamp']) # time
-            data.append(v)
-
-        with InfluxDBClient(**self.connection_param) as client:
-            write_api = client.write_api(write_options=SYNCHRONOUS)
-            write_api.write(bucket=self.bucket, org=self.connection_param['org'], record=data)
-
-    def _write_data_v1(self, records):
-        data =[]
-        for item in records:
-            v = {'measurement': self.measurement, 
-                 'tags': item['tags'],
-                 'time': item['timestamp'],
-                 'fields': item['fields']
-            }
-        data.append(v)
-
-        # with influxdbv1.InfluxDBClient(**self.connection_param) as client:
-        #     client.write_points(data)
-        try:
-            client = influxdbv1.InfluxDBClient(**self.connection_param)
-            client.write_points(data)
-        except influxdbv1.exceptions.InfluxDBClientError as e:
-            print(e)
-        finally:
-            client.close()
-
-
-
+        if self._file is None:
+            self._open()
+        elif self.rotate_daily and date.today() != self._day:
+            self._rotate()
+            self._open()
+        buf = b''.join(json_line(r) for r in records)
+        self._file.write(buf)
+        self._file.flush()
+        self._size += len(buf)
+        if self.rotate_size and self._size >= self.rotate_size:
+            self._rotate()
 
     def serve(self, data: dict):
-        tags = {k:f'{data[k]}' for k in self.tags if k in data}
-        tags['reporthost'] = getfqdn()
-
-        fields = {}
-        for k,v in data.items():
-            if k in self.excluded:
-                continue
-            fields[k] = f'\"{v}\"' if type(v) == str else v
+        self.writer.put(data)
 
-        timestamp = int(data[XrdKey.TOD]*1e9)
+    def close(self):
+        self.writer.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
-        if self.api == 'v2':
-            self._write_data(records=[{'tags':tags,
-                                    'timestamp':timestamp,
-                                    'fields':fields}])
-        else:
-            self._write_data_v1(records=[{'tags':tags,
-                             'timestamp':timestamp,
-                             'fields':fields}])
+    def __str__(self):
+        return "File(\"{}\")".format(self.filename)
 
 
-    def __str__(self):
-        if self.api == 'v2':
-            return "InfluxDB2({}, {}, {})".format(self.connection_param['url'], self.bucket, self.measurement)
-        else:
-            return "InfluxDBv1({}, {}, {})".format(self.connection_param['host'], self.connection_param['database'] 
-                                                  ,self.measurement)
+# the fields that identify a source, as InfluxDB tags and Prometheus labels
+TAG_KEYS = [XrdKey.SRC, XrdKey.INS,
+            XrdKey.SITE, XrdKey.PGM, XrdKey.VER,
+            XrdKey.INFO_HOST, XrdKey.INFO_PORT, XrdKey.INFO_NAME,
+            XrdKey.OFS_ROLE,
+            'host_type']
 
 
-        
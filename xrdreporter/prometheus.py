@@ -0,0 +1,239 @@
+import logging
+import math
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socket import getfqdn
+
+from xrdreporter.filters import FieldFilter
+from xrdreporter.observers import TAG_KEYS, Observer
+from xrdreporter.xrdLabels import XrdKey
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+_INVALID = re.compile(r'[^a-zA-Z0-9_:]')
+_LABEL_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"', '\n': '\\n'})
+
+
+def metric_name(prefix: str, key: str) -> str:
+    name = _INVALID.sub('_', '{}_{}'.format(prefix, key) if prefix else key)
+    return '_' + name if name[0].isdigit() else name
+
+
+def format_value(v) -> str:
+    if type(v) is float:
+        if math.isnan(v):
+            return 'NaN'
+        if math.isinf(v):
+            return '+Inf' if v > 0 else '-Inf'
+        return repr(v)
+    return str(int(v))
+
+
+class Exposition:
+    """The latest numeric fields of each source, as pre-rendered Prometheus text exposition lines.
+
+    Every field becomes a metric (prefix_field), with the tags of the source as labels.
+    When a source reports, only its own lines are re-rendered, and fields it did
+    not send keep their last value. The label set is rendered once per combination
+    of tag values, and the metric names once per key set.
+    Lines are kept per metric, then per source, so a scrape joins the lines of each
+    metric under its TYPE line; the page is kept until something changes.
+    Sources that have not reported for ttl seconds are expired.
+    """
+    max_cached = 10000
+
+    def __init__(self, tags, prefix: str = 'xrootd', fields: str = '.*', exclude: str = '',
+                 extra_labels: dict = None, ttl: float = 600.):
+        self.tags = tuple(tags)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.extra_labels = dict(extra_labels or {})
+        excluded = set(self.tags) | {XrdKey.PID, XrdKey.TOD}
+        self._select = FieldFilter(fields, exclude)
+        self._excluded = frozenset(excluded)
+        self._labels = {}   # tag values -> '{tag="value",...}'
+        self._names = {}    # tuple of keys -> ((key, metric name), ...)
+        self._metrics = {}  # metric name -> {src: line}
+        self._sources = {}  # src -> (monotonic time of the last report, its metric names, key set last seen)
+        self._lock = threading.Lock()
+        self._page = None
+        self._next_expiry = 0.
+        self.updates = 0
+        self.expired = 0
+        self.scrapes = 0
+
+    def _label_set(self, values: tuple) -> str:
+        labels = dict(self.extra_labels)
+        labels.update((k, v) for k, v in zip(self.tags, values) if v is not None and str(v) != '')
+        text = '{' + ','.join('{}="{}"'.format(_INVALID.sub('_', k), str(v).translate(_LABEL_ESCAPES))
+                              for k, v in sorted(labels.items())) + '}'
+        if len(self._labels) >= self.max_cached:
+            self._labels.clear()
+        self._labels[values] = text
+        return text
+
+    def _metric_names(self, keys: tuple, stats: dict) -> tuple:
+        kept = self._select.filter(stats)
+        names = tuple((k, metric_name(self.prefix, k)) for k in keys if k in kept and k not in self._excluded)
+        if len(self._names) >= self.max_cached:
+            self._names.clear()
+        self._names[keys] = names
+        return names
+
+    def update(self, stats: dict):
+        """Re-render the lines of the source of stats"""
+        src = stats.get(XrdKey.SRC)
+        if src is None:
+            return
+        values = tuple(stats.get(k) for k in self.tags)
+        labels = self._labels.get(values)
+        if labels is None:
+            labels = self._label_set(values)
+        keys = tuple(stats)
+        names = self._names.get(keys)
+        if names is None:
+            names = self._metric_names(keys, stats)
+        lines = []
+        append = lines.append
+        for k, name in names:
+            v = stats[k]
+            t = type(v)
+            if t is int:
+                append((name, f'{name}{labels} {v}\n'))
+            elif t is float:
+                # false for inf and nan
+                if v - v == 0:
+                    append((name, f'{name}{labels} {v!r}\n'))
+                else:
+                    append((name, f'{name}{labels} {format_value(v)}\n'))
+            elif t is bool:
+                append((name, f'{name}{labels} {int(v)}\n'))
+
+        now = time.monotonic()
+        with self._lock:
+            metrics = self._metrics
+            for name, line in lines:
+                by_source = metrics.get(name)
+                if by_source is None:
+                    by_source = metrics[name] = {}
+                by_source[src] = line
+            # a field missing from this record keeps its last value (records may only carry
+            # the changed fields, with [CHANGES]); it goes when the source expires
+            previous = self._sources.get(src)
+            if previous is None:
+                self._sources[src] = (now, {name for _, name in names}, names)
+            elif previous[2] is names:
+                self._sources[src] = (now, previous[1], names)
+            else:
+                previous[1].update(name for _, name in names)
+                self._sources[src] = (now, previous[1], names)
+            self._page = None
+            self.updates += 1
+            if now >= self._next_expiry:
+                self._next_expiry = now + min(60., self.ttl / 10)
+                self._expire(now)
+
+    def _remove(self, name: str, src):
+        by_source = self._metrics.get(name)
+        if by_source is not None:
+            by_source.pop(src, None)
+            if not by_source:
+                del self._metrics[name]
+
+    def _expire(self, now: float):
+        """Drop the sources that have not reported for ttl seconds; the lock must be held"""
+        stale = [src for src, (seen, _, _) in self._sources.items() if now - seen > self.ttl]
+        for src in stale:
+            _, names, _ = self._sources.pop(src)
+            for name in names:
+                self._remove(name, src)
+        if stale:
+            self.expired += len(stale)
+            self._page = None
+            logging.debug("Expired {} sources from the Prometheus exposition".format(len(stale)))
+
+    def render(self) -> bytes:
+        """The whole exposition page"""
+        with self._lock:
+            self.scrapes += 1
+            self._expire(time.monotonic())
+            if self._page is None:
+                parts = []
+                for name in sorted(self._metrics):
+                    parts.append('# TYPE {} untyped\n'.format(name))
+                    parts.append(''.join(self._metrics[name].values()))
+                self._page = ''.join(parts).encode('utf-8')
+            return self._page
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'sources': len(self._sources),
+                    'metrics': len(self._metrics),
+                    'updates': self.updates,
+                    'expired': self.expired,
+                    'scrapes': self.scrapes,
+                    }
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    exposition = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404, 'use /metrics')
+            return
+        body = self.exposition.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Scrape from {}: {}".format(self.address_string(), format % args))
+
+
+def serve_metrics(exposition: Exposition, address: tuple) -> ThreadingHTTPServer:
+    """Start an HTTP server for /metrics on a background thread"""
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'exposition': exposition})
+    server = ThreadingHTTPServer(address, handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='xrdrep-prometheus', daemon=True).start()
+    return server
+
+
+class PrometheusObserver(Observer):
+    """Serve the latest stats of each source on http_address:http_port/metrics, in the Prometheus
+    text format (see Exposition). With several worker processes, worker n
+    listens on http_port + n.
+    """
+    nonblocking = True
+
+    def __init__(self, params: dict):
+        super().__init__()
+        self.exposition = Exposition(TAG_KEYS,
+                                     prefix=params.get('prefix', 'xrootd'),
+                                     fields=params.get('fields', '.*'),
+                                     exclude=params.get('exclude', ''),
+                                     extra_labels={'reporthost': getfqdn()},
+                                     ttl=float(params.get('ttl', 600)))
+        port = int(params.get('http_port', 9100)) + int(os.environ.get('XRDREP_WORKER', '0'))
+        self.server = serve_metrics(self.exposition, (params.get('http_address', '127.0.0.1'), port))
+        logging.info("{} serving /metrics on {}:{}".format(self, *self.server.server_address[:2]))
+
+    def serve(self, data: dict):
+        self.exposition.update(data)
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def stats(self) -> dict:
+        return self.exposition.stats()
+
+    def __str__(self):
+        return "Prometheus({})".format(self.exposition.prefix)
@@ -0,0 +1,55 @@
+import importlib
+import logging
+
+ENTRY_POINT_GROUP = 'xrdreporter.observers'
+
+# observer name (as used for 'observer =' in the config) -> module that defines it;
+# a module is only imported when a config section uses one of its observers
+BUILTIN = {
+    'LoggerObserver': 'xrdreporter.observers',
+    'SummaryLoggerObserver': 'xrdreporter.observers',
+    'FileObserver': 'xrdreporter.observers',
+    'ArchiveObserver': 'xrdreporter.archive',
+    'RingBufferObserver': 'xrdreporter.ringbuffer',
+    'PrometheusObserver': 'xrdreporter.prometheus',
+    'ElasticSearchObserver': 'xrdreporter.elastic',
+    'InfluxDB2Observer': 'xrdreporter.influx',
+}
+
+
+def _entry_points() -> dict:
+    """name -> entry point, for the observers that other packages register"""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return {} # Python < 3.8
+    found = entry_points()
+    if hasattr(found, 'select'):
+        found = found.select(group=ENTRY_POINT_GROUP)
+    else:
+        found = found.get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep for ep in found}
+
+
+def observer_class(name: str):
+    """The observer class for a config name: a built-in observer, one registered by another
+    package under the 'xrdreporter.observers' entry point group, or 'package.module:Class'"""
+    if name in BUILTIN:
+        return getattr(importlib.import_module(BUILTIN[name]), name)
+    if ':' in name:
+        module, _, attr = name.partition(':')
+        return getattr(importlib.import_module(module), attr)
+    plugins = _entry_points()
+    if name in plugins:
+        logging.debug("Loading observer {} from {}".format(name, plugins[name].value))
+        return plugins[name].load()
+    raise ValueError("Unknown observer '{}'; built-in observers are {}{}".format(
+                     name, ", ".join(sorted(BUILTIN)),
+                     "; installed plugins are " + ", ".join(sorted(plugins)) if plugins else ""))
+
+
+def available() -> dict:
+    """name -> where it comes from, for every observer that can be configured, without importing any"""
+    observers = dict(BUILTIN)
+    observers.update((name, ep.value) for name, ep in _entry_points().items() if name not in BUILTIN)
+    return observers
@@ -0,0 +1,80 @@
+import configparser
+import logging
+import signal
+import threading
+import time
+
+
+def read_config(paths) -> configparser.ConfigParser:
+    """Read the ini config files; at least one of them must be readable"""
+    config = configparser.ConfigParser()
+    read = config.read(paths)
+    if not read:
+        raise ValueError("None of the config files {} could be read".format(", ".join(str(p) for p in paths)))
+    return config
+
+
+class Reloader:
+    """Re-read the config files on request, and hand the old and new config to apply(old, new).
+
+    Reloads run one at a time on a background thread, so neither the signal handler
+    nor the thread receiving a 'reload' datagram does any of the work. A request made
+    while a reload is running leads to one more reload once it is done, so the last
+    edit of the files is always picked up. If reading the files or apply() fails,
+    the error is logged and the running config is kept.
+    """
+    def __init__(self, paths, config, apply):
+        self.paths = paths
+        self.config = config
+        self.apply = apply
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload = None
+        self._wanted = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='xrdrep-reload', daemon=True)
+        self._thread.start()
+
+    def install(self, signum=signal.SIGHUP):
+        """Reload when the process receives signum; must be called from the main thread"""
+        signal.signal(signum, lambda signum, frame: self.request())
+
+    def request(self):
+        self._wanted.set()
+
+    def reload(self) -> bool:
+        """Read the config files and apply them, now, on the calling thread"""
+        logging.info("Reloading the configuration from {}".format(", ".join(str(p) for p in self.paths)))
+        t0 = time.monotonic()
+        try:
+            config = read_config(self.paths)
+            self.apply(self.config, config)
+        except Exception as e:
+            self.failures += 1
+            logging.error("Reload failed, keeping the running configuration: {}".format(e))
+            return False
+        self.config = config
+        self.reloads += 1
+        self.last_reload = time.time()
+        logging.info("Reloaded the configuration in {:.3f} s".format(time.monotonic() - t0))
+        return True
+
+    def _run(self):
+        while True:
+            self._wanted.wait()
+            if self._stopping:
+                break
+            self._wanted.clear()
+            self.reload()
+
+    def close(self):
+        """Stop, after finishing any reload in progress"""
+        self._stopping = True
+        self._wanted.set()
+        self._thread.join()
+
+    def stats(self) -> dict:
+        return {'reloads': self.reloads,
+                'failures': self.failures,
+                'last_reload': self.last_reload or 0,
+                }
@@ -1,13 +1,19 @@
+import json
 import logging
 import re
 import socketserver
 import threading
 import xml
 
-from numbers import Number
+from time import perf_counter
 from xml.dom import minidom
 
-from xrdreporter.observers import Observer
+from xrdreporter.deltas import DeltaStore
+from xrdreporter.enrich import Enricher
+from xrdreporter.filters import FieldFilter
+from xrdreporter.metrics import Metrics
+from xrdreporter.templates import TemplateCache
+from xrdreporter.xmlparse import parse_expat
 from xrdreporter.xrdLabels import XrdKey
 
 
@@ -50,23 +56,28 @@ def parse_dom(dataraw):
     return data
 
 
+# available xml parsers, selected with MyUDPRequestHandler.parser
+# ('template' uses MyUDPRequestHandler.template_cache, falling back to expat)
+parsers = {'minidom': parse_dom,
+           'expat': parse_expat,
+          }
+
+
 def filter_stats(stats: dict, re_includes, re_excludes):
     """filter the stats, based on lists of compiled re expressions"""
     new_stats = {}
     for k,v in stats.items():
-        for re_exp in re_excludes:
-            if re_exp.match(k) is not None:
-                #logging.debug("Excluded on match: {} {}".format(re_exp, k))
-                continue # exclude the key
-        for re_exp in re_includes:
-            if re_exp.match(k):
-                new_stats[k] = v
-                #logging.debug("Included on match: {} {}".format(re_exp, k))
-                continue # passed at least one match
+        if any(re_exp.match(k) is not None for re_exp in re_excludes):
+            #logging.debug("Excluded on match: {} {}".format(re_exp, k))
+            continue # exclude the key
+        if any(re_exp.match(k) for re_exp in re_includes):
+            new_stats[k] = v
+            #logging.debug("Included on match: {} {}".format(re_exp, k))
     return new_stats
 
 def augment_raltier1(stats: dict):
-    """Specific addtions/changes for the tier-1 configuration"""
+    """Specific addtions/changes for the tier-1 configuration
+    (now the default rules of xrdreporter.enrich.Enricher, which the handler uses)"""
     
     new_stats = dict(stats)
 
@@ -104,81 +115,159 @@ def augment_raltier1(stats: dict):
 
 class MyUDPRequestHandler(socketserver.DatagramRequestHandler):
     observers = []
+    dispatcher = None # if set, observers are served asynchronously through it
     do_deltas = False
-    last_values = dict()
-    include_fields = ".*"
-    exclude_fields = ""
+    delta_store = DeltaStore()
+    field_filter = FieldFilter(".*", "")
+    enricher = Enricher()
+    parser = 'template'
+    template_cache = TemplateCache()
+    metrics = Metrics()
+    capture = None # CaptureWriter for the raw datagrams, if enabled
+    rollup = None # Rollup that aggregates the stats for its own observers, if enabled
+    changes = None # ChangeFilter, if only changed fields are to be passed on
+    reload = None # callable that starts a reload of the config, if the 'reload' command is enabled
+    worker = None # index of this worker process, when running several
+    merged_stats_path = None # JSON file with the supervisor's merged stats of all the workers
 
-    def __init__(self,*args,**kwargs):
-        self._include_fields = [re.compile(x.strip()) for x in self.include_fields.split(",") if len(x)]
-        self._exclude_fields = [re.compile(x.strip()) for x in self.exclude_fields.split(",") if len(x)]
-        super().__init__(*args,**kwargs)
-
-    def _caclulate_deltas(self, stats: dict):
+    @classmethod
+    def _caclulate_deltas(cls, stats: dict):
         """Determine differences from previous values, if existing"""
-        src = stats.get('src',None)
-        if src is None:
-            raise ValueError("Missing 'src' key")
-
-        if not src in self.last_values:
-            # no previous value, so return
-            return stats
-
-        # get the last values, and calculate differences
-        last = self.last_values[src]
-        new_stats = dict(stats)
-        delta_s = float(stats['tod'] - last['tod'])
-        new_stats['delta_s'] = delta_s
-        if delta_s == 0:
-            # set value to 1 to avoid /0 errors
-            delta_s = 1.
-        for k,v in stats.items():
-            if not isinstance(v,Number):
-                continue
-            new_stats[f'delta_{k}'] = (stats[k] - last[k]) / delta_s
-
-        return new_stats
-        
+        return cls.delta_store.calculate(stats)
 
+    @classmethod
+    def emit(cls, stats: dict):
+        """Pass the dict to all registered observers"""
+        if cls.dispatcher is not None:
+            cls.dispatcher.serve(stats)
+            return
+        for obs in cls.observers:
+            t0 = perf_counter()
+            obs.serve(stats)
+            cls.metrics.histogram('observer__{}'.format(getattr(obs, 'name', obs))).record(perf_counter() - t0)
 
-    # Override the handle() method
-    def handle(self):
-        # Receive and print the datagram received from client
-        # Print the name of the thread
-        logging.debug("Thread Name:{}; Recieved one request from {}"\
-                     .format(threading.current_thread().name,
-                             self.client_address[0]))
+    @classmethod
+    def stats_reply(cls) -> dict:
+        """What to answer 'stats' with: with several workers, the supervisor's latest snapshot
+        merged over all of them (scope 'merged'), otherwise this process's own metrics"""
+        if cls.merged_stats_path is not None:
+            try:
+                with open(cls.merged_stats_path) as f:
+                    stats = json.load(f)
+                stats['scope'] = 'merged'
+                stats['answered_by'] = cls.worker
+                return stats
+            except (OSError, ValueError):
+                pass # the supervisor has not merged anything yet
+        stats = cls.metrics.snapshot()
+        if cls.worker is not None:
+            stats['scope'] = 'worker'
+            stats['worker'] = cls.worker
+        return stats
+
+    @classmethod
+    def prepare(cls, packet: bytes, client_address, socket):
+        """Run a single raw datagram through the parse/filter/augment/deltas chain.
 
-        datagram = self.rfile.readline().decode('utf_8').strip()
+        Returns the stats to pass to the observers, or None if the datagram
+        was a command (ping, stats, reload) or empty. Each stage is timed into the
+        handler's metrics.
+        """
+        metrics = cls.metrics
+        metrics.counter('packets').inc()
+        metrics.counter('bytes').inc(len(packet))
+        t0 = perf_counter()
+        datagram = packet.split(b'\n', 1)[0].decode('utf_8').strip()
         logging.debug("Datagram starts: {}".format(datagram[0:min(len(datagram),20)]))
         if datagram == "ping":
             # self.socket.sendall("pong".encode('utf-8'))
-            logging.info("Ping sent from {}".format(self.client_address))
-            socket = self.request[1]
-            socket.sendto("pong".encode('utf-8'), self.client_address)
-            return 
+            logging.info("Ping sent from {}".format(client_address))
+            socket.sendto("pong".encode('utf-8'), client_address)
+            return None
+        if datagram == "stats":
+            logging.info("Stats requested from {}".format(client_address))
+            socket.sendto(json.dumps(cls.stats_reply()).encode('utf-8'), client_address)
+            return None
+        if datagram == "reload":
+            if cls.reload is None:
+                logging.warning("Reload requested from {}, but the reload command is not enabled".format(client_address))
+                socket.sendto("reload disabled".encode('utf-8'), client_address)
+            else:
+                logging.info("Reload requested from {}".format(client_address))
+                cls.reload()
+                socket.sendto("reloading".encode('utf-8'), client_address)
+            return None
 
         if len(datagram) == 0:
             logging.debug("Message with no data")
-            return
+            return None
+
+        if cls.capture is not None:
+            # keep the raw datagram, so it can be replayed later
+            cls.capture.write(packet, client_address)
 
         # convert the xml into a dict
         try:
-            stats = parse_dom(datagram)
+            if cls.parser == 'template':
+                stats = cls.template_cache.parse(datagram)
+            else:
+                stats = parsers[cls.parser](datagram)
         except Exception as e:
+            metrics.counter('parse_failures').inc()
             raise(e)
+        t1 = perf_counter()
+        metrics.histogram('parse').record(t1 - t0)
 
-        stats = filter_stats(stats, self._include_fields, self._exclude_fields)
+        stats = cls.field_filter.filter(stats)
+        t2 = perf_counter()
+        metrics.histogram('filter').record(t2 - t1)
 
-        # special hacks for the tier1
-        stats = augment_raltier1(stats)
+        # host classification and overrides (by default the tier1 rules), added in place
+        cls.enricher.enrich(stats, client_address)
+        t3 = perf_counter()
+        metrics.histogram('augment').record(t3 - t2)
 
-        if self.do_deltas:
+        if cls.do_deltas:
             # calculate the deltas, and set stats to new dict
-            stats = self._caclulate_deltas(stats)
-            # replace the old value
-            self.last_values[stats['src']] = stats 
+            stats = cls._caclulate_deltas(stats)
+            t4 = perf_counter()
+            metrics.histogram('deltas').record(t4 - t3)
+            t3 = t4
 
-        # pass the dict to all registered observers
-        for obs in self.observers:
-            obs.serve(stats)
+        if cls.rollup is not None:
+            cls.rollup.add(stats)
+            t4 = perf_counter()
+            metrics.histogram('rollup').record(t4 - t3)
+            t3 = t4
+
+        if cls.changes is not None:
+            # drop the fields that have not changed since the last report
+            stats = cls.changes.filter(stats)
+            metrics.histogram('changes').record(perf_counter() - t3)
+        return stats
+
+    @classmethod
+    def process(cls, packet: bytes, client_address, socket):
+        """Run a single raw datagram through the whole chain, including the observers.
+
+        Shared by the per-request handler and the worker-pool server, so the
+        processing does not depend on how the datagram was received.
+        """
+        t0 = perf_counter()
+        stats = cls.prepare(packet, client_address, socket)
+        if stats is None:
+            return
+        t1 = perf_counter()
+        cls.emit(stats)
+        t2 = perf_counter()
+        cls.metrics.histogram('emit').record(t2 - t1)
+        cls.metrics.histogram('total').record(t2 - t0)
+
+    # Override the handle() method
+    def handle(self):
+        # Receive and print the datagram received from client
+        # Print the name of the thread
+        logging.debug("Thread Name:{}; Recieved one request from {}"\
+                     .format(threading.current_thread().name,
+                             self.client_address[0]))
+        self.process(self.packet, self.client_address, self.socket)
@@ -0,0 +1,353 @@
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import itemgetter
+from urllib.parse import parse_qs, urlparse
+
+from xrdreporter.filters import FieldFilter
+from xrdreporter.observers import Observer
+from xrdreporter.xrdLabels import XrdKey
+
+AGGREGATES = ('rate', 'max', 'min', 'mean', 'last', 'pNN (e.g. p95)')
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile (q in 0-1) of sorted values"""
+    return values[min(len(values) - 1, max(0, int(q * len(values) + 0.5) - 1))]
+
+
+class Ring:
+    """The last capacity samples of one source: a time array and one float array per field, preallocated"""
+    __slots__ = ('times', 'columns', 'head', 'count', 'seen', 'layout')
+
+    def __init__(self, capacity: int):
+        self.times = array('d', [math.nan]) * capacity
+        self.columns = {}
+        # (keys of the last sample, getter of the stored fields' values, their columns, whether that is all columns)
+        self.layout = None
+        self.head = 0   # where the next sample goes
+        self.count = 0
+        self.seen = 0.  # monotonic time of the last sample
+
+    def indices(self, capacity: int):
+        """Slots of the stored samples, oldest first"""
+        start = (self.head - self.count) % capacity
+        return [(start + i) % capacity for i in range(self.count)]
+
+
+class RingStore:
+    """Keep the recent numeric fields of every source in memory, in fixed-size ring buffers.
+
+    Each source gets capacity slots; a field's array is allocated (full size) when
+    the source first reports it, so memory is bounded by max_sources * (max_fields + 1)
+    * capacity * 8 bytes. A sample is only stored for numeric fields matching fields.
+    A field missing from a sample keeps the value it had in the source's previous
+    sample, as records may only carry the fields that changed (with [CHANGES]); it is
+    nan only until the source first reports it. Sources not seen for ttl seconds are
+    evicted, as is the least recently seen source beyond max_sources.
+    Samples are keyed by their tod, and time windows in queries are relative to the
+    current time.
+    """
+    def __init__(self, capacity: int = 360, fields: str = '.*', exclude: str = '', max_sources: int = 5000,
+                 max_fields: int = 400, ttl: float = 3600.):
+        self.capacity = capacity
+        self.max_sources = max_sources
+        self.max_fields = max_fields
+        self.ttl = ttl
+        self._select = FieldFilter(fields, exclude)
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = 0.
+        self.samples = 0
+        self.evicted = 0
+        self.fields_dropped = 0
+
+    @classmethod
+    def from_params(cls, params: dict):
+        """From an observer section; retention (seconds) / interval (the report interval) gives the capacity"""
+        retention = float(params.get('retention', 3600))
+        interval = float(params.get('interval', 10))
+        return cls(capacity=max(1, int(math.ceil(retention / interval))),
+                   fields=params.get('fields', '.*'),
+                   exclude=params.get('exclude', ''),
+                   max_sources=int(params.get('max_sources', 5000)),
+                   max_fields=int(params.get('max_fields', 400)),
+                   ttl=float(params.get('ttl', retention)))
+
+    def _layout(self, ring: Ring, keys: tuple, stats: dict) -> tuple:
+        """Work out which columns the fields of a sample with these keys go to; the lock must be held"""
+        names = []
+        columns = []
+        for k, v in self._select.filter(stats).items():
+            if k == XrdKey.TOD or (type(v) is not int and type(v) is not float):
+                continue
+            column = ring.columns.get(k)
+            if column is None:
+                if len(ring.columns) >= self.max_fields:
+                    self.fields_dropped += 1
+                    continue
+                column = ring.columns[k] = array('d', [math.nan]) * self.capacity
+            names.append(k)
+            columns.append(column)
+        if len(names) > 1:
+            getter = itemgetter(*names)
+        elif names:
+            getter = lambda d, k=names[0]: (d[k],)
+        else:
+            getter = lambda d: ()
+        return keys, getter, columns, len(columns) == len(ring.columns)
+
+    def add(self, stats: dict):
+        src = stats.get(XrdKey.SRC)
+        tod = stats.get(XrdKey.TOD)
+        if src is None or type(tod) not in (int, float):
+            return
+        keys = tuple(stats)
+        now = time.monotonic()
+        nan = math.nan
+        with self._lock:
+            ring = self._sources.get(src)
+            if ring is None:
+                ring = self._sources[src] = Ring(self.capacity)
+                if len(self._sources) > self.max_sources:
+                    self._sources.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._sources.move_to_end(src)
+            layout = ring.layout
+            if layout is None or layout[0] != keys:
+                layout = ring.layout = self._layout(ring, keys, stats)
+            _, getter, columns, complete = layout
+            i = ring.head
+            ring.times[i] = tod
+            for column, v in zip(columns, getter(stats)):
+                column[i] = v if type(v) is int or type(v) is float else nan
+            if not complete:
+                # a field this sample does not have carries its previous value forward
+                # (rather than keeping the one from a lap ago)
+                previous = (i - 1) % self.capacity
+                stored = set(map(id, columns))
+                for column in ring.columns.values():
+                    if id(column) not in stored:
+                        column[i] = column[previous] if ring.count else nan
+            ring.head = (i + 1) % self.capacity
+            ring.count = min(ring.count + 1, self.capacity)
+            ring.seen = now
+            self.samples += 1
+            if now >= self._next_sweep:
+                self._next_sweep = now + min(60., self.ttl / 10)
+                self._evict(now)
+
+    def _evict(self, now: float):
+        """Drop the sources that have been idle for ttl; the lock must be held"""
+        while self._sources:
+            src, ring = next(iter(self._sources.items()))
+            if now - ring.seen <= self.ttl:
+                break
+            del self._sources[src]
+            self.evicted += 1
+
+    def _select_sources(self, src: str = None) -> list:
+        pattern = re.compile(src) if src else None
+        with self._lock:
+            return [(s, ring) for s, ring in self._sources.items() if pattern is None or pattern.search(str(s))]
+
+    def _samples(self, ring: Ring, fields: list, start: float = None, end: float = None) -> dict:
+        """{'tod': [...], field: [...]} for the samples of ring in [start, end], with None for missing values"""
+        with self._lock:
+            slots = [i for i in ring.indices(self.capacity)
+                     if (start is None or ring.times[i] >= start) and (end is None or ring.times[i] <= end)]
+            out = {'tod': [ring.times[i] for i in slots]}
+            for k in fields:
+                column = ring.columns.get(k)
+                out[k] = [None if column is None or math.isnan(column[i]) else column[i] for i in slots]
+        return out
+
+    def sources(self) -> dict:
+        """{src: {'samples': n, 'last': tod of the latest sample, 'fields': n}}"""
+        result = {}
+        for src, ring in self._select_sources():
+            with self._lock:
+                last = ring.times[(ring.head - 1) % self.capacity]
+                result[str(src)] = {'samples': ring.count, 'last': last, 'fields': len(ring.columns)}
+        return result
+
+    def latest(self, src: str = None, fields: list = None) -> dict:
+        """{src: {'tod': t, field: value}} of the latest sample of each matching source"""
+        result = {}
+        for s, ring in self._select_sources(src):
+            with self._lock:
+                if not ring.count:
+                    continue
+                i = (ring.head - 1) % self.capacity
+                names = fields if fields else list(ring.columns)
+                values = {'tod': ring.times[i]}
+                for k in names:
+                    column = ring.columns.get(k)
+                    values[k] = None if column is None or math.isnan(column[i]) else column[i]
+            result[str(s)] = values
+        return result
+
+    def slice(self, fields: list, src: str = None, start: float = None, end: float = None) -> dict:
+        """{src: {'tod': [...], field: [...]}} of the samples with start <= tod <= end"""
+        return {str(s): self._samples(ring, fields, start, end) for s, ring in self._select_sources(src)}
+
+    def aggregate(self, field: str, function: str, src: str = None, start: float = None, end: float = None) -> dict:
+        """Apply function to field over [start, end], per source and over all of them.
+
+        rate: (last - first) / time between them, for counters; over all sources, the sum of the rates.
+        max, min, mean, pNN (percentile, e.g. p95) and last: of the samples of a source; over all
+        sources, of all their samples (of the latest samples, for last, and the sum of them as 'sum').
+        """
+        if function not in ('rate', 'max', 'min', 'mean', 'last') and not re.fullmatch(r'p\d{1,2}(\.\d+)?', function):
+            raise ValueError("Unknown function '{}'; use one of {}".format(function, ', '.join(AGGREGATES)))
+        per_source = {}
+        everything = []
+        for s, ring in self._select_sources(src):
+            samples = self._samples(ring, [field], start, end)
+            points = [(t, v) for t, v in zip(samples['tod'], samples[field]) if v is not None]
+            if not points:
+                continue
+            values = [v for _, v in points]
+            if function == 'rate':
+                if len(points) < 2 or points[-1][0] == points[0][0]:
+                    continue
+                value = (points[-1][1] - points[0][1]) / (points[-1][0] - points[0][0])
+                everything.append(value)
+            elif function == 'last':
+                value = values[-1]
+                everything.append(value)
+            else:
+                everything.extend(values)
+                value = self._apply(function, values)
+            per_source[str(s)] = value
+        overall = None
+        if everything:
+            if function == 'rate':
+                overall = sum(everything)
+            elif function == 'last':
+                overall = {'sum': sum(everything), 'max': max(everything), 'min': min(everything)}
+            else:
+                overall = self._apply(function, everything)
+        return {'field': field, 'function': function, 'sources': per_source, 'all': overall}
+
+    @staticmethod
+    def _apply(function: str, values: list) -> float:
+        if function == 'max':
+            return max(values)
+        if function == 'min':
+            return min(values)
+        if function == 'mean':
+            return sum(values) / len(values)
+        return percentile(sorted(values), float(function[1:]) / 100)
+
+    def __len__(self):
+        return len(self._sources)
+
+    def stats(self) -> dict:
+        with self._lock:
+            fields = sum(len(ring.columns) for ring in self._sources.values())
+            return {'sources': len(self._sources),
+                    'samples': self.samples,
+                    'evicted': self.evicted,
+                    'fields_dropped': self.fields_dropped,
+                    'bytes': 8 * self.capacity * (fields + len(self._sources)),
+                    }
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """GET /sources, /latest, /slice and /aggregate, with query parameters:
+    src (regex), fields (comma separated), field and fn (for /aggregate), and the window as
+    minutes (back from now) or start/end (unix times)"""
+    store = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        fields = [x.strip() for x in query.get('fields', '').split(",") if len(x.strip())]
+        try:
+            start = float(query['start']) if 'start' in query else None
+            end = float(query['end']) if 'end' in query else None
+            if 'minutes' in query:
+                start = time.time() - 60 * float(query['minutes'])
+            src = query.get('src')
+            if url.path == '/sources':
+                result = self.store.sources()
+            elif url.path == '/latest':
+                result = self.store.latest(src, fields)
+            elif url.path == '/slice':
+                if not fields:
+                    raise ValueError("fields is required")
+                result = self.store.slice(fields, src, start, end)
+            elif url.path == '/aggregate':
+                if 'field' not in query:
+                    raise ValueError("field is required")
+                result = self.store.aggregate(query['field'], query.get('fn', 'max'), src, start, end)
+            elif url.path == '/stats':
+                result = self.store.stats()
+            else:
+                self._reply(404, {'error': 'use /sources, /latest, /slice, /aggregate or /stats'})
+                return
+        except (ValueError, re.error) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        self._reply(200, result)
+
+    def _reply(self, status: int, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Query from {}: {}".format(self.address_string(), format % args))
+
+
+def serve_queries(store: RingStore, address: tuple) -> ThreadingHTTPServer:
+    """Start an HTTP server for queries of store, on a background thread"""
+    handler = type('BoundQueryHandler', (QueryHandler,), {'store': store})
+    server = ThreadingHTTPServer(address, handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='xrdrep-ringquery', daemon=True).start()
+    return server
+
+
+class RingBufferObserver(Observer):
+    """Keep the recent numeric fields of each source in memory (see RingStore),
+    and answer queries about them over HTTP on http_address:http_port.
+    With several worker processes, worker n listens on http_port + n.
+    """
+    nonblocking = True
+
+    def __init__(self, params):
+        super().__init__()
+        self.store = RingStore.from_params(params)
+        self.server = None
+        if params.get('http_port'):
+            port = int(params['http_port']) + int(os.environ.get('XRDREP_WORKER', '0'))
+            self.server = serve_queries(self.store, (params.get('http_address', '127.0.0.1'), port))
+            logging.info("{} answering queries on {}:{}".format(self, *self.server.server_address[:2]))
+
+    def serve(self, data: dict):
+        self.store.add(data)
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def stats(self) -> dict:
+        return self.store.stats()
+
+    def __str__(self):
+        return "RingBuffer({} samples)".format(self.store.capacity)
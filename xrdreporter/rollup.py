@@ -0,0 +1,253 @@
+import logging
+import threading
+import time
+from collections import deque
+from socket import getfqdn
+
+from xrdreporter.filters import FieldFilter
+
+FUNCTIONS = ('sum', 'mean', 'max', 'rate')
+
+
+class Rollup:
+    """Aggregate the processed stats into per-group windows, and pass the rollups to a set of observers.
+
+    Records are grouped by the values of the group_by keys (e.g. site, host_type),
+    and for every numeric field matching the fields patterns the sum, number of
+    samples and maximum are kept, overall and per source. Records go into buckets
+    of slide seconds by their tod, so windows follow the time the stats were
+    reported, also when replaying a capture. When a bucket ends, one record per
+    group is emitted, covering the last window seconds: a tumbling window when
+    slide equals window, otherwise a sliding one. Each record has
+    <field>__<function> for the chosen functions, where rate is the sum over the
+    sources of each source's mean over the window; as the delta_ fields are already
+    per-second rates, for them this is the total rate of the group.
+    A bucket is closed lateness seconds after it ends, in terms of the latest tod
+    seen, which moves on with the clock while no records arrive. Records for a
+    bucket that was already closed are counted as late and dropped; a tod in the
+    future is taken as the current time.
+    """
+    def __init__(self, observers, group_by=('site', 'host_type'), fields: str = 'delta_.*',
+                 functions=FUNCTIONS, window: float = 60., slide: float = None, max_groups: int = 10000,
+                 lateness: float = 5.):
+        slide = window if slide is None else slide
+        if window <= 0 or slide <= 0:
+            raise ValueError("window and slide must be positive")
+        n_buckets = round(window / slide)
+        if n_buckets < 1 or abs(n_buckets * slide - window) > 1e-6:
+            raise ValueError("window ({}) must be a multiple of slide ({})".format(window, slide))
+        unknown = set(functions) - set(FUNCTIONS)
+        if unknown:
+            raise ValueError("Unknown rollup functions {}; use some of {}".format(sorted(unknown), FUNCTIONS))
+        self.observers = list(observers)
+        self.group_by = tuple(group_by)
+        self.fields = fields
+        self.functions = tuple(functions)
+        self.window = window
+        self.slide = slide
+        self.max_groups = max_groups
+        self.lateness = lateness
+        self.src = '{}:rollup'.format(getfqdn())
+        self._select = FieldFilter(fields, '')
+
+        self._lock = threading.Lock()
+        # bucket start -> {group values -> [set of src, number of records, {field: [sum, samples, max, {src: [sum, samples]}]}]}
+        self._open = {}
+        # start of the next bucket to close; None until the first record, and after a gap in the records
+        self._next_start = None
+        # closed buckets that may still be inside a window: (start, groups)
+        self._closed = deque(maxlen=n_buckets)
+        # latest tod seen, and the time.time() it was seen at
+        self._watermark = None
+        self._watermark_at = 0.
+        self.windows = 0
+        self.emitted = 0
+        self.dropped = 0
+        self.late = 0
+        self.errors = 0
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='xrdrep-rollup', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_config(cls, section, observers):
+        """Create from a [ROLLUP] config section"""
+        def names(value):
+            return [x.strip() for x in value.split(",") if len(x.strip())]
+        return cls(observers,
+                   group_by=names(section.get('group_by', 'site, host_type')),
+                   fields=section.get('fields', 'delta_.*'),
+                   functions=names(section.get('functions', ','.join(FUNCTIONS))),
+                   window=section.getfloat('window', 60.),
+                   slide=section.getfloat('slide', None),
+                   max_groups=section.getint('max_groups', 10000),
+                   lateness=section.getfloat('lateness', 5.))
+
+    def add(self, stats: dict):
+        group = tuple(stats.get(k) for k in self.group_by)
+        selected = self._select.filter(stats)
+        src = stats.get('src')
+        now = time.time()
+        tod = stats.get('tod')
+        if (type(tod) is not int and type(tod) is not float) or tod > now:
+            tod = now
+        start = (tod // self.slide) * self.slide
+        with self._lock:
+            if self._watermark is None or tod > self._watermark:
+                self._watermark = tod
+                self._watermark_at = now
+            if self._next_start is None:
+                self._next_start = start
+            elif start < self._next_start:
+                self.late += 1
+                return
+            groups = self._open.get(start)
+            if groups is None:
+                groups = self._open[start] = {}
+            entry = groups.get(group)
+            if entry is None:
+                if len(groups) >= self.max_groups:
+                    self.dropped += 1
+                    return
+                entry = groups[group] = [set(), 0, {}]
+            entry[0].add(src)
+            entry[1] += 1
+            acc = entry[2]
+            for k, v in selected.items():
+                if type(v) is not int and type(v) is not float:
+                    continue
+                a = acc.get(k)
+                if a is None:
+                    acc[k] = [v, 1, v, {src: [v, 1]}]
+                    continue
+                a[0] += v
+                a[1] += 1
+                if v > a[2]:
+                    a[2] = v
+                per_source = a[3].get(src)
+                if per_source is None:
+                    a[3][src] = [v, 1]
+                else:
+                    per_source[0] += v
+                    per_source[1] += 1
+
+    def _event_time(self):
+        """The latest tod seen, moved on by the time since it was seen; None before the first record"""
+        with self._lock:
+            if self._watermark is None:
+                return None
+            return self._watermark + (time.time() - self._watermark_at)
+
+    def _close_buckets(self, now: float) -> list:
+        """Close every bucket that ended lateness seconds before now; returns the records of each window ending there"""
+        windows = []
+        with self._lock:
+            while self._next_start is not None and self._next_start + self.slide + self.lateness <= now:
+                start = self._next_start
+                end = start + self.slide
+                self._closed.append((start, self._open.pop(start, {})))
+                buckets = [groups for s, groups in self._closed if s >= end - self.window - 1e-9]
+                first = min(s for s, _ in self._closed if s >= end - self.window - 1e-9)
+                windows.append((end, end - first, buckets))
+                if end not in self._open and not any(groups for s, groups in self._closed if s > end - self.window + 1e-9):
+                    # nothing for the coming windows: skip ahead to the next bucket with records
+                    self._next_start = min(self._open) if self._open else None
+                else:
+                    self._next_start = end
+        return [self._window_records(buckets, end, duration) for end, duration, buckets in windows
+                if any(buckets)]
+
+    def _window_records(self, buckets: list, end: float, duration: float) -> list:
+        merged = {}
+        for groups in buckets:
+            for group, (sources, records, acc) in groups.items():
+                entry = merged.get(group)
+                if entry is None:
+                    entry = merged[group] = [set(), 0, {}]
+                entry[0] |= sources
+                entry[1] += records
+                for k, (s, n, m, per_source) in acc.items():
+                    a = entry[2].get(k)
+                    if a is None:
+                        entry[2][k] = [s, n, m, {src: list(v) for src, v in per_source.items()}]
+                        continue
+                    a[0] += s
+                    a[1] += n
+                    if m > a[2]:
+                        a[2] = m
+                    for src, (ss, sn) in per_source.items():
+                        b = a[3].get(src)
+                        if b is None:
+                            a[3][src] = [ss, sn]
+                        else:
+                            b[0] += ss
+                            b[1] += sn
+        return [self._record(group, entry, end, duration) for group, entry in merged.items()]
+
+    def _record(self, group: tuple, entry: list, end: float, duration: float) -> dict:
+        sources, records, acc = entry
+        record = {'src': self.src, 'pgm': 'xrdreporter', 'ins': 'rollup', 'tod': int(end)}
+        record.update((k, v) for k, v in zip(self.group_by, group) if v is not None)
+        record['rollup_window'] = round(duration, 3)
+        record['rollup_sources'] = len(sources)
+        record['rollup_records'] = records
+        functions = self.functions
+        for k, (s, n, m, per_source) in acc.items():
+            if 'sum' in functions:
+                record[k + '__sum'] = s
+            if 'mean' in functions:
+                record[k + '__mean'] = s / n
+            if 'max' in functions:
+                record[k + '__max'] = m
+            if 'rate' in functions:
+                record[k + '__rate'] = sum(ss / sn for ss, sn in per_source.values())
+        return record
+
+    def _emit(self, records: list):
+        if not records:
+            return
+        self.windows += 1
+        self.emitted += len(records)
+        for obs in self.observers:
+            try:
+                self.errors += obs.serve_batch(records) or 0
+            except Exception as e:
+                self.errors += len(records)
+                logging.error("Observer {} failed to take rollups: {}".format(getattr(obs, 'name', obs), e))
+
+    def _run(self):
+        while not self._stop.wait(min(1., self.slide)):
+            now = self._event_time()
+            if now is None:
+                continue
+            try:
+                for records in self._close_buckets(now):
+                    self._emit(records)
+            except Exception as e:
+                logging.error("Failed to emit rollups: {}".format(e))
+
+    def close(self):
+        """Stop, and emit the rollups of the buckets still open"""
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            last = max(self._open) if self._open else None
+        if last is not None:
+            for records in self._close_buckets(last + self.slide + self.lateness):
+                self._emit(records)
+
+    def stats(self) -> dict:
+        with self._lock:
+            groups = sum(len(groups) for groups in self._open.values())
+        return {'groups': groups,
+                'windows': self.windows,
+                'emitted': self.emitted,
+                'dropped': self.dropped,
+                'late': self.late,
+                'errors': self.errors,
+                }
+
+    def __str__(self):
+        return "Rollup(group_by={}, fields={}, window={}, slide={})".format(
+               ",".join(self.group_by), self.fields, self.window, self.slide)
@@ -0,0 +1,217 @@
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+# overflow policies for the bounded ingest queue
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+OVERFLOW_POLICIES = (DROP_NEWEST, DROP_OLDEST)
+
+
+def set_rcvbuf(sock, size: int):
+    """Ask for a socket receive buffer of size bytes, so bursts are queued rather than dropped by the kernel.
+
+    The kernel caps the size at net.core.rmem_max; a warning is logged if
+    the buffer ends up smaller than requested.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    # linux reports twice the usable size, to account for its bookkeeping
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if actual < size:
+        logging.warning("Socket receive buffer is {} bytes, less than the {} requested; "
+                        "raise net.core.rmem_max to allow more".format(actual, size))
+    else:
+        logging.info("Socket receive buffer is {} bytes".format(actual))
+
+
+def udp_socket_stats(sock) -> dict:
+    """Receive queue (bytes) and kernel drop count of a UDP socket, from /proc/net/udp[6].
+
+    Drops counted here are datagrams lost because the receive buffer was full,
+    before the collector ever saw them. Returns {} where /proc is not available.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except OSError:
+        return {}
+    for table in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(table) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 13 and fields[9] == inode:
+                        return {'rx_queue': int(fields[4].split(':')[1], 16),
+                                'drops': int(fields[12])}
+        except OSError:
+            continue
+    return {}
+
+
+class ReusePortThreadingUDPServer(socketserver.ThreadingUDPServer):
+    """ThreadingUDPServer whose socket can share its port with other processes (SO_REUSEPORT).
+
+    The kernel then spreads incoming datagrams over the processes by source address.
+    """
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class WorkerPoolUDPServer:
+    """UDP server with a single socket reader and a fixed pool of worker threads.
+
+    Datagrams are read from the socket by the thread calling serve_forever() and
+    placed on a bounded queue; the workers take them off the queue and pass them
+    to handler_class.process(). When the queue is full the overflow policy decides
+    whether the new datagram, or the oldest queued one, is dropped.
+    The interface mirrors socketserver.UDPServer, so either can be used by xrdrep.py
+    """
+    max_packet_size = 65535
+    poll_interval = 0.5
+
+    def __init__(self, server_address, handler_class, pool_size: int = 4,
+                 queue_size: int = 1000, overflow: str = DROP_NEWEST, metrics=None, reuse_port: bool = False,
+                 rcvbuf: int = 0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '{}'; use one of {}".format(overflow, OVERFLOW_POLICIES))
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        if queue_size < 1:
+            # queue.Queue would take 0 or less as unbounded
+            raise ValueError("queue_size must be at least 1")
+        self.handler_class = handler_class
+        self.pool_size = pool_size
+        self.overflow = overflow
+        # time datagrams spend waiting for a worker
+        self.queue_wait = None if metrics is None else metrics.histogram('queue_wait')
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if rcvbuf:
+            set_rcvbuf(self.socket, rcvbuf)
+        self.socket.bind(server_address)
+        self.socket.settimeout(self.poll_interval)
+        self.server_address = self.socket.getsockname()
+
+        self._workers = []
+        self._shutdown = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        # reader-side counters are only touched by the reader thread
+        self.received = 0
+        self.dropped_newest = 0
+        self.dropped_oldest = 0
+        # worker-side counters are updated under the lock
+        self.processed = 0
+        self.errors = 0
+
+    def _start_workers(self):
+        for i in range(self.pool_size):
+            t = threading.Thread(target=self._worker, name='xrdrep-worker-{}'.format(i), daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                # sentinel from shutdown()
+                break
+            packet, client_address, received = item
+            if self.queue_wait is not None:
+                self.queue_wait.record(time.monotonic() - received)
+            try:
+                self.handler_class.process(packet, client_address, self.socket)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                logging.error("Error processing datagram from {}: {}".format(client_address, e))
+
+    def _enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        if self.overflow == DROP_NEWEST:
+            self.dropped_newest += 1
+            return
+        # drop-oldest; a worker may have freed a slot in the meantime, so just retry
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.dropped_oldest += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                continue
+
+    def serve_forever(self):
+        """Read datagrams until shutdown() is called"""
+        self._start_workers()
+        logging.info("Serving on {} with {} workers, queue size {} ({})".format(
+                     self.server_address, self.pool_size, self.queue.maxsize, self.overflow))
+        try:
+            while not self._shutdown.is_set():
+                try:
+                    packet, client_address = self.socket.recvfrom(self.max_packet_size)
+                except socket.timeout:
+                    continue
+                except OSError as e:
+                    if self._shutdown.is_set():
+                        break
+                    logging.error("Socket error: {}".format(e))
+                    continue
+                self.received += 1
+                self._enqueue((packet, client_address, time.monotonic()))
+        finally:
+            self._stop_workers()
+            self._stopped.set()
+
+    def _stop_workers(self):
+        # let the workers finish what has been queued, then stop them
+        for _ in self._workers:
+            self.queue.put(None)
+        for t in self._workers:
+            t.join()
+        self._workers = []
+        logging.info("Worker pool stopped: {}".format(self.stats()))
+
+    def shutdown(self):
+        """Stop the serve_forever loop and wait until it has finished"""
+        self._shutdown.set()
+        self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            processed, errors = self.processed, self.errors
+        stats = {'received': self.received,
+                 'processed': processed,
+                 'errors': errors,
+                 'dropped_newest': self.dropped_newest,
+                 'dropped_oldest': self.dropped_oldest,
+                 'queue_depth': self.queue.qsize(),
+                 }
+        stats.update(udp_socket_stats(self.socket))
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.server_close()
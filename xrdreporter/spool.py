@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+
+SUFFIX = '.spool'
+POSITION = 'position'
+DEAD_LETTER = 'dead-letter.jsonl'
+
+
+class Spool:
+    """Write-ahead spool of batches that could not be written, kept on local disk until they can be replayed.
+
+    Each batch is appended as one line of JSON to segment files in directory,
+    named by sequence number; a new segment is started every segment_size bytes.
+    When the spool grows beyond max_bytes, the oldest segments are deleted
+    (and their batches counted as evicted). Batches are read back oldest first
+    with peek(), and commit() moves past the one returned; fully replayed
+    segments are deleted, and the read position is kept in a file so a restart
+    resumes where replay stopped.
+    Batches the sink rejected for good are moved to a dead letter file in the same
+    directory (one JSON line per batch, up to max_bytes), where they are kept for
+    inspection but never replayed; once it is full, further rejected batches are
+    dropped and counted as dead_letter_dropped.
+    A Spool is used by a single thread, that of the BatchWriter it belongs to.
+    """
+    def __init__(self, directory: str, max_bytes: int = 1 << 30, segment_size: int = 16 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+
+        # sequence number -> [size in bytes, number of batches]
+        self._segments = {}
+        for name in os.listdir(directory):
+            if name.endswith(SUFFIX) and name[:-len(SUFFIX)].isdigit():
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    batches = sum(1 for _ in f)
+                self._segments[int(name[:-len(SUFFIX)])] = [os.path.getsize(path), batches]
+        self._next_seq = max(self._segments, default=0) + 1
+        self._write_seq = None
+        self._write_file = None
+
+        self._read_seq = None
+        self._read_file = None
+        self._read_offset = 0
+        self._peeked = None
+        self._load_position()
+
+        self.appended = 0
+        self.replayed = 0
+        self.evicted = 0
+        self.corrupt = 0
+        self.dead_lettered = 0
+        self.dead_letter_dropped = 0
+        if self._segments:
+            logging.info("Spool {} has {} batches waiting to be replayed".format(directory, self.pending()))
+
+    @classmethod
+    def from_params(cls, params: dict):
+        """Spool for an observer config section with spool_dir set, otherwise None.
+        '{worker}' in spool_dir is replaced by the worker process index, so each worker has its own spool"""
+        directory = params.get('spool_dir')
+        if not directory:
+            return None
+        directory = directory.replace('{worker}', os.environ.get('XRDREP_WORKER', '0'))
+        return cls(directory,
+                   max_bytes=int(params.get('spool_max_bytes', 1 << 30)),
+                   segment_size=int(params.get('spool_segment_size', 16 << 20)))
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, '{:010d}{}'.format(seq, SUFFIX))
+
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION)) as f:
+                position = json.load(f)
+            if position['segment'] in self._segments:
+                self._read_seq = position['segment']
+                self._read_offset = position['offset']
+                # the batches before the position were replayed already
+                with open(self._path(self._read_seq), 'rb') as f:
+                    f.seek(self._read_offset)
+                    self._segments[self._read_seq][1] = sum(1 for _ in f)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save_position(self):
+        path = os.path.join(self.directory, POSITION)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'segment': self._read_seq, 'offset': self._read_offset}, f)
+        os.replace(path + '.tmp', path)
+
+    def append(self, batch: list):
+        """Add a batch to the end of the spool"""
+        line = (json.dumps(batch) + '\n').encode('utf-8')
+        if self._write_file is None or self._segments[self._write_seq][0] >= self.segment_size:
+            if self._write_file is not None:
+                self._write_file.close()
+            self._write_seq = self._next_seq
+            self._next_seq += 1
+            self._write_file = open(self._path(self._write_seq), 'ab')
+            self._segments[self._write_seq] = [0, 0]
+        self._write_file.write(line)
+        self._write_file.flush()
+        self._segments[self._write_seq][0] += len(line)
+        self._segments[self._write_seq][1] += 1
+        self.appended += 1
+        self._enforce_limit()
+
+    def _enforce_limit(self):
+        while self.size() > self.max_bytes and len(self._segments) > 1:
+            seq = min(self._segments)
+            if seq == self._write_seq:
+                break
+            size, batches = self._segments.pop(seq)
+            if seq == self._read_seq:
+                self._close_reader()
+                self._read_seq = None
+                self._read_offset = 0
+            self.evicted += batches
+            os.remove(self._path(seq))
+            logging.warning("Spool {} is over {} bytes; dropped its oldest {} batches".format(
+                            self.directory, self.max_bytes, batches))
+
+    def _close_reader(self):
+        if self._read_file is not None:
+            self._read_file.close()
+            self._read_file = None
+        self._peeked = None
+
+    def _remove_segment(self, seq: int):
+        self._segments.pop(seq, None)
+        if seq == self._write_seq:
+            self._write_file.close()
+            self._write_file = None
+            self._write_seq = None
+        os.remove(self._path(seq))
+
+    def peek(self):
+        """The oldest batch not yet replayed, or None if the spool is empty"""
+        if self._peeked is not None:
+            return self._peeked[0]
+        while self._segments:
+            if self._read_seq is None or self._read_seq not in self._segments:
+                self._close_reader()
+                self._read_seq = min(self._segments)
+                self._read_offset = 0
+            if self._read_file is None:
+                self._read_file = open(self._path(self._read_seq), 'rb')
+                self._read_file.seek(self._read_offset)
+            line = self._read_file.readline()
+            if line.endswith(b'\n'):
+                try:
+                    batch = json.loads(line)
+                except ValueError:
+                    self.corrupt += 1
+                    self._read_offset += len(line)
+                    continue
+                self._peeked = (batch, len(line))
+                return batch
+            if self._read_seq == self._write_seq:
+                # caught up with the writer: everything has been replayed
+                self._close_reader()
+                self._remove_segment(self._read_seq)
+                self._read_seq = None
+                self._read_offset = 0
+                self._save_position()
+                return None
+            # end of a completed segment (possibly with a partial last line, after a crash)
+            if line:
+                self.corrupt += 1
+            self._close_reader()
+            self._remove_segment(self._read_seq)
+            self._read_seq = None
+            self._read_offset = 0
+        return None
+
+    def commit(self):
+        """Mark the batch returned by peek() as replayed"""
+        if self._peeked is None:
+            return
+        self._read_offset += self._peeked[1]
+        self._peeked = None
+        self._segments[self._read_seq][1] -= 1
+        self.replayed += 1
+        self._save_position()
+
+    def dead_letter(self, batch: list) -> bool:
+        """Keep a batch the sink will not accept, apart from the batches to replay;
+        returns False if it was dropped because the dead letter file is full"""
+        path = os.path.join(self.directory, DEAD_LETTER)
+        line = (json.dumps(batch) + '\n').encode('utf-8')
+        try:
+            if os.path.getsize(path) + len(line) > self.max_bytes:
+                logging.warning("Dead letter file {} is full; dropping a batch of {}".format(path, len(batch)))
+                self.dead_letter_dropped += 1
+                return False
+        except OSError:
+            pass # no dead letters yet
+        with open(path, 'ab') as f:
+            f.write(line)
+        self.dead_lettered += 1
+        return True
+
+    def reject(self):
+        """Move the batch returned by peek() to the dead letter file, and go on to the next"""
+        if self._peeked is None:
+            return
+        self.dead_letter(self._peeked[0])
+        self._read_offset += self._peeked[1]
+        self._peeked = None
+        self._segments[self._read_seq][1] -= 1
+        self._save_position()
+
+    def size(self) -> int:
+        """Bytes on disk"""
+        return sum(size for size, _ in list(self._segments.values()))
+
+    def pending(self) -> int:
+        """Batches waiting to be replayed"""
+        return sum(batches for _, batches in list(self._segments.values()))
+
+    def close(self):
+        self._close_reader()
+        if self._write_file is not None:
+            self._write_file.close()
+            self._write_file = None
+        self._save_position()
+
+    def stats(self) -> dict:
+        return {'bytes': self.size(),
+                'segments': len(self._segments),
+                'pending': self.pending(),
+                'appended': self.appended,
+                'replayed': self.replayed,
+                'evicted': self.evicted,
+                'corrupt': self.corrupt,
+                'dead_lettered': self.dead_lettered,
+                'dead_letter_dropped': self.dead_letter_dropped,
+                }
+
+    def __str__(self):
+        return "Spool({}, max_bytes={})".format(self.directory, self.max_bytes)
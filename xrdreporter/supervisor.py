@@ -0,0 +1,212 @@
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from collections import deque
+
+from xrdreporter.metrics import merge_exports
+
+
+class MetricsPublisher:
+    """Periodically send a worker process's Metrics.export() to the supervisor"""
+    def __init__(self, index: int, metrics, metrics_queue, interval: float = 10.):
+        self.index = index
+        self.metrics = metrics
+        self.queue = metrics_queue
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='xrdrep-metrics-publisher', daemon=True)
+        self._thread.start()
+
+    def publish(self):
+        try:
+            self.queue.put_nowait((self.index, self.metrics.export()))
+        except queue.Full:
+            pass
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.publish()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        # so the supervisor has the final numbers
+        self.publish()
+
+
+class Supervisor:
+    """Run n_workers copies of target(index, metrics_queue) in separate processes, restarting any that die.
+
+    Each worker is expected to bind its own socket with SO_REUSEPORT, build its own
+    observers and keep its own delta state, and to send Metrics.export() snapshots
+    on metrics_queue; the supervisor merges the latest snapshot of every worker and
+    logs the result every log_interval seconds and when it stops. The merged snapshot
+    is also kept up to date in the JSON file stats_path, whose location is passed to
+    the workers in XRDREP_STATS_FILE, so whichever worker is asked can answer with it.
+    A SIGHUP is passed on to every worker, so they all reload their config.
+    A worker that dies is restarted after restart_delay seconds, doubling with every
+    further failure within failure_window seconds up to max_restart_delay; after
+    max_failures failures of one worker within failure_window, the supervisor stops
+    all workers and run() returns False.
+    """
+    def __init__(self, n_workers: int, target, restart_delay: float = 1., log_interval: float = 300.,
+                 max_restart_delay: float = 60., max_failures: int = 5, failure_window: float = 300.):
+        self.n_workers = n_workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.log_interval = log_interval
+        self._context = multiprocessing.get_context('fork')
+        self.metrics_queue = self._context.Queue(maxsize=1000)
+        self.workers = [None] * n_workers
+        self.restarts = [0] * n_workers
+        # when each worker died recently, and when it is due to be restarted (None while it runs)
+        self._failures = [deque() for _ in range(n_workers)]
+        self._restart_at = [None] * n_workers
+        self.latest = {}
+        self.stats_path = os.path.join(tempfile.mkdtemp(prefix='xrdrep-'), 'stats.json')
+        self._stopping = False
+
+    def _start(self, index: int):
+        p = self._context.Process(target=self._run_worker, args=(index,), name='xrdrep-worker-{}'.format(index))
+        p.start()
+        self.workers[index] = p
+        logging.info("Started worker {} (pid {})".format(index, p.pid))
+
+    def _run_worker(self, index: int):
+        # let SIGTERM unwind the worker the same way as Ctrl-C, so observers are flushed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        # until the worker installs its own handler, a SIGHUP (config reload) must not stop it
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # so per-worker resources, such as observer spools, can be told apart
+        os.environ['XRDREP_WORKER'] = str(index)
+        os.environ['XRDREP_STATS_FILE'] = self.stats_path
+        try:
+            self.target(index, self.metrics_queue)
+        except KeyboardInterrupt:
+            pass
+
+    def _check_workers(self) -> bool:
+        """Schedule the restart of workers that died, and start those that are due;
+        returns False if a worker failed too often to keep trying"""
+        now = time.monotonic()
+        for index, p in enumerate(self.workers):
+            if p is None or p.is_alive() or self._stopping:
+                continue
+            if self._restart_at[index] is None:
+                failures = self._failures[index]
+                failures.append(now)
+                while failures[0] < now - self.failure_window:
+                    failures.popleft()
+                if len(failures) >= self.max_failures:
+                    logging.error("Worker {} (pid {}) exited with code {}, {} times in {:g} s; giving up".format(
+                                  index, p.pid, p.exitcode, len(failures), self.failure_window))
+                    return False
+                delay = min(self.restart_delay * 2 ** (len(failures) - 1), self.max_restart_delay)
+                logging.error("Worker {} (pid {}) exited with code {}; restarting in {:g} s".format(
+                              index, p.pid, p.exitcode, delay))
+                self._restart_at[index] = now + delay
+            if now >= self._restart_at[index]:
+                self._restart_at[index] = None
+                self.restarts[index] += 1
+                self._start(index)
+        return True
+
+    def _drain_metrics(self, timeout: float) -> bool:
+        """Collect the snapshots the workers sent; returns whether there were any"""
+        received = False
+        try:
+            index, export = self.metrics_queue.get(timeout=timeout)
+            self.latest[index] = export
+            received = True
+            while True:
+                index, export = self.metrics_queue.get_nowait()
+                self.latest[index] = export
+        except queue.Empty:
+            pass
+        return received
+
+    def _write_stats(self):
+        """Replace the stats file with the current merged snapshot, without readers ever seeing half of it"""
+        stats = self.stats()
+        stats['updated'] = time.time()
+        tmp = self.stats_path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp, self.stats_path)
+        except OSError as e:
+            logging.warning("Could not write the merged stats to {}: {}".format(self.stats_path, e))
+
+    def stats(self) -> dict:
+        """Self-metrics merged over the latest snapshot from every worker"""
+        merged = merge_exports([self.latest[i] for i in sorted(self.latest)])
+        merged['gauges']['supervisor'] = {'workers': sum(1 for p in self.workers if p is not None and p.is_alive()),
+                                          'restarts': sum(self.restarts)}
+        return merged
+
+    def run(self) -> bool:
+        """Start the workers and supervise them until interrupted; returns False if it gave up on a failing worker"""
+        def terminate(signum, frame):
+            # unlike Ctrl-C, SIGTERM is only sent to us; pass it on to the workers
+            self._terminate_workers = True
+            raise KeyboardInterrupt
+        def reload(signum, frame):
+            # the workers each re-read the config files
+            logging.info("Passing SIGHUP on to the workers, to reload the configuration")
+            for p in self.workers:
+                if p is not None and p.is_alive():
+                    os.kill(p.pid, signal.SIGHUP)
+        self._terminate_workers = False
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGHUP, reload)
+
+        for index in range(self.n_workers):
+            self._start(index)
+        last_log = time.monotonic()
+        ok = True
+        try:
+            while True:
+                if self._drain_metrics(timeout=1.):
+                    self._write_stats()
+                if not self._check_workers():
+                    ok = False
+                    self._terminate_workers = True
+                    break
+                if time.monotonic() - last_log >= self.log_interval:
+                    logging.info("Merged worker stats: {}".format(json.dumps(self.stats())))
+                    last_log = time.monotonic()
+        except KeyboardInterrupt:
+            logging.info("Stopping workers")
+        finally:
+            self._stopping = True
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            if self._terminate_workers:
+                for p in self.workers:
+                    if p is not None and p.is_alive():
+                        p.terminate()
+            # give the workers time to flush their observers
+            deadline = time.monotonic() + 30
+            while any(p is not None and p.is_alive() for p in self.workers) and time.monotonic() < deadline:
+                self._drain_metrics(timeout=0.2)
+            for p in self.workers:
+                if p is not None and p.is_alive():
+                    logging.warning("Worker {} did not stop; killing it".format(p.name))
+                    p.kill()
+                if p is not None:
+                    p.join(1)
+            self._drain_metrics(timeout=0.1)
+            logging.info("Final merged worker stats: {}".format(json.dumps(self.stats())))
+            shutil.rmtree(os.path.dirname(self.stats_path), ignore_errors=True)
+        return ok
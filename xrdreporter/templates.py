@@ -0,0 +1,259 @@
+import re
+import threading
+from collections import OrderedDict
+
+from xrdreporter.xmlparse import _CACHE_HITS, _RE_CACHE_HITS, _key, parse_expat, to_number
+
+# markup and text of a packet, in document order
+_TOKEN = re.compile(r'<[^>]*>|[^<]+')
+_TAG_NAME = re.compile(r'</?([^\s/>]+)')
+_ATTR = re.compile(r'([^\s=]+)\s*=\s*"([^"]*)"')
+_SRC = re.compile(r'\ssrc="([^"]*)"')
+# the structure of a packet: everything but text and root attribute values
+_TEXT_NODE = re.compile(r'>[^<]+<')
+_ATTR_VALUE = re.compile(r'"[^"]*"')
+
+# values containing entities or markup do not match, and go through the full parser
+_VALUE = '([^<&]*)'
+_ATTR_VALUE_GROUP = '"([^"<&]*)"'
+# ... apart from cache hits, whose value has an extraneous '>' (escaped) at the end
+_HITS_VALUE = '([^<]*)'
+
+_INT, _NUMBER, _STR, _HITS = 'int', 'number', 'str', 'hits'
+
+
+def fingerprint(dataraw: str) -> str:
+    """The packet without its values (text, and attributes of the root element); equal for packets with the same structure"""
+    end = dataraw.find('>')
+    return _ATTR_VALUE.sub('""', dataraw[:end]) + _TEXT_NODE.sub('><', dataraw[end:])
+
+
+class Template:
+    """Compiled layout of one packet structure.
+
+    regex matches any packet with the same elements and attributes, with a group
+    for every value; keys and kinds give the flat key and the type of each group,
+    in the order parse_expat would produce them.
+    """
+    def __init__(self, regex, keys: list, kinds: list, strings: dict):
+        self.regex = re.compile(regex, re.DOTALL)
+        self.keys = keys
+        self.int_keys = [k for k, t in zip(keys, kinds) if t == _INT]
+        self.number_keys = [k for k, t in zip(keys, kinds) if t == _NUMBER]
+        self.hits_keys = [k for k, t in zip(keys, kinds) if t == _HITS]
+        # text values seen when the template was built; unchanged ones need no conversion
+        self.strings = strings
+
+    def match(self, dataraw: str):
+        return self.regex.fullmatch(dataraw)
+
+    def extract(self, match) -> dict:
+        data = dict(zip(self.keys, match.groups()))
+        for k in self.int_keys:
+            try:
+                data[k] = int(data[k])
+            except ValueError:
+                data[k] = to_number(data[k])
+        for k in self.number_keys:
+            data[k] = to_number(data[k])
+        for k in self.hits_keys:
+            data[k] = to_number(_RE_CACHE_HITS.match(data[k]).group(1))
+        for k, v in self.strings.items():
+            if data[k] != v:
+                data[k] = to_number(data[k])
+        return data
+
+
+def _kind(key, value):
+    if key == _CACHE_HITS:
+        return _HITS
+    if type(value) is int:
+        return _INT
+    if type(value) is float:
+        return _NUMBER
+    return _STR
+
+
+def build_template(dataraw: str, expected: dict):
+    """Template for the structure of dataraw, or None if the packet has a layout templates do not handle.
+
+    expected is the parse_expat output for dataraw; the template is only returned
+    if it reproduces it exactly.
+    """
+    pieces = []
+    keys = []
+    # index in pieces of the text of the element at each depth, not yet known to be a value
+    pending = {}
+    depth = 0
+    stats_id = None
+    names = [None, None]
+    nested = False
+
+    def value(key):
+        # the text of the element just closed is the value for key
+        index = pending.pop(depth + 1, None)
+        pattern = _HITS_VALUE if key == _CACHE_HITS else _VALUE
+        if index is None:
+            # empty element
+            pieces.append(pattern)
+        else:
+            pieces[index] = pattern
+        keys.append(key)
+
+    for token in _TOKEN.finditer(dataraw):
+        token = token.group()
+        if token[0] != '<':
+            if stats_id is not None and depth >= 3:
+                if depth == 3 and nested:
+                    # between grandchildren; ignored by the parser
+                    pieces.append(re.escape(token))
+                    continue
+                pending[depth] = len(pieces)
+                pieces.append(None)
+            else:
+                pieces.append(re.escape(token))
+            continue
+        if token.startswith('<!') or token.endswith('/>') or (token.startswith('<?') and depth > 0):
+            return None
+        if token.startswith('<?'):
+            pieces.append(re.escape(token))
+            continue
+        name = _TAG_NAME.match(token).group(1)
+        if token.startswith('</'):
+            depth -= 1
+            if stats_id is not None:
+                if depth == 1:
+                    stats_id = None
+                elif depth == 2 and not nested:
+                    value(_key(stats_id, names[0]))
+                elif depth == 3:
+                    value(_key(stats_id, names[0], names[1]))
+            pieces.append(re.escape(token))
+            continue
+
+        if depth == 0:
+            # attributes of the root element are values too
+            pos = 0
+            pattern = []
+            for attr in _ATTR.finditer(token):
+                pattern.append(re.escape(token[pos:attr.start(2) - 1]))
+                pattern.append(_ATTR_VALUE_GROUP)
+                keys.append(attr.group(1))
+                pos = attr.end(2) + 1
+            pattern.append(re.escape(token[pos:]))
+            pieces.append(''.join(pattern))
+        elif stats_id is not None:
+            if depth == 2:
+                names[0] = name
+                nested = False
+            elif depth == 3:
+                if pending.pop(3, None) is not None:
+                    # text before the first child; the parser treats this differently
+                    return None
+                nested = True
+                names[1] = name
+            else:
+                return None
+            pieces.append(re.escape(token))
+        else:
+            if depth == 1 and name == 'stats':
+                attrs = dict(_ATTR.findall(token))
+                stats_id = attrs.get('id', '')
+            pieces.append(re.escape(token))
+        depth += 1
+
+    if depth != 0 or pending or len(set(keys)) != len(keys) or set(keys) != set(expected):
+        return None
+    kinds = [_kind(k, expected[k]) for k in keys]
+    strings = {k: expected[k] for k, t in zip(keys, kinds) if t == _STR}
+    template = Template(''.join(pieces), keys, kinds, strings)
+
+    # only use the template if it gives exactly what the parser does
+    match = template.match(dataraw)
+    if match is None:
+        return None
+    got = template.extract(match)
+    if list(got) != list(expected) or any(type(got[k]) is not type(v) or got[k] != v for k, v in expected.items()):
+        return None
+    return template
+
+
+class TemplateCache:
+    """Parse xrd.report packets by matching them against the structure of earlier packets from the same source.
+
+    A source sends packets with the same elements every interval, and only the
+    values change. The first packet with a new structure is parsed with
+    parse_expat, and a Template (one regex with a group per value) is built from
+    it; later packets from any source with that structure are matched against
+    the template, and their values taken by position. A packet that does not
+    match its source's template, e.g. because the shape changed, is parsed in
+    full. Up to max_sources sources and max_templates structures are kept, the
+    least recently used being evicted first.
+    """
+    def __init__(self, max_sources: int = 10000, max_templates: int = 1000):
+        self.max_sources = max_sources
+        self.max_templates = max_templates
+        self._by_source = OrderedDict()
+        self._by_fingerprint = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.built = 0
+        self.unusable = 0
+
+    def parse(self, dataraw: str) -> dict:
+        end = dataraw.find('>')
+        m = _SRC.search(dataraw, 0, end if end >= 0 else len(dataraw))
+        src = m.group(1) if m else ''
+        with self._lock:
+            template = self._by_source.get(src)
+            if template is not None:
+                self._by_source.move_to_end(src)
+        if template is not None:
+            match = template.match(dataraw)
+            if match is not None:
+                with self._lock:
+                    self.hits += 1
+                return template.extract(match)
+
+        data = parse_expat(dataraw)
+        key = fingerprint(dataraw)
+        with self._lock:
+            self.misses += 1
+            known = key in self._by_fingerprint
+            template = self._by_fingerprint.get(key)
+            if known:
+                self._by_fingerprint.move_to_end(key)
+        if not known:
+            template = build_template(dataraw, data)
+            with self._lock:
+                self._by_fingerprint[key] = template
+                if template is None:
+                    # remember it cannot be templated, so it is not tried again
+                    self.unusable += 1
+                else:
+                    self.built += 1
+                while len(self._by_fingerprint) > self.max_templates:
+                    self._by_fingerprint.popitem(last=False)
+        if template is not None:
+            with self._lock:
+                self._by_source[src] = template
+                self._by_source.move_to_end(src)
+                while len(self._by_source) > self.max_sources:
+                    self._by_source.popitem(last=False)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': round(self.hits / total, 4) if total else 0.,
+                    'sources': len(self._by_source),
+                    'templates': self.built,
+                    'unusable': self.unusable,
+                    'cached_structures': len(self._by_fingerprint),
+                    }
+
+    def __str__(self):
+        return "TemplateCache(max_sources={}, max_templates={})".format(self.max_sources, self.max_templates)
@@ -0,0 +1,167 @@
+import logging
+import re
+import sys
+
+from xml.parsers import expat
+
+from xrdreporter.xrdLabels import XrdKey
+
+# value has extraneous ">" in last character
+_RE_CACHE_HITS = re.compile(r'(\d+)')
+_CACHE_HITS = 'cache__rd__hits'
+
+# interned key strings, indexed by the element path that produces them.
+# Seeded from the known xrd.report fields; anything else is added on first sight
+_MAX_KEYS = 10000
+_keys = {tuple(v.split('__')): sys.intern(v) for v in vars(XrdKey).values()}
+
+
+def _key(*path):
+    """Flat key for an element path, e.g. ('xrootd','ops','open') -> 'xrootd__ops__open'"""
+    try:
+        return _keys[path]
+    except KeyError:
+        key = sys.intern('__'.join(path))
+        if len(_keys) < _MAX_KEYS:
+            _keys[path] = key
+        return key
+
+
+def to_number(data: str):
+    """If possible convert to numeric type; integers are converted directly, without going via float"""
+    try:
+        return int(data)
+    except ValueError:
+        pass
+    try:
+        d = float(data)
+    except ValueError:
+        return data
+    return int(d) if d.is_integer() else d
+
+
+def parse_expat(dataraw):
+    """Single pass parse of an xrd.report packet into the same flat dict as parse_dom"""
+    data = {}
+    # (stats id, name of the current child of <stats>, name of the current grandchild)
+    path = [None, None, None]
+    # whether the current child of <stats> started with an element, and the text seen so far
+    state = {'depth': 0, 'nested': False}
+    text = []
+
+    def start(name, attrs):
+        depth = state['depth']
+        state['depth'] = depth + 1
+        if depth == 0:
+            for k, v in attrs.items():
+                data[k] = to_number(v)
+        elif path[0] is not None:
+            if depth == 2:
+                path[1] = name
+                state['nested'] = False
+                del text[:]
+            elif depth == 3:
+                if not text:
+                    # the first child of this element is an element
+                    state['nested'] = True
+                path[2] = name
+                del text[:]
+        elif name == 'stats':
+            path[0] = attrs.get('id', '')
+
+    def end(name):
+        depth = state['depth'] - 1
+        state['depth'] = depth
+        if path[0] is None:
+            return
+        if depth == 1:
+            path[0] = None
+        elif depth == 2:
+            if not state['nested']:
+                data[_key(path[0], path[1])] = to_number(''.join(text))
+        elif depth == 3 and state['nested']:
+            key = _key(path[0], path[1], path[2])
+            value = ''.join(text)
+            if key == _CACHE_HITS:
+                value = _RE_CACHE_HITS.match(value).group(1)
+            data[key] = to_number(value)
+            del text[:]
+
+    try:
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = text.append
+        parser.Parse(dataraw, True)
+    except Exception as e:
+        logging.debug("Error string parsing {}".format(dataraw[0:min(len(dataraw),50)]))
+        logging.error("Bad xml detected")
+        raise e
+    return data
+
+
+def compare_parsers(packets, reference, candidate):
+    """Parse each packet with both parsers; return a list of (packet index, key, reference value, candidate value) differences"""
+    differences = []
+    for i, packet in enumerate(packets):
+        expected = reference(packet)
+        got = candidate(packet)
+        for k in expected.keys() | got.keys():
+            if k not in expected or k not in got or expected[k] != got[k] or type(expected[k]) != type(got[k]):
+                differences.append((i, k, expected.get(k), got.get(k)))
+        if list(expected) != list(got) and not differences:
+            differences.append((i, '<key order>', list(expected), list(got)))
+    return differences
+
+
+SAMPLE_PACKETS = [
+    '<statistics tod="1650000000" ver="v5.4.2" src="ceph-gw1.example:1094" tos="1649990000" pgm="xrootd" ins="anon" pid="1234" site="RAL">'
+    '<stats id="info"><host>ceph-gw1.example</host><port>1094</port><name>ceph</name></stats>'
+    '<stats id="buff"><reqs>10</reqs><mem>2048</mem><buffs>3</buffs><adj>0</adj><xlreqs>0</xlreqs><xlmem>0</xlmem><xlbuffs>0</xlbuffs></stats>'
+    '<stats id="link"><num>3</num><maxn>10</maxn><tot>100</tot><in>123456789012</in><out>5.5</out><ctime>10</ctime><tmo>0</tmo><stall>0</stall><sfps>0</sfps></stats>'
+    '<stats id="poll"><att>3</att><en>77</en><ev>74</ev><int>0</int></stats>'
+    '<stats id="proc"><usr><s>1</s><u>2</u></usr><sys><s>1</s><u>5</u></sys></stats>'
+    '<stats id="xrootd"><num>1</num><ops><open>4</open><rf>0</rf><rd>7</rd><pr>0</pr><rv>0</rv><rs>0</rs><wv>0</wv><ws>0</ws><wr>2</wr><sync>0</sync><getf>0</getf><putf>0</putf><misc>11</misc></ops>'
+    '<sig><ok>0</ok><bad>0</bad><ign>0</ign></sig><aio><num>0</num><max>0</max><rej>0</rej></aio><err>0</err><rdr>0</rdr><dly>0</dly>'
+    '<lgn><num>3</num><af>0</af><au>3</au><ua>0</ua></lgn></stats>'
+    '<stats id="ofs"><role>server</role><opr>1</opr><opw>0</opw><opp>0</opp><ups>0</ups><han>1</han><rdr>0</rdr><bxq>0</bxq><rep>0</rep><err>0</err><dly>0</dly><sok>0</sok><ser>0</ser>'
+    '<tpc><grnt>1</grnt><deny>0</deny><err>0</err><exp>0</exp></tpc></stats>'
+    '<stats id="sched"><jobs>51</jobs><inq>0</inq><maxinq>1</maxinq><threads>9</threads><idle>7</idle><tcr>9</tcr><tde>0</tde><tlimr>0</tlimr></stats>'
+    '<stats id="sgen"><as>0</as><et>1</et><toe>1650000001</toe></stats>'
+    '</statistics>',
+    '<statistics tod="1650000010" ver="v5.5.0" src="xcache.example:1094" tos="1649990000" pgm="xrootd" ins="cache" pid="99" site="RAL">'
+    '<stats id="info"><host>xcache.example</host><port>1094</port><name>cache</name></stats>'
+    '<stats id="cache" type="pfc"><prerd><in>0</in><hits>0</hits><miss>0</miss></prerd><rd><in>5</in><out>0.25</out><hits>3&gt;</hits><miss>2</miss></rd>'
+    '<pass>0</pass><wr>0</wr><saved>1.5e3</saved><purge>0</purge></stats>'
+    '<stats id="oss" v="2"><paths>1</paths><space>0</space></stats>'
+    '</statistics>',
+]
+
+
+if __name__ == "__main__":
+    # check that the streaming parser gives the same output as the minidom one
+    from xrdreporter.requestHandlers import parse_dom
+
+    packets = SAMPLE_PACKETS
+    if len(sys.argv) > 1:
+        # one packet per line, e.g. from a capture of xrd.report traffic
+        packets = []
+        for filename in sys.argv[1:]:
+            with open(filename) as f:
+                packets.extend(line.strip() for line in f if line.strip())
+
+    differences = compare_parsers(packets, parse_dom, parse_expat)
+    for d in differences:
+        print("packet {}: {} minidom={!r} expat={!r}".format(*d))
+    print("{} packets compared, {} differences".format(len(packets), len(differences)))
+
+    # and that the template cache does too, once it has seen each structure
+    from xrdreporter.templates import TemplateCache
+    cache = TemplateCache()
+    template_differences = compare_parsers(packets + packets, parse_expat, cache.parse)
+    for d in template_differences:
+        print("packet {}: {} expat={!r} template={!r}".format(*d))
+    print("{} packets compared with the template cache, {} differences; {}".format(
+          2 * len(packets), len(template_differences), cache.stats()))
+    sys.exit(1 if differences or template_differences else 0)
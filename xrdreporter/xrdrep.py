@@ -1,43 +1,80 @@
 #!/usr/bin/env python3
 
 import argparse 
-import configparser
 import json
 import logging
 import os
-import re
+import signal
 import socketserver
-import threading
-import xml
+import sys
+import time
 
 from pathlib import Path
-from threading import Lock
-from xml.dom import minidom
 
-import xrdreporter
+from xrdreporter.batching import BatchWriter
+from xrdreporter.capture import CaptureWriter, replay
+from xrdreporter.changes import ChangeFilter
+from xrdreporter.deltas import DeltaStore
+from xrdreporter.dispatch import BLOCK, ObserverDispatcher, ObserverQueue
+from xrdreporter.enrich import Enricher
+from xrdreporter.filters import FieldFilter
+from xrdreporter.metrics import SelfMetricsReporter
 from xrdreporter.requestHandlers import MyUDPRequestHandler
-from xrdreporter.observers import FileObserver, LoggerObserver, SummaryLoggerObserver, ElasticSearchObserver, InfluxDB2Observer
+from xrdreporter.rollup import Rollup
+from xrdreporter.observers import SummaryLoggerObserver
+from xrdreporter.registry import observer_class
+from xrdreporter.reload import Reloader, read_config
+from xrdreporter.servers import ReusePortThreadingUDPServer, WorkerPoolUDPServer, set_rcvbuf, udp_socket_stats
+from xrdreporter.supervisor import MetricsPublisher, Supervisor
+from xrdreporter.templates import TemplateCache
 
 
-def create_observers(config):
-    """create a list of observers, based on input of external config-parser output"""
-    import importlib
-    module = importlib.import_module('xrdreporter.observers')
+# keys of [DEFAULT] that configure the collector itself, rather than the observers
+PIPELINE_KEYS = ('include_fields', 'exclude_fields')
 
+
+def section_params(config, name, ignore=PIPELINE_KEYS):
+    """the params of a config section, without the ignored keys, or None if there is no such section"""
+    if config is None or not config.has_section(name):
+        return None
+    return {k: v for k, v in config[name].items() if k not in ignore}
+
+
+def create_observers(config, previous=None):
+    """create a list of observers, based on input of external config-parser output;
+    only the modules of the enabled observers are imported.
+    An observer in previous whose section is unchanged is kept rather than created again"""
+    previous = {getattr(obs, 'name', None): obs for obs in previous or []}
     observers = []
-    for section_name in config.sections():
-        section = config[section_name]
-        if 'observer' not in section:
-            continue # not an observer section
-        if section.getboolean('enabled',fallback=False) == False:
-            logging.info("Observer {} is disabled; use 'enabled = true' to enable it".format(section_name))
-            continue # disabled
-        ObserverClass = getattr(module, section.get('observer'))
-        #copy the params for the section
-        #don't print out params here, in case there's sensitive info
-        params = dict(section)
-        #create the object
-        observers.append( ObserverClass(params) )
+    created = []
+    try:
+        for section_name in config.sections():
+            section = config[section_name]
+            if 'observer' not in section:
+                continue # not an observer section
+            if section.getboolean('enabled',fallback=False) == False:
+                logging.info("Observer {} is disabled; use 'enabled = true' to enable it".format(section_name))
+                continue # disabled
+            # what the observer was created from; 'streams' only says where the handler sends it records
+            key = section_params(config, section_name, PIPELINE_KEYS + ('streams',))
+            observer = previous.get(section_name)
+            if observer is None or getattr(observer, 'config_params', None) != key:
+                ObserverClass = observer_class(section.get('observer'))
+                #copy the params for the section
+                #don't print out params here, in case there's sensitive info
+                params = dict(section)
+                #create the object
+                observer = ObserverClass(params)
+                observer.name = section_name
+                observer.config_params = key
+                created.append(observer)
+            # 'raw' for every processed record, 'rollup' for the [ROLLUP] aggregates, or both
+            observer.streams = {x.strip() for x in section.get('streams', 'raw').split(",") if len(x.strip())}
+            observers.append(observer)
+    except Exception:
+        for observer in created:
+            observer.close()
+        raise
 
 
     logging.debug('Observers created: {}'.format(observers))
@@ -45,6 +82,413 @@ def create_observers(config):
     return observers
 
 
+def create_dispatcher(config, observers, previous=None):
+    """put each observer behind its own queue and worker, using the dispatch_* options of its config section;
+    an observer that already has a queue in the previous dispatcher keeps it"""
+    queues = {id(q.observer): q for q in previous.queues} if previous is not None else {}
+    for obs in observers:
+        if id(obs) in queues:
+            continue
+        name = getattr(obs, 'name', str(obs))
+        params = config[name] if config.has_section(name) else {}
+        queues[id(obs)] = ObserverQueue.from_params(obs, params, name=name)
+    return ObserverDispatcher(queues[id(obs)] for obs in observers)
+
+
+def holds_resources(observer) -> bool:
+    """whether the observer holds something a replacement for it would need too: a spool directory or a listening socket"""
+    params = getattr(observer, 'config_params', None) or {}
+    return bool(params.get('spool_dir')) or getattr(observer, 'server', None) is not None
+
+
+def release_observers(observers, config, drain_delay=1.):
+    """take observers out of the running handler, then flush and close them, so a
+    replacement can take over their spool directory or port"""
+    handler = MyUDPRequestHandler
+    old_dispatcher = handler.dispatcher
+    if old_dispatcher is not None:
+        handler.dispatcher = create_dispatcher(config, [obs for obs in handler.observers if obs not in observers],
+                                               previous=old_dispatcher)
+    handler.observers = [obs for obs in handler.observers if obs not in observers]
+    if handler.rollup is not None:
+        handler.rollup.observers = [obs for obs in handler.rollup.observers if obs not in observers]
+    time.sleep(drain_delay)
+    queues = {id(q.observer): q for q in old_dispatcher.queues} if old_dispatcher is not None else {}
+    for obs in observers:
+        logging.info("Closing observer {} before replacing it".format(getattr(obs, 'name', obs)))
+        if id(obs) in queues:
+            queues[id(obs)].close()
+        else:
+            obs.close()
+
+
+def restore_observers(config, server=None):
+    """recreate the observers of config that are missing from the running handler,
+    after a failed reload released them; returns the observers recreated"""
+    handler = MyUDPRequestHandler
+    running = list(handler.observers)
+    if handler.rollup is not None:
+        running.extend(obs for obs in handler.rollup.observers if obs not in running)
+    observers = create_observers(config, previous=running)
+    raw_observers = [obs for obs in observers if 'raw' in obs.streams]
+    if handler.dispatcher is not None:
+        handler.dispatcher = create_dispatcher(config, raw_observers, previous=handler.dispatcher)
+    handler.observers = raw_observers
+    if handler.rollup is not None:
+        handler.rollup.observers = [obs for obs in observers if 'rollup' in obs.streams]
+    register_gauges(handler.metrics, server)
+    return [obs for obs in observers if obs not in running]
+
+
+def close_observers():
+    """flush anything the observers still have buffered, and log the final stats"""
+    rollup = MyUDPRequestHandler.rollup
+    if rollup is not None:
+        # emits the last, partial, window
+        rollup.close()
+    if MyUDPRequestHandler.dispatcher is not None:
+        MyUDPRequestHandler.dispatcher.close()
+    else:
+        for obs in MyUDPRequestHandler.observers:
+            obs.close()
+    if rollup is not None:
+        for obs in rollup.observers:
+            if obs not in MyUDPRequestHandler.observers:
+                obs.close()
+    logging.info("Final stats: {}".format(json.dumps(MyUDPRequestHandler.metrics.snapshot())))
+
+
+def replay_losses(snapshot: dict) -> dict:
+    """the records that did not make it to each observer, from a metrics snapshot: {gauge: {counter: n}}"""
+    gauges = snapshot.get('gauges', {})
+    lost = {}
+    for name, stats in gauges.items():
+        if name.startswith('writer__'):
+            counts = {k: stats.get(k, 0) for k in ('dropped', 'failed', 'rejected')}
+        elif name == 'observers':
+            for queue_name, q in stats.items():
+                counts = {k: q.get(k, 0) for k in ('dropped', 'errors')}
+                if any(counts.values()):
+                    lost['observer__' + queue_name] = counts
+            continue
+        elif name == 'rollup':
+            counts = {k: stats.get(k, 0) for k in ('dropped', 'late', 'errors')}
+        else:
+            continue
+        if any(counts.values()):
+            lost[name] = counts
+    return lost
+
+
+def register_gauges(metrics, server):
+    """make the state of the server, filter, delta store and observer queues/writers part of the self-metrics"""
+    handler = MyUDPRequestHandler
+    metrics.gauge('field_filter', lambda: handler.field_filter.hits())
+    metrics.gauge('enrich', lambda: handler.enricher.stats())
+    if handler.parser == 'template':
+        metrics.gauge('templates', lambda: handler.template_cache.stats())
+    if handler.do_deltas:
+        metrics.gauge('deltas', lambda: handler.delta_store.stats())
+    if handler.changes is not None:
+        metrics.gauge('changes', handler.changes.stats)
+    if handler.dispatcher is not None:
+        metrics.gauge('observers', lambda: handler.dispatcher.stats())
+    observers = list(handler.observers)
+    if handler.rollup is not None:
+        metrics.gauge('rollup', handler.rollup.stats)
+        observers.extend(obs for obs in handler.rollup.observers if obs not in observers)
+    for obs in observers:
+        if hasattr(obs, 'writer'):
+            metrics.gauge('writer__{}'.format(getattr(obs, 'name', obs)), obs.writer.stats)
+        if hasattr(obs, 'stats'):
+            metrics.gauge('observer__{}'.format(getattr(obs, 'name', obs)), obs.stats)
+    if server is not None and hasattr(server, 'stats'):
+        metrics.gauge('server', server.stats)
+    elif server is not None:
+        # kernel-side receive queue and drops, for the threading server
+        metrics.gauge('server', lambda: udp_socket_stats(server.socket))
+
+
+def create_server(server_address, server_config=None, reuse_port=False):
+    """create the UDP server, based on the 'mode' of the [SERVER] config section.
+    With reuse_port, several processes can listen on the same port"""
+    mode = 'threading' if server_config is None else server_config.get('mode', 'threading')
+    rcvbuf = 0 if server_config is None else server_config.getint('rcvbuf', 0) # bytes; 0 for the system default
+    if mode == 'threading':
+        # Each request is processed through a different thread
+        if reuse_port:
+            server = ReusePortThreadingUDPServer(server_address, MyUDPRequestHandler)
+        else:
+            server = socketserver.ThreadingUDPServer(server_address, MyUDPRequestHandler)
+        if rcvbuf:
+            set_rcvbuf(server.socket, rcvbuf)
+        return server
+    if mode == 'pool':
+        # One socket reader, with a fixed pool of workers behind a bounded queue
+        return WorkerPoolUDPServer(server_address, MyUDPRequestHandler,
+                                   pool_size=server_config.getint('pool_size', 4),
+                                   queue_size=server_config.getint('queue_size', 1000),
+                                   overflow=server_config.get('overflow', 'drop-newest'),
+                                   metrics=MyUDPRequestHandler.metrics,
+                                   reuse_port=reuse_port,
+                                   rcvbuf=rcvbuf)
+    if mode == 'asyncio':
+        # One event loop, draining the socket in batches and passing each batch on at once
+        # asyncio is only imported when it is used
+        from xrdreporter.aioserver import AsyncUDPServer
+        return AsyncUDPServer(server_address, MyUDPRequestHandler,
+                              batch_size=server_config.getint('batch_size', 64),
+                              rcvbuf=rcvbuf,
+                              max_pending=server_config.getint('max_pending', 100),
+                              metrics=MyUDPRequestHandler.metrics,
+                              reuse_port=reuse_port)
+    raise ValueError("Unknown server mode '{}'".format(mode))
+
+
+def configure_handler(config, args):
+    """set up the request handler: parser, field filter, delta state, observers and dispatcher"""
+    MyUDPRequestHandler.do_deltas = args.deltas
+    if args.parser is not None:
+        MyUDPRequestHandler.parser = args.parser
+    elif config is not None and config.has_section('SERVER'):
+        MyUDPRequestHandler.parser = config['SERVER'].get('parser', MyUDPRequestHandler.parser)
+    if config is not None and config.has_section('SERVER'):
+        MyUDPRequestHandler.template_cache = TemplateCache(max_sources=config['SERVER'].getint('template_sources', 10000),
+                                                           max_templates=config['SERVER'].getint('template_structures', 1000))
+    # register observers against the handler. These send the process output elsewhere
+    if args.debug and config is None:
+        # register a default handler if no config, and debug mode
+        MyUDPRequestHandler.observers.append(SummaryLoggerObserver({'level':'INFO'}))
+    # # dynamic loading of any components specified in the config file
+    if config is not None:
+        observers = create_observers(config)
+        MyUDPRequestHandler.observers.extend(obs for obs in observers if 'raw' in obs.streams)
+        if config.has_section('CHANGES') and config['CHANGES'].getboolean('enabled', fallback=False):
+            MyUDPRequestHandler.changes = ChangeFilter.from_config(config['CHANGES'])
+            logging.debug("Change filter: {}".format(MyUDPRequestHandler.changes))
+        if config.has_section('ROLLUP') and config['ROLLUP'].getboolean('enabled', fallback=False):
+            MyUDPRequestHandler.rollup = Rollup.from_config(config['ROLLUP'],
+                                                            [obs for obs in observers if 'rollup' in obs.streams])
+            logging.debug("Rollup: {}".format(MyUDPRequestHandler.rollup))
+        else:
+            for obs in observers:
+                if 'rollup' in obs.streams and 'raw' not in obs.streams:
+                    logging.warning("Observer {} only takes rollups, but [ROLLUP] is not enabled".format(obs.name))
+        MyUDPRequestHandler.field_filter = FieldFilter(config['DEFAULT'].get('include_fields',".*"),
+                                                       config['DEFAULT'].get('exclude_fields',""))
+        logging.debug("Field filter: {}".format(MyUDPRequestHandler.field_filter))
+        if config.has_section('ENRICH'):
+            MyUDPRequestHandler.enricher = Enricher.from_config(config['ENRICH'])
+        logging.debug("Enrichment: {}".format(MyUDPRequestHandler.enricher))
+        if config.has_section('DELTAS'):
+            deltas_config = config['DELTAS']
+            MyUDPRequestHandler.do_deltas = args.deltas or deltas_config.getboolean('enabled', fallback=False)
+            MyUDPRequestHandler.delta_store = DeltaStore.from_config(deltas_config)
+            logging.debug("Delta state: {}".format(MyUDPRequestHandler.delta_store))
+
+    logging.debug("Configured Observers: \n\t{}".format( "\n\t".join(str(x) for x in MyUDPRequestHandler.observers)))
+    if config is not None and config.has_section('SERVER') and config['SERVER'].get('dispatch', 'sync') == 'async':
+        MyUDPRequestHandler.dispatcher = create_dispatcher(config, MyUDPRequestHandler.observers)
+        logging.debug("Dispatcher: {}".format(MyUDPRequestHandler.dispatcher))
+
+
+def reload_handler(old_config, config, args, server=None, worker=None, drain_delay=1.):
+    """swap the filters and observers of a changed config into the running handler.
+
+    Everything is built before the swap, so if anything fails the running pipeline is left
+    as it was. Observers, delta state, change state and rollups whose config sections are
+    unchanged are carried over, with their connections, buffers and per-source state.
+    Each component is replaced by a single assignment, so datagrams keep being processed
+    throughout; observers that were removed or changed are closed, flushing what they
+    hold, once the datagrams already being processed have had drain_delay seconds to reach them.
+    Those with a spool directory or a listening socket are closed before the new observers
+    are created instead, so a replacement can take them over, and are recreated if the reload fails.
+    [SERVER] and [CAPTURE] are only read at startup.
+    """
+    handler = MyUDPRequestHandler
+    for name in ('SERVER', 'CAPTURE'):
+        if section_params(old_config, name) != section_params(config, name):
+            logging.warning("Changes to [{}] only take effect after a restart".format(name))
+
+    def unchanged(name):
+        return section_params(old_config, name) == section_params(config, name)
+
+    def enabled(name):
+        return config.has_section(name) and config[name].getboolean('enabled', fallback=False)
+
+    old_observers = list(handler.observers)
+    if handler.rollup is not None:
+        old_observers.extend(obs for obs in handler.rollup.observers if obs not in old_observers)
+
+    def replaced(obs):
+        name = getattr(obs, 'name', None)
+        return not enabled(name) or \
+            section_params(config, name, PIPELINE_KEYS + ('streams',)) != getattr(obs, 'config_params', None)
+
+    # an observer's replacement, or a new section, may need its spool directory or port:
+    # close it first, and bring it back if the reload fails
+    released = [obs for obs in old_observers if replaced(obs) and holds_resources(obs)]
+    if released:
+        release_observers(released, old_config, drain_delay)
+
+    def restore():
+        if not released:
+            return
+        try:
+            restore_observers(old_config, server)
+        except Exception as e:
+            logging.error("Could not recreate the observers closed for the reload: {}".format(e))
+
+    rollup = None
+    try:
+        observers = create_observers(config, previous=[obs for obs in old_observers if obs not in released])
+    except Exception:
+        restore()
+        raise
+    added = [obs for obs in observers if obs not in old_observers]
+    try:
+        field_filter = FieldFilter(config['DEFAULT'].get('include_fields',".*"),
+                                   config['DEFAULT'].get('exclude_fields',""))
+        enricher = handler.enricher
+        if not unchanged('ENRICH'):
+            enricher = Enricher.from_config(config['ENRICH']) if config.has_section('ENRICH') else Enricher()
+        do_deltas = args.deltas or (config.has_section('DELTAS') and config['DELTAS'].getboolean('enabled', fallback=False))
+        delta_store = handler.delta_store
+        if not unchanged('DELTAS'):
+            delta_store = DeltaStore.from_config(config['DELTAS']) if config.has_section('DELTAS') else DeltaStore()
+            logging.info("[DELTAS] changed; the delta state starts afresh")
+        changes = None
+        if enabled('CHANGES'):
+            changes = handler.changes if unchanged('CHANGES') and handler.changes is not None \
+                      else ChangeFilter.from_config(config['CHANGES'])
+        rollup_observers = [obs for obs in observers if 'rollup' in obs.streams]
+        if enabled('ROLLUP'):
+            if unchanged('ROLLUP') and handler.rollup is not None:
+                rollup = handler.rollup
+            else:
+                rollup = Rollup.from_config(config['ROLLUP'], rollup_observers)
+                if worker is not None:
+                    rollup.src = '{}-w{}'.format(rollup.src, worker)
+        raw_observers = [obs for obs in observers if 'raw' in obs.streams]
+        dispatcher = None
+        if handler.dispatcher is not None:
+            dispatcher = create_dispatcher(config, raw_observers, previous=handler.dispatcher)
+    except Exception:
+        if rollup is not None and rollup is not handler.rollup:
+            rollup.close()
+        for obs in added:
+            obs.close()
+        restore()
+        raise
+
+    delta_state = 'kept' if delta_store is handler.delta_store else 'reset'
+    # the swap
+    old_rollup, old_dispatcher = handler.rollup, handler.dispatcher
+    handler.field_filter = field_filter
+    handler.enricher = enricher
+    handler.delta_store = delta_store
+    handler.do_deltas = do_deltas
+    handler.changes = changes
+    if rollup is not None:
+        rollup.observers = rollup_observers
+    handler.rollup = rollup
+    handler.dispatcher = dispatcher
+    handler.observers = raw_observers
+
+    removed = [obs for obs in old_observers if obs not in observers]
+    for name in ('deltas', 'changes', 'rollup'):
+        handler.metrics.remove_gauge(name)
+    for obs in removed:
+        handler.metrics.remove_gauge('writer__{}'.format(getattr(obs, 'name', obs)))
+        handler.metrics.remove_gauge('observer__{}'.format(getattr(obs, 'name', obs)))
+    register_gauges(handler.metrics, server)
+    logging.info("Configuration swapped in: {} observers kept, {} added, {} removed; delta state {}".format(
+                 len(observers) - len(added), len(added), len(removed), delta_state))
+
+    time.sleep(drain_delay)
+    if old_rollup is not None and old_rollup is not rollup:
+        # emits the last, partial, window of the old rollup to its observers
+        old_rollup.close()
+    closed = set()
+    if old_dispatcher is not None:
+        kept = {id(q) for q in dispatcher.queues}
+        for q in old_dispatcher.queues:
+            if id(q) not in kept:
+                # an observer that now only takes rollups stays open
+                q.close(close_observer=q.observer not in observers)
+                closed.add(id(q.observer))
+    for obs in removed:
+        if id(obs) not in closed and obs not in released:
+            obs.close()
+
+
+def serve(config, args, worker=None, metrics_queue=None):
+    """configure the handler, then listen and process datagrams until interrupted.
+    worker is the index of this process when running several (see Supervisor)"""
+    configure_handler(config, args)
+    server_config = config['SERVER'] if config is not None else None
+
+    if config is not None and config.has_section('CAPTURE') and config['CAPTURE'].getboolean('enabled', fallback=False):
+        capture_config = config['CAPTURE']
+        prefix = capture_config.get('prefix', 'xrdreport')
+        MyUDPRequestHandler.capture = CaptureWriter(capture_config.get('directory'),
+                                                    prefix=prefix if worker is None else '{}-w{}'.format(prefix, worker),
+                                                    segment_size=capture_config.getint('segment_size', 64 << 20))
+        MyUDPRequestHandler.metrics.gauge('capture', MyUDPRequestHandler.capture.stats)
+
+    # prepare and start the loop 
+    if config is not None:
+        ServerAddress = (server_config.get('address'), server_config.getint('port'))
+    else:
+        ServerAddress = ('0.0.0.0', 9931)
+    # Create a Server Instance using context manager
+    with create_server(ServerAddress, server_config, reuse_port=worker is not None) as UDPServerObject:
+        register_gauges(MyUDPRequestHandler.metrics, UDPServerObject)
+        self_metrics = None
+        if server_config is not None and server_config.getfloat('self_metrics_interval', 0) > 0:
+            # re-emit our own metrics through the observers, as an 'xrdreporter' measurement
+            self_metrics = SelfMetricsReporter(MyUDPRequestHandler.metrics, MyUDPRequestHandler.emit,
+                                               interval=server_config.getfloat('self_metrics_interval'))
+            if worker is not None:
+                self_metrics.src = '{}-w{}'.format(self_metrics.src, worker)
+        if MyUDPRequestHandler.rollup is not None and worker is not None:
+            # each worker only sees its share of the sources, so keep their rollups apart
+            MyUDPRequestHandler.rollup.src = '{}-w{}'.format(MyUDPRequestHandler.rollup.src, worker)
+        publisher = None
+        if metrics_queue is not None:
+            publisher = MetricsPublisher(worker, MyUDPRequestHandler.metrics, metrics_queue)
+        if worker is not None:
+            # so a 'stats' query gets all the workers, whichever one the kernel hands it to
+            MyUDPRequestHandler.worker = worker
+            MyUDPRequestHandler.merged_stats_path = os.environ.get('XRDREP_STATS_FILE')
+        reloader = None
+        if config is not None and args.config:
+            # re-read the config files on SIGHUP and swap the changes in, without stopping the server
+            reloader = Reloader(args.config, config,
+                                lambda old, new: reload_handler(old, new, args, UDPServerObject, worker))
+            reloader.install()
+            MyUDPRequestHandler.metrics.gauge('reload', reloader.stats)
+            if server_config.getboolean('reload_command', fallback=False):
+                if worker is None:
+                    MyUDPRequestHandler.reload = reloader.request
+                else:
+                    # the supervisor passes the signal on to every worker
+                    MyUDPRequestHandler.reload = lambda: os.kill(os.getppid(), signal.SIGHUP)
+        # Make the server wait forever serving connections
+        try:
+            UDPServerObject.serve_forever()
+        finally:
+            if reloader is not None:
+                reloader.close()
+            if self_metrics is not None:
+                self_metrics.close()
+            if MyUDPRequestHandler.capture is not None:
+                MyUDPRequestHandler.capture.close()
+            close_observers()
+            if publisher is not None:
+                publisher.close()
+
+
 
 if __name__ == "__main__":
 
@@ -57,6 +501,12 @@ if __name__ == "__main__":
     parser.add_argument('-d','--debug',help='Enable additional logging',action='store_true')
     parser.add_argument('-l','--log',help='Send all logging to a dedicated file',dest='logfile',default=None)
     parser.add_argument('--deltas',help='Also calculate derivatives between measurements',action='store_true')
+    parser.add_argument('--parser',help='xml parser to use for the xrd.report packets (default: template)',
+                                   choices=['template','expat','minidom'],default=None)
+    parser.add_argument('--replay',help='process datagrams from capture segment files, instead of listening',
+                                   type=Path,nargs='+',default=None)
+    parser.add_argument('--replay-speed',help='replay speed, as a multiple of the original rate (default 0: as fast as possible)',
+                                         type=float,default=0.)
 
     # # es parameters
     # parser.add_argument('-e','--eshosts', default=[], type=str, nargs='+',help='Elastic search hosts')
@@ -68,37 +518,47 @@ if __name__ == "__main__":
                     format='XRDREPORT-%(asctime)s-%(process)d-%(levelname)s-%(message)s',                  
                     )
 
-    if args.config is not None:
+    config = None
+    if args.config:
         logging.debug("Config files: {}".format(args.config))
-        config = configparser.ConfigParser()
-        config.read(args.config)
+        config = read_config(args.config)
 
         logging.debug("Sections: {}".format(','.join(config.sections())))
 
 
+    if args.replay:
+        # push captured datagrams through the same pipeline, then stop
+        # nothing is lost by waiting for a slow sink here, so hold the replay back rather than drop records
+        BatchWriter.block = True
+        configure_handler(config, args)
+        if MyUDPRequestHandler.dispatcher is not None:
+            for q in MyUDPRequestHandler.dispatcher.queues:
+                q.policy = BLOCK
+        register_gauges(MyUDPRequestHandler.metrics, None)
+        n = 0
+        try:
+            n = replay(sorted(args.replay), lambda packet, client_address: MyUDPRequestHandler.process(packet, client_address, None),
+                       speed=args.replay_speed)
+        finally:
+            close_observers()
+        lost = replay_losses(MyUDPRequestHandler.metrics.snapshot())
+        if lost:
+            logging.warning("Replayed {} datagrams; records lost: {}".format(n, json.dumps(lost)))
+        else:
+            logging.info("Replayed {} datagrams".format(n))
+        sys.exit(0)
 
-    MyUDPRequestHandler.do_deltas = args.deltas
-    # register observers against the handler. These send the process output elsewhere
-    if args.debug and not args.config:
-        # register a default handler if no config, and debug mode
-        MyUDPRequestHandler.observers.append(SummaryLoggerObserver({'level':'INFO'}))
-    # # dynamic loading of any components specified in the config file
-    if args.config:
-        MyUDPRequestHandler.observers.extend( create_observers(config) )
-        MyUDPRequestHandler.include_fields = config['DEFAULT'].get('include_fields',".*")
-        MyUDPRequestHandler.exclude_fields = config['DEFAULT'].get('exclude_fields',"")
-
-    logging.debug("Configured Observers: \n\t{}".format( "\n\t".join(str(x) for x in MyUDPRequestHandler.observers)))
-
-
-    # prepare and start the loop 
-    if args.config:
-        ServerAddress = (config['SERVER'].get('address'), config['SERVER'].getint('port'))
+    workers = config['SERVER'].getint('workers', 1) if config is not None and config.has_section('SERVER') else 1
+    if workers > 1:
+        # one process per core, sharing the port; the kernel spreads the sources over them
+        # each worker reads the config files when it starts, so one restarted after a reload uses the new config
+        supervisor = Supervisor(workers, lambda index, metrics_queue: serve(read_config(args.config), args, index, metrics_queue),
+                                log_interval=config['SERVER'].getfloat('stats_log_interval', 300.),
+                                max_restart_delay=config['SERVER'].getfloat('max_restart_delay', 60.),
+                                max_failures=config['SERVER'].getint('max_worker_failures', 5),
+                                failure_window=config['SERVER'].getfloat('worker_failure_window', 300.))
+        if not supervisor.run():
+            sys.exit(1)
     else:
-        ServerAddress = ('0.0.0.0', 9931)
-    # Create a Server Instance using context manager
-    # Each request is processed through a different thread
-    with socketserver.ThreadingUDPServer(ServerAddress, MyUDPRequestHandler) as UDPServerObject:
-        # Make the server wait forever serving connections
-        UDPServerObject.serve_forever()
+        serve(config, args)
     logging.info("Server terminating")